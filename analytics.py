@@ -0,0 +1,152 @@
+"""
+Server-side aggregation and downsampling of flow series.
+
+Both work directly on the column arrays of `columnar.DeviceSeries`, on the
+time each sample was taken rather than `received_at`: a batch of 10
+samples shares one `received_at` stamp (set at upload), so `sample_times()`
+places the newest sample of a batch at that stamp and the others before it
+by their `timestamp` (device millis()) distance to it.
+
+- `aggregate()` folds samples into fixed time buckets (1m/15m/1h/1d) with
+  min/max/mean flow rate and volume delta, using `ufunc.reduceat`.
+- `lttb()` picks at most N visually significant points (Largest Triangle
+  Three Buckets) so charts stay light no matter how long the history is.
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+from columnar import NAT, to_records
+
+MS_NS = 1_000_000
+MINUTE_NS = 60 * 1_000_000_000
+
+BUCKETS = {
+    "1m": MINUTE_NS,
+    "15m": 15 * MINUTE_NS,
+    "1h": 60 * MINUTE_NS,
+    "1d": 24 * 60 * MINUTE_NS,
+}
+
+# Default number of points sent to a chart
+CHART_MAX_POINTS = 1000
+
+
+def sample_times(columns: Dict[str, np.ndarray]) -> np.ndarray:
+    """Epoch ns at which each sample was taken.
+
+    ``received_at - (batch max timestamp - timestamp)`` ms, where a batch is
+    a run of rows with the same ``received_at``. Rows without a
+    ``received_at`` stay NaT.
+    """
+    received_at = columns["received_at"]
+    if len(received_at) == 0:
+        return received_at.copy()
+    timestamp = columns["timestamp"]
+    starts = np.flatnonzero(np.concatenate(([True], received_at[1:] != received_at[:-1])))
+    lengths = np.diff(np.append(starts, len(received_at)))
+    batch_max = np.repeat(np.maximum.reduceat(timestamp, starts), lengths)
+    return np.where(received_at == NAT, NAT, received_at - (batch_max - timestamp) * MS_NS)
+
+
+def by_sample_time(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Columns plus ``sampled_at`` (`sample_times`), ordered by it."""
+    sampled_at = sample_times(columns)
+    columns = dict(columns, sampled_at=sampled_at)
+    if len(sampled_at) > 1 and np.any(sampled_at[1:] < sampled_at[:-1]):
+        order = np.argsort(sampled_at, kind="stable")
+        return {name: values[order] for name, values in columns.items()}
+    return columns
+
+
+def aggregate(columns: Dict[str, np.ndarray], bucket_ns: int) -> Dict[str, np.ndarray]:
+    """Aggregate one device's columns into buckets of ``bucket_ns`` of sample time.
+
+    Returns arrays ``bucket_start`` (epoch ns), ``count``, ``flow_min``,
+    ``flow_max``, ``flow_mean`` and ``volume_delta`` (last - first volume in
+    the bucket). NaN samples are ignored.
+    """
+    columns = by_sample_time(columns)
+    sampled_at = columns["sampled_at"]
+    if len(sampled_at) == 0:
+        empty_f = np.empty(0, dtype=np.float64)
+        return {"bucket_start": np.empty(0, dtype=np.int64),
+                "count": np.empty(0, dtype=np.int64),
+                "flow_min": empty_f, "flow_max": empty_f,
+                "flow_mean": empty_f, "volume_delta": empty_f}
+
+    bucket = sampled_at // bucket_ns
+    starts = np.flatnonzero(np.concatenate(([True], bucket[1:] != bucket[:-1])))
+    ends = np.append(starts[1:], len(bucket)) - 1
+
+    flow = columns["flow_rate"].astype(np.float64)
+    valid = ~np.isnan(flow)
+    count = np.add.reduceat(valid.astype(np.int64), starts)
+    flow_sum = np.add.reduceat(np.where(valid, flow, 0.0), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        flow_mean = np.where(count > 0, flow_sum / count, np.nan)
+
+    volume = columns["volume"].astype(np.float64)
+    return {
+        "bucket_start": bucket[starts] * bucket_ns,
+        "count": np.diff(np.append(starts, len(bucket))),
+        "flow_min": np.fmin.reduceat(flow, starts),
+        "flow_max": np.fmax.reduceat(flow, starts),
+        "flow_mean": flow_mean,
+        "volume_delta": volume[ends] - volume[starts],
+    }
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int = CHART_MAX_POINTS) -> np.ndarray:
+    """Return the indices of at most ``threshold`` points chosen by LTTB."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+    # Bucket boundaries for the n-2 inner points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        next_hi = max(next_hi, next_lo + 1)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def sample_rows(device_id: str, columns: Dict[str, np.ndarray]) -> List[Dict]:
+    """Records of `by_sample_time` columns, each with its ``sampled_at``."""
+    sampled_at = np.datetime_as_string(columns["sampled_at"].view("datetime64[ns]"), unit="ms")
+    records = to_records(device_id, columns)
+    for record, sampled in zip(records, sampled_at.tolist()):
+        record["sampled_at"] = None if sampled == "NaT" else sampled
+    return records
+
+
+def aggregate_rows(device_id: str, result: Dict[str, np.ndarray]) -> List[Dict]:
+    """Format `aggregate()` output as JSON-friendly rows."""
+    starts = np.datetime_as_string(result["bucket_start"].view("datetime64[ns]"), unit="s")
+
+    def clean(values):
+        return [None if np.isnan(v) else round(float(v), 4) for v in values]
+
+    return [
+        {"device_id": device_id, "bucket_start": start, "count": int(count),
+         "flow_min": fmin, "flow_max": fmax, "flow_mean": fmean,
+         "volume_delta": vdelta}
+        for start, count, fmin, fmax, fmean, vdelta in zip(
+            starts.tolist(), result["count"].tolist(),
+            clean(result["flow_min"]), clean(result["flow_max"]),
+            clean(result["flow_mean"]), clean(result["volume_delta"]))
+    ]
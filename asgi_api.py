@@ -0,0 +1,320 @@
+"""
+ASGI entry point for the device-facing API.
+
+Serves the same `/verify`, `/data` (POST, JSON or binary), `/devices` and
+`/latest` contract as `flask_api.py` on an asyncio event loop:
+
+    uvicorn asgi_api:app --host 0.0.0.0 --port 5000
+
+Each connection is a coroutine rather than a worker thread, so an ESP32
+trickling its batch over weak WiFi costs a few KB of memory and never holds up
+fast clients. Blocking work stays off the event loop: a batch is handed to the
+shared `IngestWriter` and awaited through a ticket callback (no thread is
+parked per request), and file I/O (log refresh, registry reload, checkpoints)
+runs in a small thread pool. Query and analytics endpoints stay on the Flask
+app; both servers share `service.py`.
+"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Optional
+from urllib.parse import parse_qs
+
+import metrics
+import service
+import wire
+from httpcache import CachedResponse, encode_json
+from ingest import SUBMIT_TIMEOUT, IngestTimeout
+
+# Largest accepted request body (a 50-record JSON batch is ~5 KB)
+MAX_BODY_BYTES = 1 << 20
+
+# Threads for blocking storage work
+EXECUTOR_THREADS = 8
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS,
+                              thread_name_prefix="asgi-storage")
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Request:
+    def __init__(self, scope, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.body = body
+        self.args = {k: v[0] for k, v in
+                     parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        headers = dict(scope.get("headers") or [])
+        self.headers = headers
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        self.mimetype = content_type.split(";")[0].strip().lower()
+
+    @property
+    def is_json(self) -> bool:
+        return self.mimetype == "application/json" or self.mimetype.endswith("+json")
+
+    def get_json(self):
+        return json.loads(self.body)
+
+    def header(self, name: bytes) -> Optional[str]:
+        value = self.headers.get(name)
+        return value.decode("latin-1") if value is not None else None
+
+
+class Response:
+    content_type = b"application/json"
+
+    headers = ()
+
+    def __init__(self, body, status: int = 200):
+        self.body = encode_json(body)
+        self.status = status
+
+    async def send(self, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status,
+            "headers": [(b"content-type", self.content_type),
+                        (b"content-length", str(len(self.body)).encode("ascii")),
+                        *self.headers],
+        })
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class MetricsResponse(Response):
+    content_type = metrics.CONTENT_TYPE.encode("ascii")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.status = 200
+
+
+class ConditionalResponse(Response):
+    """Cached body, or 304 when the client's ETag/Last-Modified still match."""
+
+    def __init__(self, cached: CachedResponse, request: Request):
+        self.status = cached.status
+        self.body = cached.body
+        if cached.status == 200:
+            self.headers = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for name, value in cached.headers()]
+        if cached.not_modified(request.header(b"if-none-match"),
+                               request.header(b"if-modified-since")):
+            self.status, self.body = 304, b""
+
+    async def send(self, send):
+        if self.status != 304:
+            await super().send(send)
+            return
+        await send({"type": "http.response.start", "status": 304, "headers": list(self.headers)})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def error(message: str, status: int) -> Response:
+    return Response({"status": "error", "message": message}, status)
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def wait_durable(ticket):
+    """Await an `IngestTicket` without blocking a thread."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle():
+        if not future.done():
+            future.set_result(None)
+
+    def resolved(_ticket):
+        try:
+            loop.call_soon_threadsafe(settle)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    ticket.add_done_callback(resolved)
+    try:
+        await asyncio.wait_for(future, SUBMIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise IngestTimeout("batch was not committed in time")
+    if ticket.error is not None:
+        raise ticket.error
+
+
+# ----------------------------------------------------------------------
+# Handlers
+# ----------------------------------------------------------------------
+async def home(request: Request) -> Response:
+    return Response({
+        "status": "online",
+        "service": "Smart Water Meter API",
+        "version": "1.0",
+        "endpoints": {
+            "verify": "/verify?device_id=<device_id>",
+            "data": "/data?device_id=<device_id> (POST, JSON or application/octet-stream)",
+            "devices": "/devices",
+            "latest": "/latest?device_id=<device_id>",
+            "metrics": "/metrics"
+        }
+    })
+
+
+async def verify(request: Request) -> Response:
+    device_id = request.args.get("device_id")
+
+    if not device_id and request.is_json and request.body:
+        try:
+            data = request.get_json()
+        except ValueError:
+            return error("invalid JSON body", 400)
+        if isinstance(data, dict):
+            device_id = data.get("device_id")
+
+    if not device_id:
+        return error("device_id parameter required", 400)
+
+    # The registry may reload its file: keep that off the event loop
+    device_info = await run_blocking(service.registry.get, device_id)
+    if device_info is None:
+        return error("device not registered", 404)
+    service.liveness.verified(device_id)
+    return Response({
+        "status": "verified",
+        "device_id": device_id,
+        "device_info": device_info
+    })
+
+
+async def receive_data(request: Request) -> Response:
+    try:
+        start = perf_counter()
+        if wire.is_binary(request.mimetype):
+            try:
+                incoming_data = wire.decode_batch(request.body)
+            except ValueError as e:
+                return error(str(e), 400)
+        elif request.is_json:
+            try:
+                incoming_data = request.get_json()
+            except ValueError:
+                return error("invalid JSON body", 400)
+        else:
+            return error("Content-Type must be application/json or application/octet-stream", 415)
+        metrics.PARSE.since(start)
+
+        # Registry lookup (may reload the file) and validation
+        device_id, records, rejected = await run_blocking(
+            service.prepare_batch, incoming_data, request.args.get("device_id"))
+        start = perf_counter()
+        ticket = service.writer.submit(records)
+        await wait_durable(ticket)
+        metrics.COMMIT.since(start)
+        return Response(await run_blocking(
+            service.batch_committed, device_id, records, ticket.stored, rejected))
+
+    except service.BatchError as e:
+        return Response(e.body(), e.status)
+    except IngestTimeout as e:
+        # Not acknowledged: the device keeps its buffer and retries
+        return error(str(e), 503)
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def get_devices(request: Request) -> Response:
+    return ConditionalResponse(await run_blocking(service.cached_devices), request)
+
+
+async def get_latest(request: Request) -> Response:
+    cached = await run_blocking(service.cached_latest, request.args.get("device_id"))
+    return ConditionalResponse(cached, request)
+
+
+async def get_metrics(request: Request) -> Response:
+    return MetricsResponse(await run_blocking(metrics.render))
+
+
+ROUTES = {
+    "/": {"GET": home},
+    "/verify": {"GET": verify, "POST": verify},
+    "/data": {"POST": receive_data},
+    "/devices": {"GET": get_devices},
+    "/latest": {"GET": get_latest},
+    "/metrics": {"GET": get_metrics},
+}
+
+
+# ----------------------------------------------------------------------
+# ASGI plumbing
+# ----------------------------------------------------------------------
+async def read_body(receive) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            service.writer.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Writer stop and checkpoints run from service.shutdown at exit
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    start = perf_counter()
+    methods = ROUTES.get(scope["path"])
+    handler = methods.get(scope["method"]) if methods is not None else None
+    if handler is None:
+        response = error("not found", 404) if methods is None else error("method not allowed", 405)
+        await response.send(send)
+        metrics.observe_request("unmatched", response.status, 0, perf_counter() - start)
+        return
+
+    try:
+        body = await read_body(receive)
+    except BodyTooLarge:
+        response = error(f"request body larger than {MAX_BODY_BYTES} bytes", 413)
+        await response.send(send)
+        metrics.observe_request(handler.__name__, response.status, 0, perf_counter() - start)
+        return
+    except ConnectionError:
+        return
+
+    # Same endpoint names as the Flask views
+    response = await handler(Request(scope, body))
+    await response.send(send)
+    metrics.observe_request(handler.__name__, response.status, len(body), perf_counter() - start)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=5000)
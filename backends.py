@@ -0,0 +1,109 @@
+"""
+Pluggable storage behind `load_data`/`save_data`/`load_devices`/`save_devices`.
+
+A backend pairs a log (records, with the `SegmentLog` listener interface the
+indexes and the writer thread use) with a device registry:
+
+    json    segment log in water_flow_data/ + registered_devices.json
+    sqlite  water_flow_data/water_meter.db (see sqlite_store.py)
+
+`flask_api.py`/`asgi_api.py` (through `service.py`) and `streamlit_app.py`
+pick the backend named by the ``SWM_STORAGE`` environment variable, so
+both sides of a deployment must use the same one. Existing JSON data moves
+to SQLite with ``python sqlite_store.py import``.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BACKENDS = ("json", "sqlite")
+DEFAULT_BACKEND = "json"
+
+
+class StorageBackend:
+    """Records and registered devices of one deployment."""
+
+    name = ""
+
+    def __init__(self, log, registry):
+        self.log = log
+        self.registry = registry
+
+    def load_data(self) -> List[Dict]:
+        """Every stored record in arrival order."""
+        return self.log.read_all()
+
+    def save_data(self, records: List[Dict]) -> int:
+        """Store a batch durably; returns the number of records written."""
+        return self.log.append(records, sync=True)
+
+    def query_data(self, device_id: str, start: Optional[int] = None,
+                   end: Optional[int] = None, limit: int = -1) -> List[Dict]:
+        """Records of one device with ``start <= timestamp < end``."""
+        selected = [record for record in self.log.iter_records()
+                    if record.get("device_id") == device_id
+                    and (start is None or record.get("timestamp", 0) >= start)
+                    and (end is None or record.get("timestamp", 0) < end)]
+        selected.sort(key=lambda record: record.get("timestamp", 0))
+        return selected if limit < 0 else selected[:limit]
+
+    def clear_data(self):
+        self.log.clear()
+
+    def load_devices(self) -> Dict[str, Dict]:
+        return self.registry.load()
+
+    def save_devices(self, devices: Dict[str, Dict]):
+        self.registry.save(devices)
+
+    def close(self):
+        self.log.close()
+
+
+class JsonBackend(StorageBackend):
+    """Segment log plus the registry JSON file."""
+
+    name = "json"
+
+    def __init__(self, data_dir, devices_file, legacy_file=None):
+        from registry import DeviceRegistry
+        from storage import SegmentLog
+
+        # Without a devices file only the log is opened (maintenance scripts)
+        super().__init__(SegmentLog(data_dir, legacy_file=legacy_file),
+                         DeviceRegistry(devices_file) if devices_file is not None else None)
+
+
+class SqliteBackend(StorageBackend):
+    """Readings and devices in one SQLite database."""
+
+    name = "sqlite"
+
+    def __init__(self, path, devices_file=None):
+        from sqlite_store import SqliteDatabase, SqliteLog, SqliteRegistry
+
+        self.database = SqliteDatabase(path)
+        super().__init__(SqliteLog(self.database), SqliteRegistry(self.database))
+        # A new database starts with the devices of the JSON registry
+        if (devices_file is not None and self.registry.version() is None
+                and Path(devices_file).exists()):
+            with open(devices_file) as f:
+                self.registry.save(json.load(f))
+
+    def query_data(self, device_id, start=None, end=None, limit=-1):
+        # Range scan on the (device_id, timestamp) index
+        return self.log.query(device_id, start, end, limit)
+
+
+def open_backend(name: Optional[str], data_dir, devices_file, legacy_file=None) -> StorageBackend:
+    """Open the backend ``name`` (default: ``SWM_STORAGE`` or json)."""
+    name = name or os.environ.get("SWM_STORAGE", DEFAULT_BACKEND)
+    if name == "json":
+        return JsonBackend(data_dir, devices_file, legacy_file)
+    if name == "sqlite":
+        from sqlite_store import DATABASE_NAME
+
+        return SqliteBackend(Path(data_dir) / DATABASE_NAME, devices_file)
+    raise ValueError(f"storage backend must be one of {', '.join(BACKENDS)}")
@@ -0,0 +1,185 @@
+"""
+Connection-scaling load test for the ingest servers.
+
+Opens N "slow" device connections that trickle their `/data` batch over
+--trickle seconds (ESP32 on weak WiFi) and, while they are in flight, sends
+batches from --fast clients with a good link and measures their latency. A
+server that scales with connections keeps the fast clients' latency flat as
+N grows; one that ties a worker to each slow upload does not.
+
+    python benchmarks/asgi_load.py --server asgi --levels 10,100,1000
+    python benchmarks/asgi_load.py --server flask --levels 10,100
+    python benchmarks/asgi_load.py --url http://127.0.0.1:5000   # running server
+
+`--server` starts the server in a temporary directory (asgi needs uvicorn).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent.parent
+DEVICE_ID = "ESP32_WATER_001"
+BATCH_RECORDS = 10
+
+SERVER_COMMANDS = {
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi_api:app",
+             "--host", "127.0.0.1", "--port", "{port}",
+             "--log-level", "warning", "--backlog", "4096"],
+    "flask": [sys.executable, "-c",
+              "import flask_api; flask_api.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+}
+
+
+def batch_body(seq: int) -> bytes:
+    records = [{"timestamp": (seq * BATCH_RECORDS + i) * 60_000,
+                "flow_rate": 1.5, "volume": float(seq * BATCH_RECORDS + i)}
+               for i in range(BATCH_RECORDS)]
+    return json.dumps({"device_id": DEVICE_ID, "data": records}).encode()
+
+
+async def post(host, port, body: bytes, chunks: int = 1, trickle: float = 0.0):
+    """POST /data, sending the body in ``chunks`` pieces over ``trickle`` s."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"POST /data HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode())
+        step = -(-len(body) // chunks)
+        for i in range(0, len(body), step):
+            if i and trickle:
+                await asyncio.sleep(trickle / chunks)
+            writer.write(body[i:i + step])
+            await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, slow: int, fast: int, fast_requests: int,
+                    trickle: float, seq_base: int):
+    latencies = []
+    fast_errors = 0
+
+    async def slow_client(i):
+        try:
+            return await post(host, port, batch_body(seq_base + i), chunks=5, trickle=trickle)
+        except OSError:
+            return None
+
+    async def fast_client(i):
+        nonlocal fast_errors
+        for j in range(fast_requests):
+            start = time.perf_counter()
+            try:
+                status = await post(host, port, batch_body(seq_base + slow + i * fast_requests + j))
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                fast_errors += 1
+
+    start = time.perf_counter()
+    slow_tasks = [asyncio.ensure_future(slow_client(i)) for i in range(slow)]
+    await asyncio.sleep(trickle / 5)  # let the slow uploads get going
+    await asyncio.gather(*(fast_client(i) for i in range(fast)))
+    statuses = await asyncio.gather(*slow_tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "slow_connections": slow,
+        "slow_ok": sum(1 for s in statuses if s == 200),
+        "fast_requests": len(latencies),
+        "fast_errors": fast_errors,
+        "fast_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "fast_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "records_per_s": (slow + len(latencies)) * BATCH_RECORDS / elapsed,
+        "elapsed_s": elapsed,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--server", choices=sorted(SERVER_COMMANDS))
+    target.add_argument("--url")
+    parser.add_argument("--levels", default="10,100,1000",
+                        help="comma separated numbers of slow connections")
+    parser.add_argument("--fast", type=int, default=10)
+    parser.add_argument("--fast-requests", type=int, default=20)
+    parser.add_argument("--trickle", type=float, default=2.0,
+                        help="seconds each slow client takes to send its body")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    process = None
+    workdir = None
+    if args.server:
+        workdir = tempfile.TemporaryDirectory()
+        host, port = "127.0.0.1", free_port()
+        command = [part.format(port=port) for part in SERVER_COMMANDS[args.server]]
+        env = dict(os.environ, PYTHONPATH=str(REPO))
+        process = subprocess.Popen(command, cwd=workdir.name, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(port)
+    else:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+
+    results = []
+    try:
+        seq = 0
+        for level in [int(n) for n in args.levels.split(",")]:
+            results.append(asyncio.run(run_level(
+                host, port, level, args.fast, args.fast_requests, args.trickle, seq)))
+            seq += level + args.fast * args.fast_requests
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            workdir.cleanup()
+
+    result = {"server": args.server or args.url, "trickle_s": args.trickle, "levels": results}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"server: {result['server']}, slow uploads take {args.trickle}s")
+        print(f"{'slow conns':>10} {'slow ok':>8} {'fast p50 ms':>12} "
+              f"{'fast p99 ms':>12} {'fast errors':>12} {'records/s':>10}")
+        for r in results:
+            print(f"{r['slow_connections']:10d} {r['slow_ok']:8d} {r['fast_p50_ms']:12.1f} "
+                  f"{r['fast_p99_ms']:12.1f} {r['fast_errors']:12d} {r['records_per_s']:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Storage size and decode speed: compressed blocks vs JSON.
+
+Generates a synthetic fleet (1-minute samples, 10-record uploads like the
+firmware) and compares
+
+    legacy   the old water_flow_data.json (one JSON array, indent=2)
+    jsonl    the segment log's newline-delimited JSON
+    swmz     compression.encode_segment (delta-of-delta / XOR blocks),
+             decoded to record dicts and to NumPy columns
+
+Usage:
+    python benchmarks/compression_bench.py --devices 20 --days 3 [--json]
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+from itertools import accumulate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import compression  # noqa: E402
+
+
+def synthetic_records(devices: int, days: int, seed: int = 1):
+    rng = random.Random(seed)
+    start = datetime.datetime(2025, 10, 7)
+    volume = [0.0] * devices
+    records = []
+    for minute in range(days * 1440):
+        batch_time = start + datetime.timedelta(minutes=minute - minute % 10 + 10)
+        for d in range(devices):
+            flow = round(rng.choice([0.0, 0.0, 0.0, rng.uniform(0.5, 12.0)]), 2)
+            volume[d] = round(volume[d] + flow / 60, 2)
+            records.append({
+                "timestamp": minute * 60000 + d,
+                "flow_rate": flow,
+                "volume": volume[d],
+                "device_id": f"ESP32_WATER_{d:03d}",
+                "received_at": (batch_time + datetime.timedelta(microseconds=d * 37)).isoformat(),
+            })
+    return records
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+def run(devices: int, days: int):
+    records = synthetic_records(devices, days)
+    n = len(records)
+
+    legacy = json.dumps(records, indent=2).encode("utf-8")
+    lines = [json.dumps(r, separators=(",", ":")).encode("utf-8") + b"\n" for r in records]
+    jsonl = b"".join(lines)
+    encode_s, swmz = timed(lambda: compression.encode_segment(
+        records, list(accumulate(len(line) for line in lines)), len(jsonl)), repeat=1)
+
+    legacy_s, _ = timed(lambda: json.loads(legacy))
+    jsonl_s, _ = timed(lambda: [json.loads(line) for line in jsonl.splitlines()])
+    swmz_s, decoded = timed(lambda: compression.decode_segment(swmz))
+    assert decoded[0] == records, "round trip mismatch"
+    columns_s, _ = timed(lambda: compression.decode_segment_columns(swmz))
+
+    return {
+        "records": n,
+        "devices": devices,
+        "formats": {
+            "legacy": {"bytes_per_record": len(legacy) / n,
+                       "decode_records_per_s": n / legacy_s},
+            "jsonl": {"bytes_per_record": len(jsonl) / n,
+                      "decode_records_per_s": n / jsonl_s},
+            "swmz": {"bytes_per_record": len(swmz) / n,
+                     "decode_records_per_s": n / swmz_s,
+                     "encode_records_per_s": n / encode_s},
+            # Vectorized decode straight to NumPy columns (no dicts)
+            "swmz_columns": {"bytes_per_record": len(swmz) / n,
+                             "decode_records_per_s": n / columns_s},
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    result = run(args.devices, args.days)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{result['records']} records, {result['devices']} devices")
+        print(f"{'format':12} {'bytes/record':>13} {'decode rec/s':>14}")
+        for name, stats in result["formats"].items():
+            print(f"{name:12} {stats['bytes_per_record']:13.1f} "
+                  f"{stats['decode_records_per_s']:14,.0f}")
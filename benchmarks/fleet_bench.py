@@ -0,0 +1,356 @@
+"""
+Synthetic fleet benchmark for the ingest and read paths.
+
+Simulates N meters running the firmware loop from FLOW_DIAGRAM.py on a
+virtual clock: one sample per minute into a 50-slot buffer, an upload of the
+whole buffer every 10 samples, and on a failed upload the data stays in the
+buffer for the next cycle (the oldest samples are dropped once it is full).
+Meters start at random minutes, so about N/10 of them upload per simulated
+minute. Two kinds of failure can be injected: an upload that never reaches the
+server (--fail-rate) and one whose response is lost (--lost-ack-rate), which
+makes the meter resend records the server already stored.
+
+Every --probe-every simulated minutes `/latest` is timed, so its latency can
+be followed as the history grows.
+
+    python benchmarks/fleet_bench.py --meters 100 --minutes 600
+    python benchmarks/fleet_bench.py --server asgi --meters 500 --rate 200
+    python benchmarks/fleet_bench.py --url http://127.0.0.1:5000 --meters 1   # existing devices
+    python benchmarks/fleet_bench.py --json --output results.json
+
+`--server test` (the default) drives `flask_api` in-process through the Flask
+test client; `flask`/`asgi` start a real server, both in a temporary
+directory with the simulated meters registered. With --url the meters must
+already be registered (ids SIM_METER_0001, ...).
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import wire  # noqa: E402
+from asgi_load import SERVER_COMMANDS, free_port, wait_for_port  # noqa: E402
+
+# Firmware constants (FLOW_DIAGRAM.py)
+SAMPLE_INTERVAL_MS = 60_000
+SAMPLES_PER_UPLOAD = 10
+BUFFER_SLOTS = 50
+
+
+def meter_id(i: int) -> str:
+    return f"SIM_METER_{i + 1:04d}"
+
+
+# ----------------------------------------------------------------------
+# Meters
+# ----------------------------------------------------------------------
+class Meter:
+    """One ESP32: samples every minute, uploads every 10 samples."""
+
+    def __init__(self, device_id: str, rng: random.Random):
+        self.device_id = device_id
+        self.rng = rng
+        self.phase = rng.randrange(SAMPLES_PER_UPLOAD)
+        self.millis = rng.randrange(1_000, 30_000)  # time since boot
+        self.volume = 0.0
+        self.flow = 0.0
+        self.buffer: List[Dict] = []
+        self.since_upload = 0
+        self.dropped = 0
+
+    def sample(self):
+        # Mostly idle, with bursts of usage (showers, taps)
+        if self.flow and self.rng.random() < 0.3:
+            self.flow = 0.0
+        elif not self.flow and self.rng.random() < 0.1:
+            self.flow = round(self.rng.uniform(2.0, 12.0), 2)
+        self.volume = round(self.volume + self.flow / 60, 3)
+        self.millis += SAMPLE_INTERVAL_MS
+        if len(self.buffer) == BUFFER_SLOTS:
+            self.buffer.pop(0)
+            self.dropped += 1
+        self.buffer.append({"timestamp": self.millis, "flow_rate": self.flow,
+                            "volume": self.volume})
+        self.since_upload += 1
+
+    def upload_due(self) -> bool:
+        return self.since_upload >= SAMPLES_PER_UPLOAD
+
+    def uploaded(self, count: int):
+        # The firmware clears what it sent; samples taken meanwhile stay
+        del self.buffer[:count]
+
+
+# ----------------------------------------------------------------------
+# Transports
+# ----------------------------------------------------------------------
+class TestClientTransport:
+    """`flask_api` in this process, through the Flask test client."""
+
+    def __init__(self):
+        import flask_api
+
+        self.app = flask_api.app
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                content_type: Optional[str] = None) -> Tuple[int, Optional[Dict]]:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HTTPTransport:
+    """A running server; one keep-alive connection per worker thread."""
+
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, content_type=None):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=30)
+        headers = {"Content-Type": content_type} if content_type else {}
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+
+# ----------------------------------------------------------------------
+# Simulation
+# ----------------------------------------------------------------------
+class Fleet:
+    def __init__(self, transport, args):
+        self.transport = transport
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.meters = [Meter(meter_id(i), random.Random(args.seed + i + 1))
+                       for i in range(args.meters)]
+        self.upload_ms: List[float] = []
+        self.latest_probes: List[Dict] = []
+        self.counts = {"uploads": 0, "records_sent": 0, "records_stored": 0,
+                       "duplicates": 0, "not_sent": 0, "lost_acks": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=args.concurrency)
+
+    def upload(self, meter: Meter, failure: str):
+        records = list(meter.buffer)
+        if failure == "not_sent":
+            with self._lock:
+                self.counts["not_sent"] += 1
+            return
+        path = f"/data?device_id={meter.device_id}"
+        if self.args.binary:
+            body, content_type = wire.encode_batch(records), "application/octet-stream"
+        else:
+            body = json.dumps({"device_id": meter.device_id, "data": records}).encode()
+            content_type = "application/json"
+
+        start = time.perf_counter()
+        try:
+            status, reply = self.transport.request("POST", path, body, content_type)
+        except OSError:
+            status, reply = None, None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.upload_ms.append(elapsed_ms)
+            self.counts["uploads"] += 1
+            self.counts["records_sent"] += len(records)
+            if status != 200:
+                self.counts["errors"] += 1
+                return
+            duplicates = (reply or {}).get("duplicates", 0)
+            self.counts["duplicates"] += duplicates
+            self.counts["records_stored"] += len(records) - duplicates
+            if failure == "lost_ack":
+                # Stored, but the meter never saw the 200 and resends next cycle
+                self.counts["lost_acks"] += 1
+                return
+        meter.uploaded(len(records))
+
+    def probe_latest(self, minute: int, wall_s: float):
+        samples = []
+        for i in range(self.args.probe_requests):
+            device_id = self.meters[i % len(self.meters)].device_id
+            start = time.perf_counter()
+            self.transport.request("GET", f"/latest?device_id={device_id}")
+            samples.append((time.perf_counter() - start) * 1000)
+        samples = np.array(samples)
+        self.latest_probes.append({
+            "minute": minute,
+            "records_stored": self.counts["records_stored"],
+            "p50_ms": float(np.percentile(samples, 50)),
+            "p99_ms": float(np.percentile(samples, 99)),
+            "elapsed_s": wall_s,
+        })
+
+    def failure(self) -> str:
+        roll = self.rng.random()
+        if roll < self.args.fail_rate:
+            return "not_sent"
+        if roll < self.args.fail_rate + self.args.lost_ack_rate:
+            return "lost_ack"
+        return ""
+
+    def run(self) -> Dict:
+        args = self.args
+        started = time.perf_counter()
+        ingest_s = 0.0
+        for minute in range(args.minutes):
+            for meter in self.meters:
+                if minute >= meter.phase:
+                    meter.sample()
+            due = [m for m in self.meters if m.upload_due()]
+            tick = time.perf_counter()
+            futures = []
+            for meter in due:
+                meter.since_upload = 0
+                futures.append(self.pool.submit(self.upload, meter, self.failure()))
+            for future in futures:
+                future.result()
+            ingest_s += time.perf_counter() - tick
+            if args.rate and due:
+                # Pace the ticks to about --rate uploads per second
+                pause = len(due) / args.rate - (time.perf_counter() - tick)
+                if pause > 0:
+                    time.sleep(pause)
+            if (minute + 1) % args.probe_every == 0 or minute + 1 == args.minutes:
+                self.probe_latest(minute + 1, time.perf_counter() - started)
+        self.pool.shutdown()
+
+        upload_ms = np.array(self.upload_ms) if self.upload_ms else np.zeros(1)
+        ingest = dict(self.counts)
+        ingest.update({
+            "samples_dropped": sum(m.dropped for m in self.meters),
+            "ingest_s": ingest_s,
+            "uploads_per_s": self.counts["uploads"] / ingest_s if ingest_s else 0.0,
+            "records_per_s": self.counts["records_sent"] / ingest_s if ingest_s else 0.0,
+            "p50_ms": float(np.percentile(upload_ms, 50)),
+            "p99_ms": float(np.percentile(upload_ms, 99)),
+            "max_ms": float(upload_ms.max()),
+        })
+        return {"ingest": ingest, "latest": self.latest_probes,
+                "elapsed_s": time.perf_counter() - started}
+
+
+def write_registry(directory: Path, meters: int):
+    now = datetime.datetime.now().isoformat()
+    devices = {meter_id(i): {"name": f"Simulated meter {i + 1}", "location": "benchmark",
+                             "registered_at": now}
+               for i in range(meters)}
+    (directory / "registered_devices.json").write_text(json.dumps(devices, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--server", choices=["test"] + sorted(SERVER_COMMANDS), default="test")
+    target.add_argument("--url")
+    parser.add_argument("--meters", type=int, default=100)
+    parser.add_argument("--minutes", type=int, default=600, help="simulated minutes")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="target uploads per second (0 = as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="uploads in flight at once")
+    parser.add_argument("--binary", action="store_true", help="send packed binary batches")
+    parser.add_argument("--fail-rate", type=float, default=0.02)
+    parser.add_argument("--lost-ack-rate", type=float, default=0.01)
+    parser.add_argument("--probe-every", type=int, default=60,
+                        help="simulated minutes between /latest probes")
+    parser.add_argument("--probe-requests", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    process = None
+    workdir = None
+    cwd = os.getcwd()
+    if args.url:
+        url = urlparse(args.url)
+        transport = HTTPTransport(url.hostname, url.port or 80)
+    else:
+        workdir = tempfile.TemporaryDirectory()
+        write_registry(Path(workdir.name), args.meters)
+        if args.server == "test":
+            os.chdir(workdir.name)  # service.py keeps its files in the cwd
+            transport = TestClientTransport()
+        else:
+            port = free_port()
+            command = [part.format(port=port) for part in SERVER_COMMANDS[args.server]]
+            env = dict(os.environ, PYTHONPATH=str(REPO))
+            process = subprocess.Popen(command, cwd=workdir.name, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_port(port)
+            transport = HTTPTransport("127.0.0.1", port)
+
+    try:
+        result = Fleet(transport, args).run()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if args.server == "test" and workdir is not None:
+            import atexit
+            import service
+
+            service.shutdown()
+            atexit.unregister(service.shutdown)
+        os.chdir(cwd)
+        if workdir is not None:
+            workdir.cleanup()
+
+    result["config"] = {name: value for name, value in vars(args).items()
+                        if name not in ("json", "output")}
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    ingest = result["ingest"]
+    print(f"target: {args.url or args.server}, {args.meters} meters, "
+          f"{args.minutes} simulated minutes")
+    print(f"uploads {ingest['uploads']} ({ingest['errors']} errors, {ingest['not_sent']} not sent, "
+          f"{ingest['lost_acks']} lost acks, {ingest['duplicates']} duplicate records)")
+    print(f"ingest: {ingest['records_per_s']:.0f} records/s, {ingest['uploads_per_s']:.0f} uploads/s, "
+          f"p50 {ingest['p50_ms']:.2f} ms, p99 {ingest['p99_ms']:.2f} ms")
+    print(f"{'minute':>7} {'records':>9} {'latest p50 ms':>14} {'latest p99 ms':>14}")
+    for probe in result["latest"]:
+        print(f"{probe['minute']:7d} {probe['records_stored']:9d} "
+              f"{probe['p50_ms']:14.3f} {probe['p99_ms']:14.3f}")
+
+
+if __name__ == "__main__":
+    main()
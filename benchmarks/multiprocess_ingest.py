@@ -0,0 +1,182 @@
+"""
+Multi-worker ingest: throughput per worker count and a no-loss check.
+
+For every --workers level a fresh data directory is created, the writer
+process (`python ingest.py serve`, unless --mode direct) and
+`uvicorn asgi_api:app --workers N` are started, and --clients client
+processes post --batches unique 10-record batches in parallel. Like the
+firmware, a client retries a batch until it gets a 200. Afterwards the
+segment log is read back and compared with what was sent: every record must
+be stored exactly once.
+
+    python benchmarks/multiprocess_ingest.py --workers 1,2,4
+    python benchmarks/multiprocess_ingest.py --workers 4 --mode direct --json
+    python benchmarks/multiprocess_ingest.py --workers 1,4 --storage sqlite
+
+Exits with status 1 if any record was lost or stored twice.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from asgi_load import free_port, post, wait_for_port  # noqa: E402
+from fleet_bench import meter_id, write_registry  # noqa: E402
+from ingest import INGEST_SOCKET_NAME, SocketIngestWriter  # noqa: E402
+from backends import BACKENDS, open_backend  # noqa: E402
+
+BATCH_RECORDS = 10
+MAX_ATTEMPTS = 50
+
+
+def batch(number: int, devices: int):
+    """Batch ``number``: records of one device, unique per (device, timestamp)."""
+    device_id = meter_id(number % devices)
+    seq = number // devices
+    records = [{"timestamp": (seq * BATCH_RECORDS + i) * 60_000, "flow_rate": 1.5,
+                "volume": float(seq * BATCH_RECORDS + i)}
+               for i in range(BATCH_RECORDS)]
+    return device_id, records
+
+
+async def _client(port: int, numbers, devices: int, concurrency: int):
+    latencies, retries, failed = [], 0, 0
+    queue = list(numbers)
+
+    async def worker():
+        nonlocal retries, failed
+        while queue:
+            device_id, records = batch(queue.pop(), devices)
+            body = json.dumps({"device_id": device_id, "data": records}).encode()
+            for attempt in range(MAX_ATTEMPTS):
+                start = time.perf_counter()
+                try:
+                    status = await post("127.0.0.1", port, body)
+                except OSError:
+                    status = None
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                    break
+                retries += 1
+                await asyncio.sleep(0.05)
+            else:
+                failed += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, retries, failed
+
+
+def run_client(port: int, numbers, devices: int, concurrency: int):
+    return asyncio.run(_client(port, numbers, devices, concurrency))
+
+
+def wait_for_socket(path: Path, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if SocketIngestWriter.available(path):
+            return
+        time.sleep(0.1)
+    raise RuntimeError("ingest writer did not start")
+
+
+def run_level(workers: int, args) -> dict:
+    workdir = tempfile.TemporaryDirectory()
+    cwd = Path(workdir.name)
+    write_registry(cwd, args.devices)
+    env = dict(os.environ, PYTHONPATH=str(REPO), SWM_STORAGE=args.storage)
+    processes = []
+    try:
+        if args.mode == "socket":
+            processes.append(subprocess.Popen(
+                [sys.executable, str(REPO / "ingest.py"), "serve"], cwd=cwd, env=env))
+            wait_for_socket(cwd / "water_flow_data" / INGEST_SOCKET_NAME)
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "asgi_api:app", "--host", "127.0.0.1",
+             "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+             "--backlog", "4096"],
+            cwd=cwd, env=env))
+        wait_for_port(port)
+        time.sleep(1.0 + 0.5 * workers)  # let every worker import and start
+
+        shares = [range(i, args.batches, args.clients) for i in range(args.clients)]
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(run_client, [port] * args.clients, shares,
+                                    [args.devices] * args.clients,
+                                    [args.concurrency] * args.clients))
+        elapsed = time.perf_counter() - start
+    finally:
+        # API workers first, so nothing is in flight when the writer stops
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    latencies = np.array([s for r in results for s in r[0]]) * 1000
+    expected = {(device_id, record["timestamp"])
+                for device_id, records in (batch(n, args.devices) for n in range(args.batches))
+                for record in records}
+    backend = open_backend(args.storage, cwd / "water_flow_data", None)
+    stored = [(r["device_id"], r["timestamp"]) for r in backend.load_data()]
+    backend.close()
+    workdir.cleanup()
+    return {
+        "workers": workers,
+        "records_sent": len(expected),
+        "records_stored": len(stored),
+        "lost": len(expected - set(stored)),
+        "stored_twice": len(stored) - len(set(stored)),
+        "failed_batches": sum(r[2] for r in results),
+        "retries": sum(r[1] for r in results),
+        "records_per_s": len(expected) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--mode", choices=["socket", "direct"], default="socket",
+                        help="socket: writer process; direct: every worker writes itself")
+    parser.add_argument("--storage", choices=BACKENDS, default="json")
+    parser.add_argument("--batches", type=int, default=4000)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight per client")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = [run_level(int(n), args) for n in args.workers.split(",")]
+    ok = all(r["lost"] == 0 and r["stored_twice"] == 0 for r in results)
+
+    if args.json:
+        print(json.dumps({"mode": args.mode, "storage": args.storage, "cpus": os.cpu_count(), "ok": ok,
+                          "levels": results}, indent=2))
+    else:
+        print(f"mode: {args.mode}, storage: {args.storage}, {os.cpu_count()} CPUs, {args.batches} batches "
+              f"of {BATCH_RECORDS} records")
+        print(f"{'workers':>7} {'records/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'retries':>8} {'lost':>6} {'twice':>6}")
+        for r in results:
+            print(f"{r['workers']:7d} {r['records_per_s']:10.0f} {r['p50_ms']:8.1f} "
+                  f"{r['p99_ms']:8.1f} {r['retries']:8d} {r['lost']:6d} {r['stored_twice']:6d}")
+        print("OK: every record stored exactly once" if ok else "FAILED: records lost or duplicated")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Storage backends compared: JSON (segment log + registry file) vs SQLite.
+
+For each backend a fresh directory is filled with a synthetic fleet (the
+`compression_bench` generator) and timed on
+
+    ingest      durable 10-record `save_data` calls (one fsync / commit each)
+    load_data   every record back as dicts
+    query       one device, one hour of device timestamps (`query_data`)
+    devices     `load_devices` with --registry devices (cached after the first)
+    open        opening the backend and rebuilding the latest-record index
+    disk        bytes on disk
+
+Usage:
+    python benchmarks/storage_bench.py --devices 20 --days 3 [--json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from backends import BACKENDS, open_backend  # noqa: E402
+from compression_bench import synthetic_records, timed  # noqa: E402
+from indexes import LatestIndex  # noqa: E402
+
+BATCH_RECORDS = 10
+# Records per call when preloading history (not timed)
+PRELOAD_CHUNK = 10_000
+HOUR_MS = 3_600_000
+
+
+def directory_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def run_backend(name: str, records, args) -> dict:
+    workdir = tempfile.TemporaryDirectory()
+    data_dir = Path(workdir.name) / "water_flow_data"
+    devices_file = Path(workdir.name) / "registered_devices.json"
+    now = datetime.datetime.now().isoformat()
+    devices_file.write_text(json.dumps(
+        {f"ESP32_WATER_{d:03d}": {"name": f"Meter {d}", "registered_at": now}
+         for d in range(args.registry)}, indent=2))
+    backend = open_backend(name, data_dir, devices_file)
+
+    # History first, then the timed durable uploads on top
+    timed_records = records[-args.batches * BATCH_RECORDS:]
+    history = records[:len(records) - len(timed_records)]
+    for i in range(0, len(history), PRELOAD_CHUNK):
+        backend.log.append(history[i:i + PRELOAD_CHUNK], sync=True)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(timed_records), BATCH_RECORDS):
+        t = time.perf_counter()
+        backend.save_data(timed_records[i:i + BATCH_RECORDS])
+        latencies.append(time.perf_counter() - t)
+    ingest_s = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+
+    load_s, loaded = timed(backend.load_data)
+    assert len(loaded) == len(records), "records lost"
+
+    rng = random.Random(2)
+    last_ms = records[-1]["timestamp"]
+    windows = [(f"ESP32_WATER_{rng.randrange(args.devices):03d}",
+                rng.randrange(0, max(1, last_ms - HOUR_MS)))
+               for _ in range(args.queries)]
+    query_times = []
+    for device_id, begin in windows:
+        t = time.perf_counter()
+        backend.query_data(device_id, begin, begin + HOUR_MS)
+        query_times.append(time.perf_counter() - t)
+
+    backend.load_devices()
+    devices_s, _ = timed(backend.load_devices, repeat=100)
+    backend.close()
+
+    def reopen():
+        other = open_backend(name, data_dir, devices_file)
+        other.log.subscribe(LatestIndex())
+        other.close()
+
+    open_s, _ = timed(reopen, repeat=1)
+    result = {
+        "ingest_batches_per_s": len(latencies) / ingest_s,
+        "ingest_p50_ms": float(np.percentile(latencies, 50)),
+        "ingest_p99_ms": float(np.percentile(latencies, 99)),
+        "load_data_s": load_s,
+        "query_p50_ms": float(np.percentile(query_times, 50)) * 1000,
+        "load_devices_us": devices_s * 1e6,
+        "open_s": open_s,
+        "disk_bytes": directory_bytes(data_dir),
+    }
+    workdir.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--batches", type=int, default=500, help="timed durable uploads")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--registry", type=int, default=1000, help="registered devices")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    records = synthetic_records(args.devices, args.days)
+    results = {name: run_backend(name, records, args) for name in args.backends.split(",")}
+
+    if args.json:
+        print(json.dumps({"records": len(records), "cpus": os.cpu_count(),
+                          "backends": results}, indent=2))
+        return
+    print(f"{len(records)} records, {args.devices} devices, {args.registry} registered")
+    print(f"{'backend':8} {'ingest b/s':>10} {'p50 ms':>7} {'p99 ms':>7} {'load s':>7} "
+          f"{'query ms':>9} {'devices us':>10} {'open s':>7} {'disk MB':>8}")
+    for name, r in results.items():
+        print(f"{name:8} {r['ingest_batches_per_s']:10.0f} {r['ingest_p50_ms']:7.2f} "
+              f"{r['ingest_p99_ms']:7.2f} {r['load_data_s']:7.2f} {r['query_p50_ms']:9.2f} "
+              f"{r['load_devices_us']:10.1f} {r['open_s']:7.2f} {r['disk_bytes'] / 1e6:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
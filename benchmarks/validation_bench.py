@@ -0,0 +1,84 @@
+"""
+CPU cost of `/data` batch preparation: validation.validate_batch vs the old
+per-record loop (stamp device_id and `datetime.now()` on every row, no checks).
+Both validation paths are also timed on their own, which is where
+`validation.NUMPY_MIN_ROWS` comes from.
+
+Usage:
+    python benchmarks/validation_bench.py [--sizes 10,50,1000] [--json]
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import validation  # noqa: E402
+from validation import validate_batch  # noqa: E402
+
+DEVICE_ID = "ESP32_WATER_001"
+
+
+def make_batch(size: int, seed: int = 1):
+    rng = random.Random(seed)
+    volume = 0.0
+    rows = []
+    for i in range(size):
+        flow = round(rng.uniform(0.0, 12.0), 2)
+        volume = round(volume + flow / 60, 2)
+        rows.append({"timestamp": i * 60_000, "flow_rate": flow, "volume": volume})
+    return rows
+
+
+def legacy_loop(rows):
+    for record in rows:
+        record['device_id'] = DEVICE_ID
+        record['received_at'] = datetime.datetime.now().isoformat()
+    return rows
+
+
+def per_batch_us(func, size: int, repeat: int) -> float:
+    batches = [make_batch(size) for _ in range(repeat)]
+    start = time.perf_counter()
+    for rows in batches:
+        func(rows)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch validation cost")
+    parser.add_argument("--sizes", default="10,50,256,1000")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        repeat = max(20, 200_000 // size)
+        results.append({
+            "batch_size": size,
+            "legacy_loop_us": per_batch_us(legacy_loop, size, repeat),
+            "row_loop_us": per_batch_us(
+                lambda rows: validation._validate_rows(rows, DEVICE_ID, "now"), size, repeat),
+            "numpy_us": per_batch_us(
+                lambda rows: validation._validate_matrix(rows, DEVICE_ID, "now"), size, repeat),
+            "validate_batch_us": per_batch_us(
+                lambda rows: validate_batch(rows, DEVICE_ID), size, repeat),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'batch':>6} {'legacy loop us':>15} {'row loop us':>12} {'numpy us':>9} "
+              f"{'validate us':>12}")
+        for r in results:
+            print(f"{r['batch_size']:6d} {r['legacy_loop_us']:15.1f} {r['row_loop_us']:12.1f} "
+                  f"{r['numpy_us']:9.1f} {r['validate_batch_us']:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,721 @@
+"""
+Columnar time-series store.
+
+Every device gets contiguous NumPy arrays instead of a list of dicts:
+
+    timestamp    int64    device millis() when the sample was taken
+    received_at  int64    server receive time, epoch nanoseconds
+    flow_rate    float32  L/min
+    volume       float32  total L
+
+That is 24 bytes per record. `ColumnStore` is a `SegmentLog` listener, so the
+arrays follow ingest incrementally.
+
+Snapshots are partitioned by device and by day (of `received_at`):
+
+    water_flow_data/shards/<device_id>/<YYYY-MM-DD>-<stamp>.npy
+
+plus `columns.json` naming the current shard of every device-day and the log
+cursor they correspond to. A checkpoint only writes the device-days that
+changed since the previous one (normally today's shard of each active
+device), so its cost follows what was ingested, not the history. On startup
+the shards are memory-mapped, a device is loaded on first use, and only the
+log written after the snapshot is replayed. Retention drops whole day shards.
+
+Only this read side is partitioned. Writes for all devices still go through
+the one segment log and its write lock: the ingest writer commits the
+batches of every device together with one fsync per commit window (a log
+per device would need one per device), and every listener follows a single
+log cursor. Writes for different devices are therefore not independent;
+the shards are derived from the log and rebuilt from it when missing.
+
+Migrate a data directory (and a legacy `water_flow_data.json`) with:
+
+    python columnar.py migrate
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+from indexes import Checkpointed
+from storage import locked_file, write_json_atomic
+from validation import number
+
+COLUMNS = {
+    "timestamp": np.int64,
+    "received_at": np.int64,
+    "flow_rate": np.float32,
+    "volume": np.float32,
+}
+
+MANIFEST_NAME = "columns.json"
+SHARDS_DIR = "shards"
+SHARDS_LOCK_NAME = ".lock"
+SHARDS_VERSION = 2
+
+# One snapshot shard per device and day: <data dir>/shards/<device>/<day>-*.npy
+SHARD_DTYPE = np.dtype([(name, dtype) for name, dtype in COLUMNS.items()])
+DAY_NS = 24 * 3600 * 1_000_000_000
+INITIAL_CAPACITY = 1024
+
+# Write a new snapshot after this many records were applied since the last one
+CHECKPOINT_RECORDS = 100_000
+
+# FrameCache checks the log for new records at most this often (seconds)
+FRAME_REFRESH_INTERVAL = 2.0
+
+NAT = np.iinfo(np.int64).min
+
+
+def to_epoch_ns(values) -> np.ndarray:
+    """Convert ISO-8601 strings (or None) to int64 epoch nanoseconds.
+
+    Values that cannot be parsed become NaT.
+    """
+    try:
+        return np.array(values, dtype="datetime64[ns]").view(np.int64)
+    except (TypeError, ValueError):
+        return np.array([_parse_or_nat(v) for v in values],
+                        dtype="datetime64[ns]").view(np.int64)
+
+
+def parse_epoch_ns(value: str) -> int:
+    """Parse one ISO-8601 time to epoch nanoseconds (ValueError if invalid)."""
+    parsed = np.datetime64(value, "ns")
+    if np.isnat(parsed):
+        raise ValueError(f"invalid time: {value!r}")
+    return int(parsed.astype(np.int64))
+
+
+def _parse_or_nat(value):
+    try:
+        return np.datetime64(value, "ns")
+    except (TypeError, ValueError):
+        return np.datetime64("NaT", "ns")
+
+
+def _int_or_zero(value) -> int:
+    value = number(value)
+    return int(value) if value is not None and -2 ** 63 <= value < 2 ** 63 else 0
+
+
+def _float_or_nan(value) -> float:
+    value = number(value)
+    return np.nan if value is None else float(value)
+
+
+def to_records(device_id: str, columns: Dict[str, np.ndarray]) -> List[Dict]:
+    """Turn column slices back into the record dicts the API returns."""
+    received_at = np.datetime_as_string(
+        columns["received_at"].view("datetime64[ns]"), unit="us")
+    # float32 -> shortest decimal repr, so 2.3 comes back as 2.3
+    flow_rate = columns["flow_rate"].astype(str).astype(np.float64)
+    volume = columns["volume"].astype(str).astype(np.float64)
+    return [
+        {
+            "device_id": device_id,
+            "timestamp": int(ts),
+            "flow_rate": None if np.isnan(fr) else float(fr),
+            "volume": None if np.isnan(vol) else float(vol),
+            "received_at": None if ra == "NaT" else ra,
+        }
+        for ts, fr, vol, ra in zip(columns["timestamp"].tolist(), flow_rate,
+                                   volume, received_at.tolist())
+    ]
+
+
+class DeviceSeries:
+    """Growable column arrays for a single device."""
+
+    def __init__(self, arrays: Optional[Dict[str, np.ndarray]] = None):
+        if arrays is None:
+            arrays = {name: np.empty(INITIAL_CAPACITY, dtype=dtype)
+                      for name, dtype in COLUMNS.items()}
+            self.length = 0
+        else:
+            self.length = len(arrays["timestamp"])
+        self._arrays = arrays
+        received_at = self.column("received_at")
+        # Arrival order is normally time order; remember if it ever is not
+        self.time_sorted = bool(np.all(received_at[1:] >= received_at[:-1]))
+
+    @property
+    def capacity(self) -> int:
+        return len(self._arrays["timestamp"])
+
+    def _grow(self, needed: int):
+        capacity = max(INITIAL_CAPACITY, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+        for name, old in self._arrays.items():
+            # Also turns read-only memory-mapped arrays into writable ones
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.length] = old[:self.length]
+            self._arrays[name] = new
+
+    def extend(self, columns: Dict[str, np.ndarray]):
+        count = len(columns["timestamp"])
+        end = self.length + count
+        if end > self.capacity or not self._arrays["timestamp"].flags.writeable:
+            self._grow(end)
+        received_at = columns["received_at"]
+        if self.time_sorted and count:
+            previous = self._arrays["received_at"][self.length - 1] if self.length else NAT
+            self.time_sorted = bool(received_at[0] >= previous and
+                                    np.all(received_at[1:] >= received_at[:-1]))
+        for name, values in columns.items():
+            self._arrays[name][self.length:end] = values
+        self.length = end
+
+    def column(self, name: str) -> np.ndarray:
+        """View of the filled part of a column (no copy)."""
+        return self._arrays[name][:self.length]
+
+    def bounds(self, start_ns: Optional[int] = None,
+               end_ns: Optional[int] = None):
+        """``(lo, hi)`` with ``start_ns <= received_at < end_ns`` for lo..hi-1.
+
+        Binary search, only valid while ``time_sorted`` holds.
+        """
+        received_at = self.column("received_at")
+        lo = 0 if start_ns is None else int(np.searchsorted(received_at, start_ns, "left"))
+        hi = self.length if end_ns is None else int(np.searchsorted(received_at, end_ns, "left"))
+        return lo, max(lo, hi)
+
+    def time_range(self, start_ns: Optional[int] = None,
+                   end_ns: Optional[int] = None) -> np.ndarray:
+        """Positions with ``start_ns <= received_at < end_ns``.
+
+        Binary search over the time-sorted arrays; falls back to a mask when
+        the server clock ever went backwards.
+        """
+        if self.time_sorted:
+            return np.arange(*self.bounds(start_ns, end_ns))
+        received_at = self.column("received_at")
+        mask = np.ones(self.length, dtype=bool)
+        if start_ns is not None:
+            mask &= received_at >= start_ns
+        if end_ns is not None:
+            mask &= received_at < end_ns
+        return np.flatnonzero(mask)
+
+    def take(self, positions: np.ndarray) -> Dict[str, np.ndarray]:
+        return {name: self.column(name)[positions] for name in COLUMNS}
+
+    def __len__(self):
+        return self.length
+
+
+class ColumnStore(Checkpointed):
+    """Per-device columnar arrays kept in sync with a `SegmentLog`.
+
+    Devices from the snapshot are only loaded (their day shards concatenated)
+    on first access, so a per-device read or write touches that device's
+    shards alone.
+    """
+
+    SNAPSHOT_NAME = MANIFEST_NAME
+    CHECKPOINT_RECORDS = CHECKPOINT_RECORDS
+
+    def __init__(self):
+        super().__init__()
+        self._series: Dict[str, DeviceSeries] = {}
+        # Snapshot shards not loaded yet: device -> day -> memory-mapped rows
+        self._pending: Dict[str, Dict[int, np.ndarray]] = {}
+        # Shard file per device and day, as of the last snapshot
+        self._files: Dict[str, Dict[int, str]] = {}
+        # Days with rows added or removed since the last snapshot
+        self._dirty: Dict[str, set] = {}
+        # Rows before this were trimmed; applied when a device is loaded
+        self._trimmed_before = NAT
+        self._lock = threading.Lock()
+        # Bumped on every change; lets caches tell whether anything is new
+        self.version = 0
+        # Bumped when rows are removed (reset, retention); caches start over
+        self.epoch = 0
+
+    # ------------------------------------------------------------------
+    # Listener interface
+    # ------------------------------------------------------------------
+    def apply(self, records: List[Dict]):
+        by_device: Dict[str, List[Dict]] = {}
+        for record in records:
+            if isinstance(record, dict):
+                by_device.setdefault(record.get("device_id", "unknown"), []).append(record)
+
+        with self._lock:
+            for device_id, rows in by_device.items():
+                # Records written before validation may hold anything: a
+                # non-number becomes 0 (timestamp) or NaN instead of failing
+                columns = {
+                    "timestamp": np.array([_int_or_zero(r.get("timestamp")) for r in rows],
+                                          dtype=np.int64),
+                    "received_at": to_epoch_ns([r.get("received_at") for r in rows]),
+                    "flow_rate": np.array([_float_or_nan(r.get("flow_rate")) for r in rows],
+                                          dtype=np.float32),
+                    "volume": np.array([_float_or_nan(r.get("volume")) for r in rows],
+                                       dtype=np.float32),
+                }
+                series = self._load(device_id)
+                if series is None:
+                    series = self._series[device_id] = DeviceSeries()
+                series.extend(columns)
+                self._dirty.setdefault(device_id, set()).update(
+                    _days(columns["received_at"]))
+            self.applied_since_checkpoint += len(records)
+            self.version += 1
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+            self._pending = {}
+            self._files = {}
+            self._dirty = {}
+            self._trimmed_before = NAT
+            self.applied_since_checkpoint = 0
+            self.version += 1
+            self.epoch += 1
+
+    def trim(self, before_ns: int) -> int:
+        """Drop rows received before ``before_ns`` (retention); returns how many."""
+        removed = 0
+        with self._lock:
+            for device_id, series in list(self._series.items()):
+                received_at = series.column("received_at")
+                if series.time_sorted:
+                    keep = np.arange(series.bounds(before_ns)[0], len(series))
+                else:
+                    keep = np.flatnonzero(received_at >= before_ns)
+                if len(keep) == len(series):
+                    continue
+                removed += len(series) - len(keep)
+                self._dirty.setdefault(device_id, set()).update(
+                    _days(received_at[received_at < before_ns]))
+                if len(keep):
+                    # Copy, so the memory (or snapshot mmap) of old rows is released
+                    self._series[device_id] = DeviceSeries(
+                        {name: np.array(values) for name, values in series.take(keep).items()})
+                else:
+                    del self._series[device_id]
+            # Shards of devices not loaded yet: whole days go now, the rest on load
+            for device_id, days in list(self._pending.items()):
+                for day in [d for d in days if _day_bounds(d)[1] <= before_ns]:
+                    removed += len(days.pop(day))
+                    self._dirty.setdefault(device_id, set()).add(day)
+                if not days:
+                    del self._pending[device_id]
+            self._trimmed_before = max(self._trimmed_before, before_ns)
+            if removed:
+                self.version += 1
+                self.epoch += 1
+        return removed
+
+    def _load(self, device_id: str) -> Optional[DeviceSeries]:
+        """Series of a device, loading its snapshot shards first if needed.
+
+        Caller holds ``self._lock``.
+        """
+        series = self._series.get(device_id)
+        if series is not None or device_id not in self._pending:
+            return series
+        days = self._pending.pop(device_id)
+        parts = [days[day] for day in sorted(days)]
+        arrays = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+        received_at = arrays["received_at"]
+        if self._trimmed_before != NAT and len(received_at) and received_at.min() < self._trimmed_before:
+            expired = received_at < self._trimmed_before
+            self._dirty.setdefault(device_id, set()).update(_days(received_at[expired]))
+            arrays = {name: values[~expired] for name, values in arrays.items()}
+            if not len(arrays["received_at"]):
+                return None
+        series = self._series[device_id] = DeviceSeries(arrays)
+        return series
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def device_ids(self) -> List[str]:
+        loaded = list(self._series)
+        return loaded + [d for d in list(self._pending) if d not in self._series]
+
+    def series(self, device_id: str) -> Optional[DeviceSeries]:
+        series = self._series.get(device_id)
+        if series is None and device_id in self._pending:
+            with self._lock:
+                series = self._load(device_id)
+        return series
+
+    def __len__(self):
+        return (sum(len(series) for series in list(self._series.values()))
+                + sum(len(part) for days in list(self._pending.values())
+                      for part in list(days.values())))
+
+    def window(self, device_id: str, start_ns: Optional[int] = None,
+               end_ns: Optional[int] = None) -> Optional[Dict[str, np.ndarray]]:
+        """Column arrays of one device in ``[start_ns, end_ns)``."""
+        series = self.series(device_id)
+        if series is None:
+            return None
+        if series.time_sorted:
+            lo, hi = series.bounds(start_ns, end_ns)
+            return {name: series.column(name)[lo:hi] for name in COLUMNS}
+        return series.take(series.time_range(start_ns, end_ns))
+
+    def query(self, device_id: str, start_ns: Optional[int] = None,
+              end_ns: Optional[int] = None, limit: int = 1000,
+              after: Optional[tuple] = None):
+        """Records of one device in ``[start_ns, end_ns)``, paginated.
+
+        Pages follow ``received_at`` (arrival order among equal stamps).
+        ``after`` is the key of the previous page, ``(received_at, n)``: the
+        page continues after the first ``n`` rows received at that stamp.
+        Unlike an array position, the key survives `trim` and means the same
+        rows in every worker process; a batch shares its stamp and is only
+        ever trimmed as a whole. Returns ``(records, next_after)``;
+        ``next_after`` is None on the last page.
+        """
+        series = self.series(device_id)
+        if series is None:
+            return [], None
+        if series.time_sorted:
+            lo, hi = series.bounds(start_ns, end_ns)
+            positions = None
+            received_at = series.column("received_at")[lo:hi]
+        else:
+            positions = series.time_range(start_ns, end_ns)
+            positions = positions[np.argsort(series.column("received_at")[positions],
+                                             kind="stable")]
+            received_at = series.column("received_at")[positions]
+
+        first = 0
+        if after is not None:
+            stamp, skip = after
+            first = int(np.searchsorted(received_at, stamp, "left"))
+            # Rows of that stamp trimmed meanwhile: do not skip newer ones
+            first += min(skip, int(np.searchsorted(received_at, stamp, "right")) - first)
+        if positions is None:
+            page = np.arange(lo + first, lo + min(first + limit, len(received_at)))
+        else:
+            page = positions[first:first + limit]
+        records = to_records(device_id, series.take(page))
+        next_after = None
+        if first + limit < len(received_at):
+            last = first + limit - 1
+            stamp = int(received_at[last])
+            next_after = (stamp, last + 1 - int(np.searchsorted(received_at, stamp, "left")))
+        return records, next_after
+
+    def frame(self, device_id: Optional[str] = None) -> pd.DataFrame:
+        """Build a DataFrame; for a single device the columns are not copied."""
+        if device_id is not None:
+            return self._device_frame(device_id, self.series(device_id))
+        frames = [self._device_frame(d, self.series(d)) for d in self.device_ids()]
+        if not frames:
+            return self._device_frame(None, None)
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def _device_frame(device_id, series) -> pd.DataFrame:
+        if series is None:
+            series = DeviceSeries({name: np.empty(0, dtype=dtype)
+                                   for name, dtype in COLUMNS.items()})
+        data = {name: series.column(name) for name in COLUMNS}
+        data["received_at"] = data["received_at"].view("datetime64[ns]")
+        df = pd.DataFrame(data, copy=False)
+        df.insert(0, "device_id", device_id)
+        return df
+
+    # ------------------------------------------------------------------
+    # Snapshots
+    # ------------------------------------------------------------------
+    def _day_rows(self, device_id: str, day: int) -> Optional[Dict[str, np.ndarray]]:
+        """Rows of one device and day from memory; caller holds ``self._lock``."""
+        series = self._series.get(device_id)
+        if series is not None:
+            rows = series.take(series.time_range(*_day_bounds(day)))
+        else:
+            part = self._pending.get(device_id, {}).get(day)
+            if part is None:
+                return None
+            rows = {name: part[name] for name in COLUMNS}
+        return rows if len(rows["timestamp"]) else None
+
+    def _state(self):
+        with self._lock:
+            # Only days that changed are written; copied while ingest is paused
+            changed = {(device_id, day): self._day_rows(device_id, day)
+                       for device_id, days in self._dirty.items() for day in days}
+            self._dirty = {}
+            return {"changed": changed, "source": self._files}
+
+    def _save_snapshot(self, directory: Path, data: Dict):
+        """Write the changed day shards, then the manifest naming all shards."""
+        shards = directory / SHARDS_DIR
+        shards.mkdir(parents=True, exist_ok=True)
+        changed, source = data["changed"], data["source"]
+        files = {device_id: dict(days) for device_id, days in source.items()}
+
+        with locked_file(shards / SHARDS_LOCK_NAME):
+            for (device_id, day), rows in changed.items():
+                days = files.setdefault(device_id, {})
+                if rows is None:
+                    days.pop(day, None)
+                else:
+                    days[day] = _write_shard(shards, device_id, day, rows)
+            # Another process's snapshot may have removed shards this one still uses
+            for device_id, days in files.items():
+                for day, name in list(days.items()):
+                    if (shards / quote(device_id, safe="") / name).exists():
+                        continue
+                    with self._lock:
+                        rows = self._day_rows(device_id, day)
+                    if rows is None:
+                        del days[day]
+                    else:
+                        days[day] = _write_shard(shards, device_id, day, rows)
+            files = {device_id: days for device_id, days in files.items() if days}
+
+            manifest = {"version": SHARDS_VERSION, "log_id": data["log_id"],
+                        "cursor": data["cursor"],
+                        "devices": {device_id: {_day_name(day): name for day, name in days.items()}
+                                    for device_id, days in files.items()}}
+            write_json_atomic(directory / MANIFEST_NAME, manifest)
+            _remove_unreferenced(shards, files)
+
+        # Snapshots written before the shard layout
+        for old in directory.glob("columns-*"):
+            shutil.rmtree(old, ignore_errors=True)
+        with self._lock:
+            if self._files is source:  # not reset meanwhile
+                self._files = files
+
+    def _load_snapshot(self, directory: Path, log_id: str) -> tuple:
+        """Map the latest snapshot's shards; returns its cursor.
+
+        Shards are memory-mapped (one mapping per device and day kept) but
+        only read when their device is first used.
+        """
+        shards = directory / SHARDS_DIR
+        shards.mkdir(parents=True, exist_ok=True)
+        # Held so no other process removes the shards while they are mapped
+        with locked_file(shards / SHARDS_LOCK_NAME):
+            with open(directory / MANIFEST_NAME) as f:
+                manifest = json.load(f)
+            if manifest["log_id"] != log_id:
+                raise ValueError("snapshot belongs to a cleared log")
+            if "generation" in manifest:
+                self._open_generation(directory / manifest["generation"])
+            else:
+                for device_id, days in manifest["devices"].items():
+                    device_dir = shards / quote(device_id, safe="")
+                    for day_name, name in days.items():
+                        day = _parse_day(day_name)
+                        self._pending.setdefault(device_id, {})[day] = np.load(
+                            device_dir / name, mmap_mode="r")
+                        self._files.setdefault(device_id, {})[day] = name
+        return tuple(manifest["cursor"])
+
+    def _open_generation(self, base: Path):
+        """Load a whole-store snapshot from before the shard layout.
+
+        Every day is marked changed, so the next checkpoint writes it as shards.
+        """
+        for entry in base.iterdir():
+            arrays = {name: np.load(entry / f"{name}.npy", mmap_mode="r")
+                      for name in COLUMNS}
+            device_id = unquote(entry.name)
+            self._series[device_id] = DeviceSeries(arrays)
+            self._dirty[device_id] = set(_days(arrays["received_at"]))
+            self.applied_since_checkpoint += len(arrays["received_at"])
+
+
+def _days(received_at: np.ndarray) -> List[int]:
+    """Distinct days (since the epoch) of ``received_at`` values."""
+    return np.unique(received_at // DAY_NS).tolist()
+
+
+def _day_bounds(day: int):
+    """``[start_ns, end_ns)`` of a day, clipped to int64 (NaT falls on the first day)."""
+    limit = np.iinfo(np.int64)
+    return max(day * DAY_NS, int(limit.min)), min((day + 1) * DAY_NS, int(limit.max))
+
+
+def _day_name(day: int) -> str:
+    return str(np.datetime64(day, "D"))
+
+
+def _parse_day(name: str) -> int:
+    return int(np.datetime64(name, "D").astype(np.int64))
+
+
+def _write_shard(shards: Path, device_id: str, day: int, rows: Dict[str, np.ndarray]) -> str:
+    """Write one device-day shard under a new name; returns the file name."""
+    device_dir = shards / quote(device_id, safe="")
+    device_dir.mkdir(exist_ok=True)
+    name = f"{_day_name(day)}-{time.time_ns():x}-{os.getpid()}.npy"
+    table = np.empty(len(rows["timestamp"]), dtype=SHARD_DTYPE)
+    for column in COLUMNS:
+        table[column] = rows[column]
+    np.save(device_dir / name, table)
+    return name
+
+
+def _remove_unreferenced(shards: Path, files: Dict[str, Dict[int, str]]):
+    """Delete shard files and device directories the manifest no longer uses.
+
+    Processes that mapped a deleted shard keep reading it (POSIX unlink).
+    """
+    for device_dir in shards.iterdir():
+        if not device_dir.is_dir():
+            continue
+        keep = set(files.get(unquote(device_dir.name), {}).values())
+        for path in device_dir.iterdir():
+            if path.name not in keep:
+                path.unlink(missing_ok=True)
+        if not keep:
+            try:
+                device_dir.rmdir()
+            except OSError:
+                pass
+
+
+def migrate(data_dir, legacy_file=None) -> Dict[str, int]:
+    """Build the shard layout for a data directory; returns rows per device.
+
+    A legacy single-file store (`water_flow_data.json`) is imported into the
+    log first if the log is still empty.
+    """
+    from rollups import RollupTables
+    from storage import SegmentLog
+
+    store = SegmentLog(data_dir, legacy_file=legacy_file)
+    columns = ColumnStore.open(store, data_dir)
+    rollups = RollupTables.open(store, data_dir)
+    columns.checkpoint(store, data_dir)
+    rollups.checkpoint(store, data_dir)
+    store.close()
+    return {device_id: len(columns.series(device_id)) for device_id in sorted(columns.device_ids())}
+
+
+class FrameCache:
+    """Process-wide, already-typed DataFrame over a `ColumnStore`.
+
+    The combined rows are kept in ``received_at`` order in growable column
+    arrays and keyed on the column store version: when nothing changed the
+    frame is returned as is, and after an ingest only the rows added since
+    the last call are appended to the arrays (amortised O(new rows)); the
+    returned frame is a view over them, not a copy. The log itself is
+    checked at most every ``refresh_interval`` seconds, so quick reruns do
+    no I/O at all.
+    """
+
+    def __init__(self, store, columns: ColumnStore,
+                 refresh_interval: float = FRAME_REFRESH_INTERVAL):
+        self.store = store
+        self.columns = columns
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._rows = self._empty_rows()
+        self._frame = ColumnStore._device_frame(None, None)
+        self._version = -1
+        self._epoch = columns.epoch
+        self._lengths: Dict[str, int] = {}
+        self._last_refresh = 0.0
+
+    @staticmethod
+    def _empty_rows() -> DeviceSeries:
+        arrays = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        arrays["device_id"] = np.empty(0, dtype=object)
+        return DeviceSeries(arrays)
+
+    def refresh(self):
+        """Pull new records from the log unless that was done very recently."""
+        now = time.monotonic()
+        if now - self._last_refresh >= self.refresh_interval:
+            self._last_refresh = now
+            self.store.refresh()
+
+    def get(self, device_id: Optional[str] = None) -> pd.DataFrame:
+        """Frame sorted by ``received_at`` (ascending), optionally one device."""
+        self.refresh()
+        if device_id is not None:
+            frame = self.columns.frame(device_id)
+            series = self.columns.series(device_id)
+            if series is not None and not series.time_sorted:
+                frame = frame.sort_values("received_at", kind="stable")
+            return frame
+
+        with self._lock:
+            if self._version != self.columns.version:
+                self._update()
+            return self._frame
+
+    def _update(self):
+        version = self.columns.version
+        new_parts = []
+        rebuild = False
+        for device_id in self.columns.device_ids():
+            series = self.columns.series(device_id)
+            done = self._lengths.get(device_id, 0)
+            if len(series) < done:
+                rebuild = True
+                break
+            if len(series) > done:
+                part = {name: series.column(name)[done:] for name in COLUMNS}
+                part["device_id"] = np.full(len(series) - done, device_id, dtype=object)
+                new_parts.append(part)
+                self._lengths[device_id] = len(series)
+        if (rebuild or self._epoch != self.columns.epoch
+                or set(self._lengths) - set(self.columns.device_ids())):
+            # The log was cleared or old rows were dropped: start over
+            self._epoch = self.columns.epoch
+            self._lengths = {}
+            self._rows = self._empty_rows()
+            self._frame = ColumnStore._device_frame(None, None)
+            self._version = -1
+            self._update()
+            return
+
+        if new_parts:
+            new_rows = {name: np.concatenate([part[name] for part in new_parts])
+                        for name in new_parts[0]}
+            order = np.argsort(new_rows["received_at"], kind="stable")
+            self._rows.extend({name: values[order] for name, values in new_rows.items()})
+            if not self._rows.time_sorted:
+                # Server clock went backwards: sort everything once
+                rows = self._rows
+                order = np.argsort(rows.column("received_at"), kind="stable")
+                self._rows = DeviceSeries({name: rows.column(name)[order]
+                                           for name in rows._arrays})
+            self._frame = self._view()
+        self._version = version
+
+    def _view(self) -> pd.DataFrame:
+        rows = self._rows
+        data = {"device_id": pd.Series(rows.column("device_id"), dtype=object, copy=False)}
+        data.update((name, rows.column(name)) for name in COLUMNS)
+        data["received_at"] = data["received_at"].view("datetime64[ns]")
+        return pd.DataFrame(data, copy=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Column store snapshot maintenance")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--data-dir", default="water_flow_data")
+    parser.add_argument("--legacy-file", default="water_flow_data.json")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        for device_id, rows in migrate(args.data_dir, Path(args.legacy_file)).items():
+            print(f"{device_id}: {rows} rows")
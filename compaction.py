@@ -0,0 +1,263 @@
+"""
+Retention and compaction of the segment log.
+
+`Compactor` runs in a background thread next to the ingest writer and, every
+COMPACT_INTERVAL seconds and whenever the log seals a segment:
+
+1. Compresses sealed `.jsonl` segments to `.swmz`, so the append that
+   filled a segment does not wait for the encoding.
+2. Expires raw samples older than the retention window. Whole sealed
+   segments whose newest `received_at` is past the window are removed, after
+   the hourly/daily rollups were checkpointed past them, so the history
+   stays available as rollups (`/rollups`) once the raw rows are gone.
+3. Drops the same rows from the in-memory column store, so memory and query
+   time stay bounded too.
+4. Merges runs of small compressed segments into one larger file with
+   per-device (sorted) blocks, fewer files to open and better compression.
+
+Segment files are decoded and encoded without holding the log's write lock;
+only the final rename/unlink does, so ingest is never blocked for longer than
+a few file operations. Disk work is guarded by `<data dir>/.compact.lock`, so
+only one process compacts at a time; every process trims its own memory.
+
+Run once by hand with:
+
+    python compaction.py run [--retention-days 30]
+"""
+
+import argparse
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import compression
+from columnar import to_epoch_ns
+from liveness import now_ns
+from storage import COMPRESSED_SUFFIX, SegmentLog
+
+try:
+    import fcntl
+except ImportError:  # Windows: compaction is only coordinated in-process
+    fcntl = None
+
+DAY_NS = 24 * 3600 * 1_000_000_000
+
+# Raw samples are kept this long; older data only lives on in the rollups.
+# The servers read SWM_RETENTION_DAYS instead when it is set
+RAW_RETENTION_DAYS = 30
+
+# Seconds between compaction runs
+COMPACT_INTERVAL = 600.0
+
+# Compressed segments smaller than this are merged, up to this size per file
+COMPACT_TARGET_BYTES = 4 * 1024 * 1024
+
+COMPACT_LOCK_NAME = ".compact.lock"
+
+
+def newest_received_ns(path: Path) -> int:
+    """Latest `received_at` (epoch ns) in a segment file."""
+    if path.suffix == COMPRESSED_SUFFIX:
+        columns, _, _ = compression.decode_segment_columns(path.read_bytes())
+        received_at = columns["received_at"]
+    else:
+        with open(path, "rb") as f:
+            received_at = to_epoch_ns([json.loads(line).get("received_at")
+                                       for line in f if line.endswith(b"\n")])
+    return int(received_at.max()) if len(received_at) else np.iinfo(np.int64).min
+
+
+class Compactor:
+    """Background retention/compaction job for one `SegmentLog`."""
+
+    def __init__(self, store: SegmentLog, directory, rollups=None, columns=None,
+                 retention_days: float = RAW_RETENTION_DAYS,
+                 interval: float = COMPACT_INTERVAL,
+                 target_bytes: int = COMPACT_TARGET_BYTES):
+        self.store = store
+        self.directory = Path(directory)
+        self.rollups = rollups
+        self.columns = columns
+        self.retention_days = retention_days
+        self.interval = interval
+        self.target_bytes = target_bytes
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._run_lock = threading.Lock()
+        self.last_run: Dict = {}
+        if isinstance(store, SegmentLog):
+            store.on_sealed = self.wake
+
+    # ------------------------------------------------------------------
+    # Thread
+    # ------------------------------------------------------------------
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._wake.clear()
+            self._thread = threading.Thread(target=self._loop, name="compactor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self, *_):
+        """Run the next pass now (a segment was sealed)."""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:  # keep the job alive; the next run retries
+                self.last_run = {"error": str(e)}
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # ------------------------------------------------------------------
+    # One pass
+    # ------------------------------------------------------------------
+    def cutoff_ns(self) -> int:
+        # received_at is naive server-local time, so the cutoff is too
+        return now_ns() - int(self.retention_days * DAY_NS)
+
+    def run_once(self) -> Dict:
+        """Expire, trim and merge once; returns what was done."""
+        with self._run_lock:
+            cutoff = self.cutoff_ns()
+            result = {"compressed_files": 0, "expired_files": 0, "merged_files": 0,
+                      "trimmed_rows": 0}
+            with _DirectoryLock(self.directory / COMPACT_LOCK_NAME) as locked:
+                if locked and hasattr(self.store, "expire_received_before"):
+                    # SQLite backend: rows instead of files, nothing to merge
+                    result["expired_rows"] = self._expire_rows(cutoff)
+                elif locked:
+                    try:
+                        result["compressed_files"] = self.store.compress_sealed_segments()
+                        result["expired_files"] = self._expire(cutoff)
+                        result["merged_files"] = self._merge()
+                    except FileNotFoundError:
+                        # A segment was compressed or the log cleared meanwhile;
+                        # the next run sees the new files
+                        pass
+            if self.columns is not None:
+                result["trimmed_rows"] = self.columns.trim(cutoff)
+            result["finished_at"] = time.time()
+            self.last_run = result
+            return result
+
+    def _expire_rows(self, cutoff_ns: int) -> int:
+        if self.rollups is not None:
+            self.store.refresh()
+            self.rollups.checkpoint(self.store, self.directory)
+        return self.store.expire_received_before(cutoff_ns)
+
+    def _expire(self, cutoff_ns: int) -> int:
+        through = None
+        # Files are in arrival order, so stop at the first one still in the window
+        for path in self.store.sealed_segments():
+            if newest_received_ns(path) >= cutoff_ns:
+                break
+            through = path
+        if through is None:
+            return 0
+        if self.rollups is not None:
+            # The rollups must cover the raw rows before they are removed
+            self.store.refresh()
+            self.rollups.checkpoint(self.store, self.directory)
+        return self.store.expire(through)
+
+    def _merge(self) -> int:
+        merged = 0
+        for group in self._merge_groups():
+            if self.store.merge(group) is not None:
+                merged += len(group)
+        return merged
+
+    def _merge_groups(self) -> List[List[Path]]:
+        """Runs of consecutive small `.swmz` files, each up to target_bytes."""
+        groups, current, size = [], [], 0
+        for path in self.store.sealed_segments():
+            file_size = path.stat().st_size
+            small = path.suffix == COMPRESSED_SUFFIX and file_size < self.target_bytes
+            if not small or size + file_size > self.target_bytes:
+                if len(current) > 1:
+                    groups.append(current)
+                current, size = [], 0
+            if small:
+                current.append(path)
+                size += file_size
+        if len(current) > 1:
+            groups.append(current)
+        return groups
+
+
+class _DirectoryLock:
+    """Non-blocking exclusive lock file; yields whether it was acquired."""
+
+    _local = threading.Lock()
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+        self._held = False
+
+    def __enter__(self) -> bool:
+        if not self._local.acquire(blocking=False):
+            return False
+        self._held = True
+        if fcntl is None:
+            return True
+        self._file = open(self.path, "a")
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._release()
+            return False
+        return True
+
+    def _release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._held:
+            self._held = False
+            self._local.release()
+
+    def __exit__(self, *exc):
+        self._release()
+
+
+def run(data_dir, retention_days: Optional[float] = None) -> Dict:
+    """One compaction pass over a data directory (rollups loaded and kept)."""
+    from backends import open_backend
+    from rollups import RollupTables
+
+    store = open_backend(None, data_dir, None).log
+    rollups = RollupTables.open(store, data_dir)
+    compactor = Compactor(store, data_dir, rollups=rollups,
+                          retention_days=RAW_RETENTION_DAYS if retention_days is None
+                          else retention_days)
+    result = compactor.run_once()
+    rollups.checkpoint(store, data_dir)
+    store.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Segment log retention and compaction")
+    parser.add_argument("command", choices=["run"])
+    parser.add_argument("--data-dir", default="water_flow_data")
+    parser.add_argument("--retention-days", type=float, default=RAW_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print(json.dumps(run(args.data_dir, args.retention_days), indent=2))
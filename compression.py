@@ -0,0 +1,360 @@
+"""
+Delta / Gorilla-style compression for stored flow series.
+
+A block holds one device's columns:
+
+    timestamp    delta-of-delta, zigzag, narrowest int width, zlib
+    received_at  same, in microseconds when no precision is lost
+    flow_rate    float32 bits XOR-ed with the previous value, zlib
+    volume       delta of the float32 bit patterns (small and positive for a
+                 monotonic counter), zigzag, zlib
+
+All streams are byte aligned, so decoding is a handful of vectorized NumPy
+calls (`cumsum`, `bitwise_xor.accumulate`) instead of a per-value bit reader.
+
+`encode_segments()` packs one or more consecutive sealed log segments: one
+block per device plus the row order and, per row, its source segment and
+original line offset, so cursors into the old `.jsonl` files stay valid after
+they are replaced by a `.swmz` file. Segments are only compressed when every
+record round-trips exactly; anything else stays JSON.
+"""
+
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"SWMZ"
+VERSION = 2
+
+RECORD_KEYS = frozenset({"device_id", "timestamp", "flow_rate", "volume", "received_at"})
+
+_UINT_WIDTHS = (np.uint8, np.uint16, np.uint32, np.uint64)
+_U32 = struct.Struct("<I")
+_HEADER = struct.Struct("<4sBIHH")  # magic, version, rows, devices, source segments
+_SOURCE = struct.Struct("<IQ")  # segment number, original size
+_HEADER_V1 = struct.Struct("<4sBIQH")  # magic, version, rows, original size, devices
+
+
+# ----------------------------------------------------------------------
+# Integer streams
+# ----------------------------------------------------------------------
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.uint64)
+    return ((values >> np.uint64(1)).view(np.int64)
+            ^ -(values & np.uint64(1)).view(np.int64))
+
+
+def _pack_uints(values: np.ndarray) -> bytes:
+    top = int(values.max()) if len(values) else 0
+    for code, dtype in enumerate(_UINT_WIDTHS):
+        if top <= np.iinfo(dtype).max:
+            break
+    payload = zlib.compress(values.astype(dtype).tobytes(), 6)
+    return bytes([code]) + _U32.pack(len(payload)) + payload
+
+
+def _unpack_uints(data: memoryview, pos: int) -> Tuple[np.ndarray, int]:
+    dtype = _UINT_WIDTHS[data[pos]]
+    (length,) = _U32.unpack_from(data, pos + 1)
+    start = pos + 1 + _U32.size
+    raw = zlib.decompress(data[start:start + length])
+    return np.frombuffer(raw, dtype=dtype).astype(np.uint64), start + length
+
+
+def _delta_of_delta(values: np.ndarray) -> np.ndarray:
+    delta = np.diff(values, prepend=np.int64(0))
+    return np.diff(delta, prepend=np.int64(0))
+
+
+def _undo_delta_of_delta(dod: np.ndarray) -> np.ndarray:
+    return np.cumsum(np.cumsum(dod))
+
+
+# ----------------------------------------------------------------------
+# Column blocks
+# ----------------------------------------------------------------------
+def encode_columns(columns: Dict[str, np.ndarray]) -> bytes:
+    """Compress one device's timestamp/received_at/flow_rate/volume arrays."""
+    timestamp = columns["timestamp"].astype(np.int64)
+    received_at = columns["received_at"].astype(np.int64)
+    micros = bool(np.all(received_at % 1000 == 0))
+    if micros:
+        received_at = received_at // 1000
+
+    flow_bits = columns["flow_rate"].astype(np.float32).view(np.uint32)
+    flow_xor = flow_bits ^ np.concatenate(([np.uint32(0)], flow_bits[:-1]))
+
+    volume_bits = columns["volume"].astype(np.float32).view(np.uint32).astype(np.int64)
+    volume_delta = np.diff(volume_bits, prepend=np.int64(0))
+
+    return b"".join([
+        bytes([1 if micros else 0]),
+        _pack_uints(_zigzag(_delta_of_delta(timestamp))),
+        _pack_uints(_zigzag(_delta_of_delta(received_at))),
+        _pack_uints(flow_xor.astype(np.uint64)),
+        _pack_uints(_zigzag(volume_delta)),
+    ])
+
+
+def decode_columns(data, pos: int = 0) -> Tuple[Dict[str, np.ndarray], int]:
+    """Inverse of `encode_columns`; returns the columns and the end position."""
+    data = memoryview(data)
+    micros = data[pos] == 1
+    pos += 1
+    ts_dod, pos = _unpack_uints(data, pos)
+    ra_dod, pos = _unpack_uints(data, pos)
+    flow_xor, pos = _unpack_uints(data, pos)
+    volume_delta, pos = _unpack_uints(data, pos)
+
+    received_at = _undo_delta_of_delta(_unzigzag(ra_dod))
+    if micros:
+        received_at = received_at * 1000
+    flow_bits = np.bitwise_xor.accumulate(flow_xor.astype(np.uint32))
+    volume_bits = np.cumsum(_unzigzag(volume_delta)).astype(np.uint32)
+    return {
+        "timestamp": _undo_delta_of_delta(_unzigzag(ts_dod)),
+        "received_at": received_at,
+        "flow_rate": flow_bits.view(np.float32),
+        "volume": volume_bits.view(np.float32),
+    }, pos
+
+
+# ----------------------------------------------------------------------
+# Segments
+# ----------------------------------------------------------------------
+def _exact_float32(values: List) -> Optional[np.ndarray]:
+    """float32 array if every value survives float32 storage unchanged."""
+    as64 = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    as32 = as64.astype(np.float32)
+    back = as32.astype(str).astype(np.float64)
+    same = (back == as64) | (np.isnan(back) & np.isnan(as64))
+    return as32 if bool(np.all(same)) else None
+
+
+def encode_segment(records: List[Dict], line_ends: List[int],
+                   original_size: int, number: int = 0) -> Optional[bytes]:
+    """Compress one sealed segment, or return None if it would not round-trip."""
+    return encode_segments([(number, records, line_ends, original_size)])
+
+
+def encode_segments(parts: List[Tuple[int, List[Dict], List[int], int]]) -> Optional[bytes]:
+    """Compress consecutive segments into one file.
+
+    ``parts`` holds ``(number, records, line_ends, original_size)`` per
+    segment, in log order. Rows are stored in per-device blocks, and every
+    row keeps its source segment and line offset, so a cursor into any of
+    the original segments can still be resolved. Returns None if any record
+    would not round-trip exactly.
+    """
+    records = [record for _, part, _, _ in parts for record in part]
+    for record in records:
+        if record.keys() != RECORD_KEYS:
+            return None
+        timestamp = record["timestamp"]
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            return None
+        if not isinstance(record["received_at"], str) or not isinstance(record["device_id"], str):
+            return None
+        for key in ("flow_rate", "volume"):
+            value = record[key]
+            if value is not None and (isinstance(value, bool)
+                                      or not isinstance(value, (int, float))):
+                return None
+    if not records:
+        return None
+
+    try:
+        received_at = np.array([r["received_at"] for r in records], dtype="datetime64[ns]")
+    except ValueError:
+        return None
+    # Only ISO strings that format back identically are stored as numbers
+    if [_format_received_at(v) for v in received_at.view(np.int64)] != \
+            [r["received_at"] for r in records]:
+        return None
+    flow_rate = _exact_float32([r["flow_rate"] for r in records])
+    volume = _exact_float32([r["volume"] for r in records])
+    if flow_rate is None or volume is None:
+        return None
+    try:
+        timestamp = np.array([r["timestamp"] for r in records], dtype=np.int64)
+    except OverflowError:
+        return None
+
+    columns = {
+        "timestamp": timestamp,
+        "received_at": received_at.view(np.int64),
+        "flow_rate": flow_rate,
+        "volume": volume,
+    }
+    row_source = np.repeat(np.arange(len(parts), dtype=np.uint64),
+                           [len(part) for _, part, _, _ in parts])
+    line_lengths = np.concatenate([
+        np.diff(np.array(line_ends, dtype=np.int64), prepend=np.int64(0))
+        for _, _, line_ends, _ in parts
+    ])
+    return _pack(columns, [r["device_id"] for r in records], row_source, line_lengths,
+                 [(number, original_size) for number, _, _, original_size in parts])
+
+
+def merge_segments(files: List[bytes]) -> Optional[bytes]:
+    """Combine compressed files of consecutive segments into one file.
+
+    Works on the decoded columns directly; rows keep their log order and
+    their source positions.
+    """
+    decoded = [_decode(data, 0) for data in files]
+    columns = {name: np.concatenate([d[0][name] for d in decoded])
+               for name in ("timestamp", "received_at", "flow_rate", "volume")}
+    device_ids = np.concatenate([d[0]["device_id"] for d in decoded])
+    sources = [source for d in decoded for source in d[2]]
+    numbers = np.concatenate([d[1][0] for d in decoded])
+    line_ends = np.concatenate([d[1][1] for d in decoded])
+
+    index = {number: i for i, (number, _) in enumerate(sources)}
+    row_source = np.array([index[n] for n in numbers.tolist()], dtype=np.uint64)
+    starts = np.concatenate(([True], numbers[1:] != numbers[:-1]))
+    previous = np.concatenate(([0], line_ends[:-1]))
+    line_lengths = line_ends - np.where(starts, 0, previous)
+    return _pack(columns, device_ids.tolist(), row_source, line_lengths, sources)
+
+
+def _pack(columns: Dict[str, np.ndarray], row_device_ids: List[str],
+          row_source: np.ndarray, line_lengths: np.ndarray,
+          sources: List[Tuple[int, int]]) -> Optional[bytes]:
+    device_ids = list(dict.fromkeys(row_device_ids))
+    if len(device_ids) > np.iinfo(np.uint16).max or len(sources) > np.iinfo(np.uint16).max:
+        return None
+    device_index = {d: i for i, d in enumerate(device_ids)}
+    row_device = np.array([device_index[d] for d in row_device_ids], dtype=np.uint64)
+
+    out = [_HEADER.pack(MAGIC, VERSION, len(row_device), len(device_ids), len(sources))]
+    for number, original_size in sources:
+        out.append(_SOURCE.pack(number, original_size))
+    for device_id in device_ids:
+        encoded = device_id.encode("utf-8")
+        out.append(struct.pack("<H", len(encoded)) + encoded)
+    out.append(_pack_uints(row_device))
+    out.append(_pack_uints(row_source.astype(np.uint64)))
+    out.append(_pack_uints(line_lengths.astype(np.uint64)))
+    # Rows grouped by device (stable, so each block stays in log order)
+    order = np.argsort(row_device, kind="stable")
+    bounds = np.cumsum(np.bincount(row_device.astype(np.intp), minlength=len(device_ids)))
+    grouped = {name: values[order] for name, values in columns.items()}
+    lo = 0
+    for hi in bounds.tolist():
+        out.append(encode_columns({name: values[lo:hi] for name, values in grouped.items()}))
+        lo = hi
+    return b"".join(out)
+
+
+def read_sources(path, number: int = 0) -> List[Tuple[int, int]]:
+    """``(segment number, original size)`` of each segment packed in a file.
+
+    ``number`` is used for version 1 files, which only held one segment and
+    did not record its number.
+    """
+    with open(path, "rb") as f:
+        head = f.read(max(_HEADER.size, _HEADER_V1.size))
+        if head[:4] != MAGIC or len(head) < _HEADER.size:
+            raise ValueError(f"{path} is not a compressed segment")
+        if head[4] == 1:
+            return [(number, _HEADER_V1.unpack_from(head)[3])]
+        source_count = _HEADER.unpack_from(head)[4]
+        f.seek(_HEADER.size)
+        table = f.read(_SOURCE.size * source_count)
+    return [_SOURCE.unpack_from(table, i * _SOURCE.size) for i in range(source_count)]
+
+
+def _decode(data, number: int):
+    data = memoryview(data)
+    magic, version = bytes(data[:4]), data[4]
+    if magic != MAGIC or version not in (1, VERSION):
+        raise ValueError("unsupported compressed segment")
+    if version == 1:
+        _, _, rows, original_size, device_count = _HEADER_V1.unpack_from(data, 0)
+        sources = [(number, original_size)]
+        pos = _HEADER_V1.size
+    else:
+        _, _, rows, device_count, source_count = _HEADER.unpack_from(data, 0)
+        pos = _HEADER.size
+        sources = [_SOURCE.unpack_from(data, pos + i * _SOURCE.size)
+                   for i in range(source_count)]
+        pos += _SOURCE.size * source_count
+
+    device_ids = []
+    for _ in range(device_count):
+        (length,) = struct.unpack_from("<H", data, pos)
+        device_ids.append(bytes(data[pos + 2:pos + 2 + length]).decode("utf-8"))
+        pos += 2 + length
+    row_device, pos = _unpack_uints(data, pos)
+    if version == 1:
+        row_source = np.zeros(rows, dtype=np.uint64)
+    else:
+        row_source, pos = _unpack_uints(data, pos)
+    line_lengths, pos = _unpack_uints(data, pos)
+
+    # Line offsets restart at 0 in every source segment
+    lengths = line_lengths.astype(np.int64)
+    ends = np.cumsum(lengths)
+    starts = np.flatnonzero(np.concatenate(([True], row_source[1:] != row_source[:-1])))
+    base = np.repeat(ends[starts] - lengths[starts], np.diff(np.append(starts, rows)))
+    numbers = np.array([n for n, _ in sources], dtype=np.int64)
+    positions = (numbers[row_source.astype(np.intp)], ends - base)
+
+    blocks = []
+    for _ in range(device_count):
+        columns, pos = decode_columns(data, pos)
+        blocks.append(columns)
+    # Blocks are per device in device order; scatter them back to log order
+    order = np.argsort(row_device, kind="stable")
+    merged = {}
+    for name, dtype in (("timestamp", np.int64), ("received_at", np.int64),
+                        ("flow_rate", np.float32), ("volume", np.float32)):
+        merged[name] = np.empty(rows, dtype=dtype)
+        if blocks:
+            merged[name][order] = np.concatenate([block[name] for block in blocks])
+    merged["device_id"] = np.array(device_ids, dtype=object)[row_device.astype(np.intp)]
+    return merged, positions, sources
+
+
+def decode_segment_columns(data, number: int = 0):
+    """Vectorized decode of a compressed file into row-ordered columns.
+
+    Returns ``(columns, positions, sources)``: ``columns`` also holds a
+    ``device_id`` object array, ``positions`` is ``(segment_numbers,
+    line_ends)`` per row and ``sources`` lists ``(number, original_size)``.
+    """
+    return _decode(data, number)
+
+
+def decode_segment(data, number: int = 0):
+    """Like `decode_segment_columns` but with record dicts in log order."""
+    merged, positions, sources = _decode(data, number)
+    flow_rate = merged["flow_rate"].astype(str).astype(np.float64)
+    volume = merged["volume"].astype(str).astype(np.float64)
+    records = [
+        {
+            "timestamp": ts,
+            "flow_rate": None if fr != fr else fr,
+            "volume": None if vol != vol else vol,
+            "device_id": device_id,
+            "received_at": _format_received_at(ra),
+        }
+        for ts, fr, vol, device_id, ra in zip(
+            merged["timestamp"].tolist(), flow_rate.tolist(), volume.tolist(),
+            merged["device_id"].tolist(), merged["received_at"].tolist())
+    ]
+    return records, positions, sources
+
+
+def _format_received_at(ns: int) -> str:
+    """Same text `datetime.isoformat()` produced when the record was stored."""
+    text = str(np.datetime64(int(ns), "ns").astype("datetime64[us]"))
+    return text[:-7] if text.endswith(".000000") else text
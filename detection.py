@@ -0,0 +1,202 @@
+"""
+Streaming leak and anomaly detection.
+
+`LeakDetector` is a `SegmentLog` listener: every batch is checked as it is
+appended (or tailed from another process), against a few numbers kept per
+device, never against the history. Rules:
+
+    night_flow       flow never dropped below LEAK_MIN_FLOW during the night
+                     window (NIGHT_START_HOUR..NIGHT_END_HOUR, server time)
+                     for at least NIGHT_MIN_SAMPLES samples
+    continuous_flow  CONTINUOUS_FLOW_SAMPLES consecutive samples with flow
+                     (around the clock)
+    volume_jump      the volume rose by more than VOLUME_JUMP_MIN_L per
+                     minute and more than Z_THRESHOLD standard deviations
+                     above the device's EWMA of per-minute volume deltas
+
+Each rule fires once per episode (night, run of flow, sample). Alerts are
+kept newest-last, up to ALERTS_MAX, and saved with the per-device state to
+`alerts.json` together with the log cursor (`indexes.Checkpointed`).
+"""
+
+import math
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from columnar import to_epoch_ns
+from indexes import Checkpointed
+from validation import number
+
+HOUR_NS = 3600 * 1_000_000_000
+DAY_NS = 24 * HOUR_NS
+MINUTE_MS = 60_000
+
+# Night window (hours of received_at, server local time)
+NIGHT_START_HOUR = 0
+NIGHT_END_HOUR = 5
+NIGHT_MIN_SAMPLES = 120
+
+# Flow (L/min) that counts as "water is running"
+LEAK_MIN_FLOW = 0.05
+CONTINUOUS_FLOW_SAMPLES = 180
+
+# EWMA of per-minute volume deltas and the z-score that flags a jump
+EWMA_ALPHA = 0.02
+WARMUP_SAMPLES = 30
+Z_THRESHOLD = 6.0
+VOLUME_JUMP_MIN_L = 20.0
+
+ALERTS_NAME = "alerts.json"
+ALERTS_MAX = 10_000
+
+# Save after this many records were applied since the last save
+CHECKPOINT_RECORDS = 10_000
+
+ALERT_TYPES = ("night_flow", "continuous_flow", "volume_jump")
+
+
+class _DeviceState:
+    """Rolling detection state of one device (fixed size)."""
+
+    __slots__ = ("timestamp", "volume", "mean", "var", "count", "run",
+                 "night", "night_min", "night_samples", "night_alerted")
+
+    def __init__(self, values=None):
+        (self.timestamp, self.volume, self.mean, self.var, self.count, self.run,
+         self.night, self.night_min, self.night_samples, self.night_alerted) = (
+            values or (None, None, 0.0, 0.0, 0, 0, None, 0.0, 0, False))
+
+    def values(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class LeakDetector(Checkpointed):
+    """Per-device leak/anomaly rules evaluated on every appended batch."""
+
+    SNAPSHOT_NAME = ALERTS_NAME
+    CHECKPOINT_RECORDS = CHECKPOINT_RECORDS
+
+    def __init__(self):
+        super().__init__()
+        self._devices: Dict[str, _DeviceState] = {}
+        self._alerts = deque(maxlen=ALERTS_MAX)
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Listener interface
+    # ------------------------------------------------------------------
+    def apply(self, records: List[Dict]):
+        received = to_epoch_ns([r.get("received_at") for r in records]).tolist()
+        with self._lock:
+            for record, received_ns in zip(records, received):
+                self._apply_one(record, received_ns)
+            self.applied_since_checkpoint += len(records)
+
+    def _apply_one(self, record: Dict, received_ns: int):
+        flow = number(record.get("flow_rate"))
+        volume = number(record.get("volume"))
+        timestamp = number(record.get("timestamp"))
+        if flow is None or volume is None or timestamp is None or received_ns < 0:
+            return
+        device_id = record.get("device_id", "unknown")
+        state = self._devices.get(device_id)
+        if state is None:
+            state = self._devices[device_id] = _DeviceState()
+
+        # Continuous flow
+        state.run = state.run + 1 if flow > LEAK_MIN_FLOW else 0
+        if state.run == CONTINUOUS_FLOW_SAMPLES:
+            self._alert(record, "continuous_flow", flow,
+                        f"flow above {LEAK_MIN_FLOW} L/min for {state.run} consecutive samples")
+
+        # Minimum flow over the night window
+        hour = received_ns % DAY_NS // HOUR_NS
+        if NIGHT_START_HOUR <= hour < NIGHT_END_HOUR:
+            night = received_ns // DAY_NS
+            if state.night != night:
+                state.night, state.night_min = night, flow
+                state.night_samples, state.night_alerted = 0, False
+            state.night_min = min(state.night_min, flow)
+            state.night_samples += 1
+            if (not state.night_alerted and state.night_samples >= NIGHT_MIN_SAMPLES
+                    and state.night_min > LEAK_MIN_FLOW):
+                state.night_alerted = True
+                self._alert(record, "night_flow", state.night_min,
+                            f"night flow never dropped below {state.night_min:.2f} L/min "
+                            f"over {state.night_samples} samples")
+        elif state.night is not None:
+            state.night = None
+
+        # Volume jumps against the EWMA of per-minute deltas
+        if state.volume is not None and timestamp > state.timestamp and volume >= state.volume:
+            minutes = max(1.0, (timestamp - state.timestamp) / MINUTE_MS)
+            delta = (volume - state.volume) / minutes
+            deviation = delta - state.mean
+            z = deviation / math.sqrt(state.var) if state.var > 0 else math.inf
+            if (state.count >= WARMUP_SAMPLES and delta > VOLUME_JUMP_MIN_L
+                    and z > Z_THRESHOLD):
+                self._alert(record, "volume_jump", round(delta, 3),
+                            f"volume rose {delta:.1f} L/min, {z:.1f} sd above normal")
+            else:
+                # Jumps are kept out of the baseline
+                increment = EWMA_ALPHA * deviation
+                state.mean += increment
+                state.var = (1 - EWMA_ALPHA) * (state.var + deviation * increment)
+                state.count += 1
+        state.timestamp, state.volume = timestamp, volume
+
+    def _alert(self, record: Dict, kind: str, value: float, message: str):
+        self._alerts.append({
+            "device_id": record.get("device_id", "unknown"),
+            "type": kind,
+            "received_at": record.get("received_at"),
+            "timestamp": record.get("timestamp"),
+            "value": value,
+            "message": message,
+        })
+
+    def reset(self):
+        with self._lock:
+            self._devices = {}
+            self._alerts = deque(maxlen=ALERTS_MAX)
+            self.applied_since_checkpoint = 0
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def alerts(self, device_id: Optional[str] = None, kind: Optional[str] = None,
+               since_ns: Optional[int] = None, limit: int = 100) -> List[Dict]:
+        """Alerts, newest first, optionally filtered."""
+        with self._lock:
+            alerts = list(self._alerts)
+        selected = []
+        for alert in reversed(alerts):
+            if device_id is not None and alert["device_id"] != device_id:
+                continue
+            if kind is not None and alert["type"] != kind:
+                continue
+            if since_ns is not None:
+                received = to_epoch_ns([alert["received_at"]])[0]
+                if received < since_ns:
+                    break  # older from here on
+            selected.append(alert)
+            if len(selected) >= limit:
+                break
+        return selected
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def _state(self):
+        with self._lock:
+            return {
+                "devices": {d: state.values() for d, state in self._devices.items()},
+                "alerts": list(self._alerts),
+            }
+
+    def _load_state(self, data):
+        devices = {d: _DeviceState(values) for d, values in data["devices"].items()}
+        with self._lock:
+            self._devices = devices
+            self._alerts = deque(data["alerts"], maxlen=ALERTS_MAX)
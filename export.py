@@ -0,0 +1,106 @@
+"""
+Streaming export of stored records.
+
+`iter_csv()` and `iter_parquet()` walk the column store device by device in
+chunks of EXPORT_CHUNK_ROWS, so an export never holds more than one chunk of
+formatted output in memory no matter how much history is selected. Parquet
+export needs `pyarrow` and writes one row group per chunk.
+"""
+
+import importlib.util
+import io
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+from columnar import COLUMNS, ColumnStore
+
+EXPORT_CHUNK_ROWS = 50_000
+
+EXPORT_COLUMNS = ["device_id", "timestamp", "flow_rate", "volume", "received_at"]
+
+
+def iter_frames(columns: ColumnStore, device_ids: Optional[Iterable[str]] = None,
+                start_ns: Optional[int] = None, end_ns: Optional[int] = None,
+                chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Yield DataFrame chunks of the selected devices and time window."""
+    if device_ids is None:
+        device_ids = sorted(columns.device_ids())
+    for device_id in device_ids:
+        window = columns.window(device_id, start_ns, end_ns)
+        if window is None:
+            continue
+        total = len(window["timestamp"])
+        for lo in range(0, total, chunk_rows):
+            part = {name: window[name][lo:lo + chunk_rows] for name in COLUMNS}
+            part["received_at"] = part["received_at"].view("datetime64[ns]")
+            frame = pd.DataFrame(part, copy=False)
+            frame.insert(0, "device_id", device_id)
+            yield frame[EXPORT_COLUMNS]
+
+
+def iter_csv(columns: ColumnStore, device_ids: Optional[Iterable[str]] = None,
+             start_ns: Optional[int] = None, end_ns: Optional[int] = None,
+             chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    """Yield the export as CSV, one chunk at a time (header first)."""
+    yield (",".join(EXPORT_COLUMNS) + "\n").encode("utf-8")
+    for frame in iter_frames(columns, device_ids, start_ns, end_ns, chunk_rows):
+        yield frame.to_csv(index=False, header=False,
+                           date_format="%Y-%m-%dT%H:%M:%S.%f").encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are drained after each row group."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def iter_parquet(columns: ColumnStore, device_ids: Optional[Iterable[str]] = None,
+                 start_ns: Optional[int] = None, end_ns: Optional[int] = None,
+                 chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    """Yield a Parquet file, one row group per chunk (requires pyarrow)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("device_id", pa.string()),
+        ("timestamp", pa.int64()),
+        ("flow_rate", pa.float32()),
+        ("volume", pa.float32()),
+        ("received_at", pa.timestamp("ns")),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for frame in iter_frames(columns, device_ids, start_ns, end_ns, chunk_rows):
+            table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+            writer.write_table(table, row_group_size=chunk_rows)
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
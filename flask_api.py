@@ -1,42 +1,42 @@
 # API Server untuk ESP32 Smart Water Meter
 # Versi alternatif menggunakan Flask (lebih cocok untuk REST API)
 
-from flask import Flask, request, jsonify
-import json
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import datetime
-from pathlib import Path
+import time
 
-app = Flask(__name__)
-
-DATA_FILE = Path("water_flow_data.json")
-DEVICES_FILE = Path("registered_devices.json")
-
-def init_files():
-    if not DATA_FILE.exists():
-        DATA_FILE.write_text(json.dumps([]))
-    if not DEVICES_FILE.exists():
-        devices = {
-            "ESP32_WATER_001": {
-                "name": "Water Meter 001",
-                "location": "Main Building",
-                "registered_at": datetime.datetime.now().isoformat()
-            }
-        }
-        DEVICES_FILE.write_text(json.dumps(devices, indent=2))
+import analytics
+import export
+import metrics
+import wire
+from columnar import parse_epoch_ns
+from detection import ALERT_TYPES
+from ingest import IngestTimeout
+from liveness import now_ns
+from rollups import PERIODS
+from service import (  # noqa: F401  (re-exported for scripts using flask_api)
+    DATA_DIR, DATA_FILE, DEVICES_FILE, BatchError, backend, batch_committed, cached_devices,
+    cached_latest, columns, compactor, detector, latest_index, liveness, load_data,
+    load_devices, prepare_batch, refresh_store, registry, response_cache, rollups, save_data,
+    store, writer,
+)
 
-init_files()
+app = Flask(__name__)
 
-def load_data():
-    with open(DATA_FILE, 'r') as f:
-        return json.load(f)
+QUERY_DEFAULT_LIMIT = 1000
+QUERY_MAX_LIMIT = 10000
 
-def load_devices():
-    with open(DEVICES_FILE, 'r') as f:
-        return json.load(f)
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses (/export) are timed up to the first byte
+    metrics.observe_request(request.endpoint or "unmatched", response.status_code,
+                            request.content_length,
+                            time.perf_counter() - g.request_start)
+    return response
 
 @app.route('/')
 def home():
@@ -46,7 +46,16 @@ def home():
         "version": "1.0",
         "endpoints": {
             "verify": "/verify?device_id=<device_id>",
-            "data": "/data?device_id=<device_id> (POST)"
+            "data": "/data?device_id=<device_id> (POST, JSON or application/octet-stream)",
+            "query": "/data?device_id=<device_id>&from=<iso>&to=<iso>&limit=<n>&cursor=<cursor> (GET)",
+            "aggregate": "/aggregate?device_id=<device_id>&bucket=1m|15m|1h|1d&from=<iso>&to=<iso>",
+            "downsample": "/downsample?device_id=<device_id>&points=<n>&from=<iso>&to=<iso>",
+            "rollups": "/rollups?period=hourly|daily&device_id=<device_id>&from=<iso>&to=<iso>",
+            "export": "/export?format=csv|parquet&device_id=<device_id>&from=<iso>&to=<iso>",
+            "alerts": "/alerts?device_id=<device_id>&type=night_flow|continuous_flow|volume_jump&from=<iso>&limit=<n>",
+            "stats": "/stats",
+            "liveness": "/liveness?device_id=<device_id>",
+            "metrics": "/metrics"
         }
     })
 
@@ -66,13 +75,14 @@ def verify():
             "message": "device_id parameter required"
         }), 400
     
-    devices = load_devices()
+    device_info = registry.get(device_id)
     
-    if device_id in devices:
+    if device_info is not None:
+        liveness.verified(device_id)
         return jsonify({
             "status": "verified",
             "device_id": device_id,
-            "device_info": devices[device_id]
+            "device_info": device_info
         }), 200
     else:
         return jsonify({
@@ -86,80 +96,291 @@ def receive_data():
     device_id = request.args.get('device_id')
     
     try:
-        incoming_data = request.get_json()
-        
-        # Check if it's wrapped format: {"device_id": "...", "data": [...]}
-        if isinstance(incoming_data, dict) and 'device_id' in incoming_data and 'data' in incoming_data:
-            # New format with wrapper
-            device_id = incoming_data['device_id']  # Override from JSON body
-            data_array = incoming_data['data']
-        elif isinstance(incoming_data, list):
-            # Old format: direct array
-            data_array = incoming_data
+        start = time.perf_counter()
+        if wire.is_binary(request.mimetype):
+            # Packed struct Data[] dari firmware (12 byte per record)
+            try:
+                incoming_data = wire.decode_batch(request.get_data())
+            except ValueError as e:
+                return jsonify({
+                    "status": "error",
+                    "message": str(e)
+                }), 400
         else:
-            return jsonify({
-                "status": "error",
-                "message": "data must be a JSON array or object with device_id and data fields"
-            }), 400
-        
-        if not device_id:
-            return jsonify({
-                "status": "error",
-                "message": "device_id required (in query param or JSON body)"
-            }), 400
+            incoming_data = request.get_json()
+        metrics.PARSE.since(start)
         
-        devices = load_devices()
-        if device_id not in devices:
-            return jsonify({
-                "status": "error",
-                "message": "device not registered"
-            }), 404
+        device_id, records, rejected = prepare_batch(incoming_data, device_id)
         
-        # Load existing data
-        all_data = load_data()
-        
-        # Add metadata
-        for record in data_array:
-            record['device_id'] = device_id
-            record['received_at'] = datetime.datetime.now().isoformat()
-            all_data.append(record)
-        
-        # Save
-        save_data(all_data)
+        # Save (append only the new batch)
+        stored = save_data(records)
+        return jsonify(batch_committed(device_id, records, stored, rejected)), 200
         
+    except BatchError as e:
+        return jsonify(e.body()), e.status
+    except IngestTimeout as e:
+        # Not acknowledged: the device keeps its buffer and retries
         return jsonify({
-            "status": "success",
-            "message": f"Received {len(data_array)} data points",
-            "device_id": device_id
-        }), 200
-        
+            "status": "error",
+            "message": str(e)
+        }), 503
     except Exception as e:
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
+def parse_time_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return parse_epoch_ns(value)
+
+def window_args():
+    """Parse device_id/from/to; returns (device_id, start_ns, end_ns) or an error response"""
+    device_id = request.args.get('device_id')
+    if not device_id:
+        return None, (jsonify({
+            "status": "error",
+            "message": "device_id parameter required"
+        }), 400)
+    try:
+        start_ns = parse_time_arg('from')
+        end_ns = parse_time_arg('to')
+    except ValueError:
+        return None, (jsonify({
+            "status": "error",
+            "message": "from/to must be ISO 8601 times"
+        }), 400)
+    return (device_id, start_ns, end_ns), None
+
+@app.route('/data', methods=['GET'])
+def query_data():
+    args, error = window_args()
+    if error:
+        return error
+    device_id, start_ns, end_ns = args
+    
+    try:
+        limit = int(request.args.get('limit', QUERY_DEFAULT_LIMIT))
+        cursor = request.args.get('cursor')
+        # "<received_at ns>:<rows of that stamp already returned>"
+        after = tuple(int(part) for part in cursor.split(':')) if cursor else None
+        if after is not None and (len(after) != 2 or after[1] < 0):
+            raise ValueError(cursor)
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "limit must be an integer and cursor a next_cursor value"
+        }), 400
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
+    
+    refresh_store()
+    records, next_after = columns.query(device_id, start_ns, end_ns, limit, after)
+    return jsonify({
+        "status": "success",
+        "device_id": device_id,
+        "count": len(records),
+        "data": records,
+        "next_cursor": None if next_after is None else f"{next_after[0]}:{next_after[1]}"
+    }), 200
+
+@app.route('/aggregate', methods=['GET'])
+def get_aggregate():
+    args, error = window_args()
+    if error:
+        return error
+    device_id, start_ns, end_ns = args
+    
+    bucket = request.args.get('bucket', '1h')
+    if bucket not in analytics.BUCKETS:
+        return jsonify({
+            "status": "error",
+            "message": f"bucket must be one of {', '.join(analytics.BUCKETS)}"
+        }), 400
+    
+    refresh_store()
+    window = columns.window(device_id, start_ns, end_ns)
+    if window is None:
+        return jsonify({"status": "error", "message": "no data found"}), 404
+    result = analytics.aggregate(window, analytics.BUCKETS[bucket])
+    return jsonify({
+        "status": "success",
+        "device_id": device_id,
+        "bucket": bucket,
+        "data": analytics.aggregate_rows(device_id, result)
+    }), 200
+
+@app.route('/downsample', methods=['GET'])
+def get_downsample():
+    args, error = window_args()
+    if error:
+        return error
+    device_id, start_ns, end_ns = args
+    
+    try:
+        points = int(request.args.get('points', analytics.CHART_MAX_POINTS))
+    except ValueError:
+        return jsonify({"status": "error", "message": "points must be an integer"}), 400
+    points = max(3, min(points, QUERY_MAX_LIMIT))
+    
+    refresh_store()
+    window = columns.window(device_id, start_ns, end_ns)
+    if window is None:
+        return jsonify({"status": "error", "message": "no data found"}), 404
+    window = analytics.by_sample_time(window)
+    selected = analytics.lttb(window["sampled_at"], window["flow_rate"], points)
+    picked = {name: values[selected] for name, values in window.items()}
+    return jsonify({
+        "status": "success",
+        "device_id": device_id,
+        "count": len(selected),
+        "data": analytics.sample_rows(device_id, picked)
+    }), 200
+
+@app.route('/rollups', methods=['GET'])
+def get_rollups():
+    period = request.args.get('period', 'daily')
+    if period not in PERIODS:
+        return jsonify({
+            "status": "error",
+            "message": f"period must be one of {', '.join(PERIODS)}"
+        }), 400
+    try:
+        start_ns = parse_time_arg('from')
+        end_ns = parse_time_arg('to')
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "from/to must be ISO 8601 times"
+        }), 400
+    
+    refresh_store()
+    rows = rollups.rows(period, request.args.get('device_id'), start_ns, end_ns)
+    return jsonify({
+        "status": "success",
+        "period": period,
+        "data": rows
+    }), 200
+
+@app.route('/export', methods=['GET'])
+def export_data():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'parquet'):
+        return jsonify({
+            "status": "error",
+            "message": "format must be csv or parquet"
+        }), 400
+    if fmt == 'parquet' and not export.parquet_available():
+        return jsonify({
+            "status": "error",
+            "message": "parquet export requires pyarrow"
+        }), 501
+    try:
+        start_ns = parse_time_arg('from')
+        end_ns = parse_time_arg('to')
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "from/to must be ISO 8601 times"
+        }), 400
+    
+    device_id = request.args.get('device_id')
+    refresh_store()
+    device_ids = [device_id] if device_id else None
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    
+    if fmt == 'csv':
+        chunks = export.iter_csv(columns, device_ids, start_ns, end_ns)
+        mimetype = 'text/csv'
+    else:
+        chunks = export.iter_parquet(columns, device_ids, start_ns, end_ns)
+        mimetype = 'application/vnd.apache.parquet'
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=water_flow_data_{stamp}.{fmt}"}
+    )
+
+@app.route('/alerts', methods=['GET'])
+def get_alerts():
+    kind = request.args.get('type')
+    if kind is not None and kind not in ALERT_TYPES:
+        return jsonify({
+            "status": "error",
+            "message": f"type must be one of {', '.join(ALERT_TYPES)}"
+        }), 400
+    try:
+        start_ns = parse_time_arg('from')
+        limit = int(request.args.get('limit', QUERY_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "from must be an ISO 8601 time and limit an integer"
+        }), 400
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
+    
+    refresh_store()
+    alerts = detector.alerts(request.args.get('device_id'), kind, start_ns, limit)
+    return jsonify({
+        "status": "success",
+        "count": len(alerts),
+        "data": alerts
+    }), 200
+
+@app.route('/liveness', methods=['GET'])
+def get_liveness():
+    device_id = request.args.get('device_id')
+    refresh_store()
+    
+    if device_id:
+        status = liveness.status(device_id)
+        if status:
+            return jsonify(status), 200
+        return jsonify({"status": "error", "message": "device never seen"}), 404
+    
+    at_ns = now_ns()
+    overdue = liveness.overdue(at_ns)
+    seen = liveness.device_ids()
+    never_seen = sorted(set(load_devices()) - set(seen))
+    return jsonify({
+        "status": "success",
+        "devices_seen": len(seen),
+        "active": liveness.active_count(at_ns),
+        "overdue": overdue,
+        "never_seen": never_seen
+    }), 200
+
+def conditional_response(cached):
+    """Cached body, or 304 when the client's ETag/Last-Modified still match"""
+    headers = cached.headers() if cached.status == 200 else []
+    if cached.not_modified(request.headers.get('If-None-Match'),
+                           request.headers.get('If-Modified-Since')):
+        return Response(status=304, headers=headers)
+    return Response(cached.body, status=cached.status,
+                    mimetype='application/json', headers=headers)
+
 @app.route('/devices', methods=['GET'])
 def get_devices():
-    devices = load_devices()
-    return jsonify(devices), 200
+    return conditional_response(cached_devices())
 
 @app.route('/latest', methods=['GET'])
 def get_latest():
-    device_id = request.args.get('device_id')
-    all_data = load_data()
-    
-    if device_id:
-        device_data = [d for d in all_data if d.get('device_id') == device_id]
-        if device_data:
-            return jsonify(device_data[-1]), 200
-        else:
-            return jsonify({"status": "error", "message": "no data found"}), 404
-    else:
-        if all_data:
-            return jsonify(all_data[-1]), 200
-        else:
-            return jsonify({"status": "error", "message": "no data available"}), 404
+    return conditional_response(cached_latest(request.args.get('device_id')))
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        "storage": backend.name,
+        "registry_cache": registry.stats(),
+        "response_cache": response_cache.stats(),
+        "recovered_bytes": store.recovered_bytes,
+        "compaction": compactor.last_run
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,110 @@
+"""
+Encoded responses for polled read endpoints, with conditional GET.
+
+`/devices` and `/latest` are polled every few seconds by dashboards and
+scripts. `ResponseCache` keeps the encoded JSON body per request, tagged
+with the version it was built from (`SegmentLog.version` for data, the
+registry file signature for devices); while the version is unchanged a poll
+is a dict lookup and returns the same bytes. Any ingest or registry edit
+moves the version, so the next poll rebuilds.
+
+The ETag is a hash of the body, not of the version: every worker process
+builds the same bytes from the same records, so clients get 304s no matter
+which worker answers, and `/latest?device_id=...` keeps its ETag while other
+devices ingest.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# Distinct requests kept (device ids are client supplied)
+CACHE_MAX_ENTRIES = 1024
+
+
+def encode_json(payload) -> bytes:
+    """Same encoding as Flask's jsonify (sorted keys, compact)."""
+    return (json.dumps(payload, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def http_date(epoch_seconds: float) -> str:
+    return formatdate(epoch_seconds, usegmt=True)
+
+
+class CachedResponse:
+    """An encoded JSON response with its validators."""
+
+    __slots__ = ("body", "status", "etag", "last_modified", "_modified")
+
+    def __init__(self, payload, status: int = 200, modified: Optional[float] = None):
+        self.body = encode_json(payload)
+        self.status = status
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=8).hexdigest() + '"'
+        self._modified = int(modified) if modified is not None else None
+        self.last_modified = http_date(self._modified) if modified is not None else None
+
+    def headers(self) -> List[Tuple[str, str]]:
+        headers = [("ETag", self.etag), ("Cache-Control", "no-cache")]
+        if self.last_modified:
+            headers.append(("Last-Modified", self.last_modified))
+        return headers
+
+    def not_modified(self, if_none_match: Optional[str],
+                     if_modified_since: Optional[str]) -> bool:
+        """Evaluate the request's validators (RFC 9110 13.2.2)."""
+        if self.status != 200:
+            return False
+        if if_none_match:
+            # If-None-Match takes precedence; weak comparison
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return any(t == "*" or t.removeprefix("W/") == self.etag for t in tags)
+        if if_modified_since and self._modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return self._modified <= since
+        return False
+
+
+class ResponseCache:
+    """Cached responses keyed by request, valid while their version is current."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, CachedResponse]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: Hashable,
+            build: Callable[[], CachedResponse]) -> CachedResponse:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Built outside the lock; concurrent misses just build twice
+        response = build()
+        with self._lock:
+            self._entries[key] = (version, response)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
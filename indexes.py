@@ -0,0 +1,244 @@
+"""
+In-memory indexes maintained from the segment log.
+
+Each index is a `SegmentLog` listener: it is rebuilt from storage when it
+subscribes and then updated incrementally with every appended batch, so reads
+never have to scan the history. `Checkpointed` listeners also save their
+state with the log cursor it reflects and, through ``open``, resume from it,
+so a restart only replays the log written since the last snapshot.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from storage import write_json_atomic
+
+# Recent sample timestamps remembered per device for duplicate detection.
+# The firmware buffer holds 50 records, so a retry is always within range.
+RECENT_KEYS_PER_DEVICE = 256
+
+LATEST_NAME = "latest.json"
+RECENT_KEYS_NAME = "recent_keys.json"
+
+# Save a snapshot after this many records were applied since the last one
+CHECKPOINT_RECORDS = 10_000
+
+
+class Checkpointed:
+    """Snapshot support for a log listener.
+
+    A snapshot is the listener's state together with the log id and the
+    cursor it reflects; ``open`` loads it and subscribes from that cursor.
+    Subclasses set ``SNAPSHOT_NAME``, return their state as a dict from
+    ``_state()`` (called while the log is held; it is saved after the hold
+    ends, so it must not share containers that ``apply`` changes) and load
+    it back in ``_load_state()``. Listeners whose snapshot is more than one
+    JSON file override ``_save_snapshot``/``_load_snapshot`` as well.
+    """
+
+    SNAPSHOT_NAME = ""
+    # Save after this many records were applied since the last snapshot
+    CHECKPOINT_RECORDS = CHECKPOINT_RECORDS
+
+    def __init__(self):
+        self._checkpoint_lock = threading.Lock()
+        self.applied_since_checkpoint = 0
+
+    def _state(self) -> Dict:
+        raise NotImplementedError
+
+    def _load_state(self, data: Dict):
+        raise NotImplementedError
+
+    def checkpoint(self, store, directory):
+        """Save the state together with the log cursor it reflects."""
+        with self._checkpoint_lock:
+            self._write_checkpoint(store, directory)
+
+    def _write_checkpoint(self, store, directory):
+        log_id = store.log_id
+        with store.hold() as cursor:
+            state = self._state()
+            self.applied_since_checkpoint = 0
+        self._save_snapshot(Path(directory), {"log_id": log_id, "cursor": list(cursor), **state})
+
+    def maybe_checkpoint(self, store, directory):
+        # Concurrent request threads: one of them saves, the others move on
+        if (self.applied_since_checkpoint >= self.CHECKPOINT_RECORDS
+                and self._checkpoint_lock.acquire(blocking=False)):
+            try:
+                if self.applied_since_checkpoint >= self.CHECKPOINT_RECORDS:
+                    self._write_checkpoint(store, directory)
+            finally:
+                self._checkpoint_lock.release()
+
+    def _save_snapshot(self, directory: Path, data: Dict):
+        write_json_atomic(directory / self.SNAPSHOT_NAME, data)
+
+    def _load_snapshot(self, directory: Path, log_id: str) -> tuple:
+        """Load the snapshot; returns its cursor."""
+        with open(directory / self.SNAPSHOT_NAME) as f:
+            data = json.load(f)
+        if data["log_id"] != log_id:
+            raise ValueError("snapshot belongs to a cleared log")
+        self._load_state(data)
+        return tuple(data["cursor"])
+
+    @classmethod
+    def open(cls, store, directory):
+        """Load the saved state and subscribe to the log from its cursor."""
+        listener = cls()
+        try:
+            since = listener._load_snapshot(Path(directory), store.log_id)
+        except (OSError, ValueError, KeyError, TypeError):
+            listener.reset()
+            since = (0, 0)
+        store.subscribe(listener, since=since)
+        return listener
+
+
+class LatestIndex(Checkpointed):
+    """Latest record per device plus the latest record overall."""
+
+    SNAPSHOT_NAME = LATEST_NAME
+
+    def __init__(self):
+        super().__init__()
+        self._by_device: Dict[str, Dict] = {}
+        self._latest: Optional[Dict] = None
+
+    def apply(self, records: List[Dict]):
+        for record in records:
+            self._by_device[record.get("device_id", "unknown")] = record
+        if records:
+            self._latest = records[-1]
+        self.applied_since_checkpoint += len(records)
+
+    def reset(self):
+        self._by_device = {}
+        self._latest = None
+        self.applied_since_checkpoint = 0
+
+    def _state(self):
+        # A copy: it is serialized after the log is released again
+        return {"devices": dict(self._by_device), "latest": self._latest}
+
+    def _load_state(self, data):
+        self._by_device = dict(data["devices"])
+        self._latest = data["latest"]
+
+    def get(self, device_id: Optional[str] = None) -> Optional[Dict]:
+        """Return the most recent record, optionally for one device."""
+        if device_id is None:
+            return self._latest
+        return self._by_device.get(device_id)
+
+    def device_ids(self) -> List[str]:
+        return list(self._by_device)
+
+
+class RecentKeys(Checkpointed):
+    """Bounded set of recent (device_id, timestamp) keys per device.
+
+    Used to drop records a device re-sends after a lost response. Checking a
+    batch costs O(batch); memory is at most ``capacity`` keys per device.
+    The timestamp is the device's millis() since boot, so a device's keys
+    are forgotten once it reboots; otherwise new samples whose millis match
+    a key from before the reboot would be dropped. A retry re-sends the
+    unacknowledged buffer, which always reaches the device's last stored
+    key, so a batch whose newest timestamp is below that key comes after a
+    reboot.
+    """
+
+    SNAPSHOT_NAME = RECENT_KEYS_NAME
+
+    def __init__(self, capacity: int = RECENT_KEYS_PER_DEVICE):
+        super().__init__()
+        self.capacity = capacity
+        self._by_device: Dict[str, OrderedDict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(record: Dict):
+        timestamp = record.get("timestamp")
+        if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+            return timestamp
+        return None
+
+    @staticmethod
+    def _newest(records: List[Dict]) -> Dict[str, float]:
+        """Highest key per device in one batch."""
+        newest = {}
+        for record in records:
+            key = RecentKeys._key(record)
+            if key is not None:
+                device_id = record.get("device_id", "unknown")
+                if key > newest.get(device_id, key - 1):
+                    newest[device_id] = key
+        return newest
+
+    def _rebooted(self, device_id: str, newest) -> bool:
+        """The batch ends below the device's last key (millis() restarted)."""
+        keys = self._by_device.get(device_id)
+        return bool(keys) and newest < next(reversed(keys))
+
+    def apply(self, records: List[Dict]):
+        with self._lock:
+            # One batch per device and received_at stamp
+            for _, batch in groupby(records, key=lambda r: (r.get("device_id", "unknown"),
+                                                            r.get("received_at"))):
+                batch = list(batch)
+                for device_id, newest in self._newest(batch).items():
+                    if self._rebooted(device_id, newest):
+                        self._by_device[device_id].clear()
+                for record in batch:
+                    key = self._key(record)
+                    if key is None:
+                        continue
+                    keys = self._by_device.get(record.get("device_id", "unknown"))
+                    if keys is None:
+                        keys = self._by_device[record.get("device_id", "unknown")] = OrderedDict()
+                    keys[key] = None
+                    keys.move_to_end(key)
+                    if len(keys) > self.capacity:
+                        keys.popitem(last=False)
+            self.applied_since_checkpoint += len(records)
+
+    def reset(self):
+        with self._lock:
+            self._by_device = {}
+            self.applied_since_checkpoint = 0
+
+    def _state(self):
+        with self._lock:
+            return {"devices": {device_id: list(keys)
+                                for device_id, keys in self._by_device.items()}}
+
+    def _load_state(self, data):
+        with self._lock:
+            self._by_device = {device_id: OrderedDict.fromkeys(keys[-self.capacity:])
+                               for device_id, keys in data["devices"].items()}
+
+    def fresh(self, records: List[Dict]) -> List[Dict]:
+        """Records not seen recently (nor earlier in the same batch)."""
+        kept = []
+        seen = set()
+        with self._lock:
+            # Devices whose batch comes after a reboot: their keys no longer apply
+            rebooted = {device_id for device_id, newest in self._newest(records).items()
+                        if self._rebooted(device_id, newest)}
+            for record in records:
+                key = self._key(record)
+                if key is not None:
+                    device_id = record.get("device_id", "unknown")
+                    if (device_id, key) in seen or (
+                            device_id not in rebooted
+                            and key in self._by_device.get(device_id, ())):
+                        continue
+                    seen.add((device_id, key))
+                kept.append(record)
+        return kept
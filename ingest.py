@@ -0,0 +1,437 @@
+"""
+Single-writer ingest pipeline.
+
+Request handlers hand validated batches to `IngestWriter.submit()` and wait on
+the returned ticket. One background thread drains the queue, writes every
+queued batch to the segment log in a single append and fsyncs once per group
+(group commit). A ticket is only released after its batch is durable, so a
+device never gets a success response for data that could still be lost.
+
+With a `RecentKeys` index the writer also drops records that were already
+stored (a retry after a lost response). The check runs under the log's write
+lock, so concurrent or cross-process retries cannot both get through; a batch
+made only of duplicates is acknowledged without touching storage.
+
+Multi-worker deployments (gunicorn / uvicorn ``--workers``) can run one
+writer process next to the workers:
+
+    python ingest.py serve            # listens on water_flow_data/.ingest.sock
+
+Workers that find the socket at startup send their validated batches there
+(`SocketIngestWriter`) instead of writing themselves, so every worker's
+batches share one group commit and one fsync, and the workers' cores are left
+for HTTP, JSON and validation. Without the writer process each worker writes
+to the log directly, serialized by the log's file lock.
+
+The durability mode trades latency for throughput: ``batch`` fsyncs every
+batch separately, ``group`` holds a commit window of ``group_commit_ms``
+open after the first batch so more batches share one fsync (see
+DURABILITY_MODES). In both modes nothing is acknowledged before it is on disk.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import queue
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Upper bound of batches combined into one group commit
+MAX_GROUP_BATCHES = 256
+
+# Durability modes; both fsync before a batch is acknowledged:
+#   "batch"  every batch is appended and fsynced on its own (lowest latency
+#            when idle, one fsync per batch under load)
+#   "group"  the writer waits up to GROUP_COMMIT_MS after the first queued
+#            batch and commits everything that arrived with one fsync
+#            (0 ms: only what is already queued, no added latency)
+DURABILITY_MODES = ("batch", "group")
+DURABILITY = "group"
+GROUP_COMMIT_MS = 0.0
+
+# How long a handler waits for its batch to become durable
+SUBMIT_TIMEOUT = 10.0
+
+# Unix socket of the writer process, inside the data directory
+INGEST_SOCKET_NAME = ".ingest.sock"
+
+# Length prefix of the messages on that socket
+_FRAME_HEADER = struct.Struct("<I")
+
+
+class IngestTimeout(Exception):
+    """Raised when a batch was not committed within the submit timeout."""
+
+
+class IngestError(Exception):
+    """The writer process could not commit a batch."""
+
+
+class IngestTicket:
+    """Handle returned by `IngestWriter.submit()`."""
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        # Records actually written; the rest were duplicates
+        self.stored = 0
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+        self._callbacks: List[Callable[["IngestTicket"], None]] = []
+        self._callback_lock = threading.Lock()
+
+    def _resolve(self, error: Optional[BaseException] = None):
+        self.error = error
+        with self._callback_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback: Callable[["IngestTicket"], None]):
+        """Call ``callback(ticket)`` from the writer thread once resolved.
+
+        Lets asyncio handlers wait for durability without parking a thread.
+        Called immediately if the ticket is already resolved.
+        """
+        with self._callback_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = SUBMIT_TIMEOUT) -> int:
+        """Block until the batch is durable; return the number of records stored."""
+        if not self._done.wait(timeout):
+            raise IngestTimeout("batch was not committed in time")
+        if self.error is not None:
+            raise self.error
+        return self.stored
+
+    @property
+    def duplicates(self) -> int:
+        return len(self.records) - self.stored
+
+
+class IngestWriter:
+    """Background thread that owns all writes to a `SegmentLog`."""
+
+    def __init__(self, store, max_group_batches=MAX_GROUP_BATCHES, dedup=None,
+                 durability=DURABILITY, group_commit_ms=GROUP_COMMIT_MS):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY_MODES)}")
+        self.store = store
+        self.dedup = dedup
+        self.durability = durability
+        self.max_group_batches = 1 if durability == "batch" else max_group_batches
+        self.group_commit_delay = max(0.0, group_commit_ms) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="ingest-writer", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, records: List[Dict]) -> IngestTicket:
+        """Queue a batch for the writer thread."""
+        ticket = IngestTicket(records)
+        if not records:
+            ticket._resolve()
+            return ticket
+        self.start()
+        self._queue.put(ticket)
+        return ticket
+
+    def write(self, records: List[Dict], timeout: Optional[float] = SUBMIT_TIMEOUT) -> int:
+        """Submit a batch and wait until it is durable."""
+        return self.submit(records).wait(timeout)
+
+    def backlog(self) -> int:
+        """Batches queued but not yet picked up by the writer thread."""
+        return self._queue.qsize()
+
+    def stop(self):
+        """Commit everything still queued and stop the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            ticket = self._queue.get()
+            if ticket is None:
+                return
+            group = [ticket]
+            stopping = False
+            # Take whatever else arrives within the commit window (or, with
+            # no window, what arrived meanwhile) into the same commit
+            deadline = time.monotonic() + self.group_commit_delay
+            while len(group) < self.max_group_batches:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+
+            self._commit(group)
+            if stopping:
+                return
+
+    def _commit(self, group: List[IngestTicket]):
+        records = [record for ticket in group for record in ticket.records]
+        written = records
+
+        def select(batch):
+            nonlocal written
+            written = self.dedup.fresh(batch)
+            return written
+
+        try:
+            self.store.append(records, sync=True,
+                              select=select if self.dedup is not None else None)
+        except Exception as e:
+            for ticket in group:
+                ticket._resolve(e)
+            return
+        written_ids = {id(record) for record in written}
+        for ticket in group:
+            ticket.stored = sum(1 for record in ticket.records if id(record) in written_ids)
+            ticket._resolve()
+
+
+# ----------------------------------------------------------------------
+# Writer process for multi-worker deployments
+# ----------------------------------------------------------------------
+def _frame(message: Dict) -> bytes:
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _read_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_frame(sock: socket.socket) -> Optional[Dict]:
+    """Next message from the socket; None once the peer closed it."""
+    header = _read_exact(sock, _FRAME_HEADER.size)
+    if header is None:
+        return None
+    payload = _read_exact(sock, _FRAME_HEADER.unpack(header)[0])
+    return None if payload is None else json.loads(payload)
+
+
+class SocketIngestWriter:
+    """`IngestWriter` interface backed by a writer process (`python ingest.py serve`).
+
+    Batches go over one Unix socket connection per worker process; a reader
+    thread resolves the tickets as the writer process acknowledges them.
+    If the connection breaks, the batches in flight fail with
+    `IngestTimeout` (the device retries, duplicates are dropped by the
+    writer) and the next submit reconnects.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._sock: Optional[socket.socket] = None
+        self._pending: Dict[int, IngestTicket] = {}
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def available(path) -> bool:
+        """Whether a writer process is listening on ``path``."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(path))
+            except OSError:
+                return False
+        return True
+
+    def start(self):
+        with self._send_lock:
+            try:
+                self._connect()
+            except OSError:
+                pass  # retried on the next submit
+
+    def _connect(self):
+        """Open the connection if needed; caller holds ``_send_lock``."""
+        if self._sock is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock, self._pending = sock, {}
+        threading.Thread(target=self._read_acks, args=(sock, self._pending),
+                         name="ingest-socket", daemon=True).start()
+
+    def _read_acks(self, sock: socket.socket, pending: Dict[int, IngestTicket]):
+        try:
+            while True:
+                message = _read_frame(sock)
+                if message is None:
+                    break
+                ticket = pending.pop(message["id"], None)
+                if ticket is None:
+                    continue
+                if "error" in message:
+                    ticket._resolve(IngestError(message["error"]))
+                else:
+                    ticket.stored = message["stored"]
+                    ticket._resolve()
+        except (OSError, ValueError):
+            pass
+        with self._send_lock:
+            if self._sock is sock:
+                self._sock = None
+        sock.close()
+        for ticket_id in list(pending):
+            ticket = pending.pop(ticket_id, None)
+            if ticket is not None:
+                ticket._resolve(IngestTimeout("connection to the ingest writer was lost"))
+
+    def submit(self, records: List[Dict]) -> IngestTicket:
+        ticket = IngestTicket(records)
+        if not records:
+            ticket._resolve()
+            return ticket
+        ticket_id = next(self._ids)
+        frame = _frame({"id": ticket_id, "records": records})
+        with self._send_lock:
+            try:
+                self._connect()
+                self._pending[ticket_id] = ticket
+                self._sock.sendall(frame)
+                return ticket
+            except OSError as e:
+                self._pending.pop(ticket_id, None)
+                self._disconnect()
+                error = e
+        ticket._resolve(IngestTimeout(f"ingest writer unavailable: {error}"))
+        return ticket
+
+    def write(self, records: List[Dict], timeout: Optional[float] = SUBMIT_TIMEOUT) -> int:
+        return self.submit(records).wait(timeout)
+
+    def backlog(self) -> int:
+        """Batches sent but not yet acknowledged by the writer process."""
+        return len(self._pending)
+
+    def stop(self):
+        with self._send_lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        """Drop the connection; its reader thread fails the batches in flight."""
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock = None
+
+
+def _serve_connection(conn: socket.socket, writer: IngestWriter):
+    send_lock = threading.Lock()
+
+    def acknowledge(ticket_id: int, ticket: IngestTicket):
+        if ticket.error is None:
+            message = {"id": ticket_id, "stored": ticket.stored}
+        else:
+            message = {"id": ticket_id, "error": str(ticket.error)}
+        with send_lock:
+            try:
+                conn.sendall(_frame(message))
+            except OSError:
+                pass  # worker gone; it fails the batch and the device retries
+
+    with conn:
+        try:
+            while True:
+                message = _read_frame(conn)
+                if message is None:
+                    return
+                ticket = writer.submit(message["records"])
+                ticket.add_done_callback(functools.partial(acknowledge, message["id"]))
+        except (OSError, ValueError, KeyError):
+            return
+
+
+def serve(data_dir, socket_path=None, durability=DURABILITY, group_commit_ms=GROUP_COMMIT_MS):
+    """Run the writer process: commit batches from all workers of a data directory."""
+    from backends import open_backend
+    from indexes import RecentKeys
+
+    data_dir = Path(data_dir)
+    socket_path = Path(socket_path or data_dir / INGEST_SOCKET_NAME)
+    # Same SWM_STORAGE backend as the API workers
+    store = open_backend(None, data_dir, None).log
+    recent_keys = RecentKeys.open(store, data_dir)
+    writer = IngestWriter(store, dedup=recent_keys,
+                          durability=durability, group_commit_ms=group_commit_ms)
+    writer.start()
+
+    socket_path.unlink(missing_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_path))
+    server.listen(128)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=_serve_connection, args=(conn, writer),
+                             name="ingest-connection", daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        socket_path.unlink(missing_ok=True)
+        writer.stop()
+        recent_keys.checkpoint(store, data_dir)
+        store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest writer process")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--data-dir", default="water_flow_data")
+    parser.add_argument("--socket", help=f"default: <data dir>/{INGEST_SOCKET_NAME}")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default=DURABILITY,
+                        help="batch: fsync every batch; group: one fsync per commit window")
+    parser.add_argument("--group-commit-ms", type=float, default=GROUP_COMMIT_MS,
+                        help="commit window of the group mode")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.data_dir, args.socket, args.durability, args.group_commit_ms)
@@ -0,0 +1,217 @@
+"""
+Device liveness: last seen, upload cadence and missed uploads per device.
+
+`LivenessTracker` follows the segment log like the indexes (one upload per
+distinct `received_at` of a device, since a batch shares one stamp), and
+`/verify` calls add boot-time sightings. Per device it keeps:
+
+    last_seen      latest upload or verify (epoch ns, server local time)
+    last_upload    latest upload
+    cadence        learned upload interval (EWMA, starts at 10 minutes)
+    missed         uploads that never came (gaps between uploads)
+
+Every device has a due time, ``last_seen + cadence * OVERDUE_FACTOR``, kept
+in a min-heap, so "which devices are overdue now" pops only the k overdue
+entries: O(k log n) instead of a scan over all devices or records. Entries
+are invalidated lazily (each device remembers its current entry) and the
+heap is rebuilt once stale entries outnumber the devices. The per-device
+state is saved to `liveness.json` with the log cursor (`indexes.Checkpointed`),
+so a restart replays only the log written since.
+"""
+
+import datetime
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from columnar import to_epoch_ns
+from indexes import Checkpointed
+
+SECOND_NS = 1_000_000_000
+
+# Firmware: 10 samples per upload, one sample per minute
+EXPECTED_UPLOAD_INTERVAL = 600 * SECOND_NS
+MIN_CADENCE = 60 * SECOND_NS
+MAX_CADENCE = 6 * 3600 * SECOND_NS
+CADENCE_ALPHA = 0.2
+
+# A device is overdue once this many cadences passed without an upload or verify
+OVERDUE_FACTOR = 1.5
+
+# Intervals longer than this many cadences are outages, not a new cadence
+OUTAGE_FACTOR = 3.0
+
+LIVENESS_NAME = "liveness.json"
+
+
+def now_ns() -> int:
+    """Current server time in the same frame as `received_at` (naive local)."""
+    return int(np.datetime64(datetime.datetime.now(), "ns").astype(np.int64))
+
+
+def _iso(value_ns: Optional[int]) -> Optional[str]:
+    if value_ns is None:
+        return None
+    return str(np.datetime64(value_ns, "ns").astype("datetime64[s]"))
+
+
+class _Device:
+    __slots__ = ("last_seen", "last_upload", "cadence", "missed", "uploads", "entry")
+
+    def __init__(self):
+        self.last_seen = None
+        self.last_upload = None
+        self.cadence = EXPECTED_UPLOAD_INTERVAL
+        self.missed = 0
+        self.uploads = 0
+        self.entry = None  # current heap entry [due, seq, device_id]
+
+
+class LivenessTracker(Checkpointed):
+    """Per-device liveness with a heap of due times."""
+
+    SNAPSHOT_NAME = LIVENESS_NAME
+
+    def __init__(self):
+        super().__init__()
+        self._devices: Dict[str, _Device] = {}
+        self._heap: List[list] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Listener interface
+    # ------------------------------------------------------------------
+    def apply(self, records: List[Dict]):
+        received = to_epoch_ns([r.get("received_at") for r in records]).tolist()
+        with self._lock:
+            for record, received_ns in zip(records, received):
+                if received_ns < 0:  # no usable received_at
+                    continue
+                device = self._device(record.get("device_id", "unknown"))
+                if received_ns != device.last_upload:
+                    self._upload(device, received_ns)
+                    self._schedule(record.get("device_id", "unknown"), device)
+            self.applied_since_checkpoint += len(records)
+
+    def reset(self):
+        with self._lock:
+            self._devices = {}
+            self._heap = []
+            self.applied_since_checkpoint = 0
+
+    def _state(self):
+        with self._lock:
+            return {"devices": {device_id: [d.last_seen, d.last_upload, d.cadence,
+                                            d.missed, d.uploads]
+                                for device_id, d in self._devices.items()}}
+
+    def _load_state(self, data):
+        with self._lock:
+            self._devices, self._heap = {}, []
+            for device_id, values in data["devices"].items():
+                device = self._devices[device_id] = _Device()
+                (device.last_seen, device.last_upload, device.cadence,
+                 device.missed, device.uploads) = values
+                if device.last_seen is not None:
+                    self._schedule(device_id, device)
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+    def verified(self, device_id: str, at_ns: Optional[int] = None):
+        """A device called /verify (it booted); it is expected to upload next."""
+        at_ns = now_ns() if at_ns is None else at_ns
+        with self._lock:
+            device = self._device(device_id)
+            if device.last_seen is None or at_ns > device.last_seen:
+                device.last_seen = at_ns
+                self._schedule(device_id, device)
+
+    def _device(self, device_id: str) -> _Device:
+        device = self._devices.get(device_id)
+        if device is None:
+            device = self._devices[device_id] = _Device()
+        return device
+
+    @staticmethod
+    def _upload(device: _Device, at_ns: int):
+        if device.last_upload is not None and at_ns > device.last_upload:
+            interval = at_ns - device.last_upload
+            if interval <= device.cadence * OUTAGE_FACTOR:
+                cadence = device.cadence + CADENCE_ALPHA * (interval - device.cadence)
+                device.cadence = int(min(max(cadence, MIN_CADENCE), MAX_CADENCE))
+            device.missed += max(0, round(interval / device.cadence) - 1)
+        device.uploads += 1
+        device.last_upload = max(at_ns, device.last_upload or at_ns)
+        device.last_seen = max(at_ns, device.last_seen or at_ns)
+
+    def _schedule(self, device_id: str, device: _Device):
+        due = device.last_seen + int(device.cadence * OVERDUE_FACTOR)
+        if device.entry is not None and device.entry[0] == due:
+            return
+        device.entry = [due, next(self._seq), device_id]
+        heapq.heappush(self._heap, device.entry)
+        if len(self._heap) > 2 * len(self._devices) + 64:
+            self._heap = [d.entry for d in self._devices.values() if d.entry is not None]
+            heapq.heapify(self._heap)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def overdue(self, at_ns: Optional[int] = None) -> List[Dict]:
+        """Devices past their due time, most overdue first."""
+        at_ns = now_ns() if at_ns is None else at_ns
+        with self._lock:
+            return [self._status(entry[2], self._devices[entry[2]], at_ns)
+                    for entry in self._due(at_ns)]
+
+    def _due(self, at_ns: int) -> List[list]:
+        """Live heap entries due by ``at_ns``; caller holds ``self._lock``."""
+        found = []
+        while self._heap and self._heap[0][0] <= at_ns:
+            entry = heapq.heappop(self._heap)
+            device = self._devices.get(entry[2])
+            if device is not None and device.entry is entry:
+                found.append(entry)
+        for entry in found:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def status(self, device_id: str, at_ns: Optional[int] = None) -> Optional[Dict]:
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                return None
+            return self._status(device_id, device, now_ns() if at_ns is None else at_ns)
+
+    def active_count(self, at_ns: Optional[int] = None) -> int:
+        """Devices seen that are not overdue."""
+        at_ns = now_ns() if at_ns is None else at_ns
+        with self._lock:
+            return len(self._devices) - len(self._due(at_ns))
+
+    def device_ids(self) -> List[str]:
+        return list(self._devices)
+
+    @staticmethod
+    def _status(device_id: str, device: _Device, at_ns: int) -> Dict:
+        due = device.entry[0] if device.entry is not None else None
+        overdue_ns = at_ns - due if due is not None and at_ns >= due else 0
+        # Uploads missed since the last one, while the device is silent
+        silent = 0
+        if device.last_upload is not None and overdue_ns:
+            silent = max(0, int((at_ns - device.last_upload) // device.cadence) - 1)
+        return {
+            "device_id": device_id,
+            "last_seen": _iso(device.last_seen),
+            "last_upload": _iso(device.last_upload),
+            "cadence_s": round(device.cadence / SECOND_NS, 1),
+            "uploads": device.uploads,
+            "missed_uploads": device.missed + silent,
+            "overdue": bool(overdue_ns),
+            "overdue_s": round(overdue_ns / SECOND_NS, 1),
+        }
@@ -0,0 +1,246 @@
+"""
+Request, stage and storage metrics in Prometheus text format (`/metrics`).
+
+Histograms have fixed bucket bounds and their count arrays are allocated when
+a label combination is first seen, so recording a sample is a bisect, two
+additions and an uncontended lock. Hot paths bind their children once at
+import (e.g. the stage timers below) and then just call ``observe()`` or
+``since()``. Gauges about storage are computed only when `/metrics` is
+scraped.
+
+Everything lives in the process: with several workers each reports its own
+numbers, which Prometheus sums per label.
+"""
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from sub-millisecond index lookups up to slow fsyncs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request bodies in bytes (a 50-record JSON batch is ~5 KB, binary 600 B)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Records per `/data` batch (the firmware buffer holds 50)
+BATCH_BUCKETS = (1, 5, 10, 20, 50, 100, 250, 1000)
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # One slot per bound plus +Inf; cumulated only when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.total += value
+
+    def since(self, start: float) -> float:
+        """Observe the seconds since ``start`` (a `perf_counter()` value); returns now."""
+        now = perf_counter()
+        self.observe(now - start)
+        return now
+
+
+class _Family:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = self._new_child()
+        return child
+
+    def samples(self) -> Iterable[Tuple[str, tuple, float]]:
+        raise NotImplementedError
+
+    def _label_text(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{self._label_text(values, extra)} {_number(value)}")
+
+
+class CounterFamily(_Family):
+    kind = "counter"
+
+    def _new_child(self):
+        return Counter()
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield "", values, "", child.value
+
+
+class HistogramFamily(_Family):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames, buckets):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return Histogram(self.buckets)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.total
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_number(bound)}"', cumulative
+            cumulative += counts[-1]
+            yield "_bucket", values, 'le="+Inf"', cumulative
+            yield "_sum", values, "", total
+            yield "_count", values, "", cumulative
+
+
+class GaugeFamily(_Family):
+    """Gauge computed at scrape time by ``collect() -> {label values: value}``."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames, collect: Callable[[], Dict[tuple, float]]):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for values, value in self.collect().items():
+            yield "", values, "", value
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# ----------------------------------------------------------------------
+# Registry
+# ----------------------------------------------------------------------
+_families: List[_Family] = []
+
+
+def counter(name: str, help_text: str, labelnames=()) -> CounterFamily:
+    family = CounterFamily(name, help_text, tuple(labelnames))
+    _families.append(family)
+    return family
+
+
+def histogram(name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> HistogramFamily:
+    family = HistogramFamily(name, help_text, tuple(labelnames), buckets)
+    _families.append(family)
+    return family
+
+
+def gauge(name: str, help_text: str, labelnames, collect) -> GaugeFamily:
+    family = GaugeFamily(name, help_text, tuple(labelnames), collect)
+    _families.append(family)
+    return family
+
+
+def render() -> bytes:
+    lines: List[str] = []
+    for family in _families:
+        try:
+            family.render(lines)
+        except Exception as e:  # a failing gauge must not hide the other metrics
+            lines.append(f"# {family.name} unavailable: {_escape(e)}")
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+
+# ----------------------------------------------------------------------
+# Metrics of the API servers
+# ----------------------------------------------------------------------
+request_seconds = histogram(
+    "swm_request_duration_seconds", "Request handling time per endpoint.", ("endpoint",))
+requests_total = counter(
+    "swm_requests_total", "Requests per endpoint and response status.", ("endpoint", "status"))
+request_bytes = histogram(
+    "swm_request_body_bytes", "Request body size per endpoint.", ("endpoint",), SIZE_BUCKETS)
+
+stage_seconds = histogram(
+    "swm_stage_duration_seconds", "Time spent in one stage of a request.", ("stage",))
+PARSE = stage_seconds.labels("parse")            # JSON / binary body decoding
+VALIDATE = stage_seconds.labels("validate")      # prepare_batch
+COMMIT = stage_seconds.labels("commit")          # save_data: queue + group commit + fsync
+CHECKPOINT = stage_seconds.labels("checkpoint")  # column/rollup checkpoints after a batch
+REFRESH = stage_seconds.labels("refresh")        # tailing other processes' writes
+LOAD_DATA = stage_seconds.labels("load_data")
+LOAD_DEVICES = stage_seconds.labels("load_devices")
+
+batch_records = histogram(
+    "swm_batch_records", "Data points per /data batch.", (), BATCH_BUCKETS).labels()
+device_batches = counter(
+    "swm_device_batches_total", "Accepted /data batches per device.", ("device_id",))
+device_records = counter(
+    "swm_device_records_total",
+    "Data points per device by outcome (stored, duplicate, rejected).",
+    ("device_id", "outcome"))
+
+
+def observe_request(endpoint: str, status: int, body_bytes, seconds: float):
+    request_seconds.labels(endpoint).observe(seconds)
+    requests_total.labels(endpoint, status).inc()
+    if body_bytes:
+        request_bytes.labels(endpoint).observe(body_bytes)
+
+
+def observe_batch(device_id: str, accepted: int, stored: int, rejected: int):
+    batch_records.observe(accepted + rejected)
+    device_batches.labels(device_id).inc()
+    device_records.labels(device_id, "stored").inc(stored)
+    if accepted > stored:
+        device_records.labels(device_id, "duplicate").inc(accepted - stored)
+    if rejected:
+        device_records.labels(device_id, "rejected").inc(rejected)
@@ -0,0 +1,85 @@
+"""
+Cached view of `registered_devices.json`.
+
+The registry file is parsed once and kept in memory. Every lookup does a cheap
+`os.stat()` and only reparses when the file's mtime, inode or size changed,
+e.g. after the Streamlit Device Management page or an operator edited it.
+Writes through `DeviceRegistry.save()` replace the file atomically and refresh
+the cache directly.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from storage import write_json_atomic
+
+
+class DeviceRegistry:
+    """In-memory device registry with file-change invalidation."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict] = {}
+        self._signature = None
+        self.hits = 0
+        self.misses = 0
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _current(self) -> Dict[str, Dict]:
+        signature = self._stat_signature()
+        with self._lock:
+            if signature is not None and signature == self._signature:
+                self.hits += 1
+                return self._devices
+            self.misses += 1
+            if signature is None:
+                self._devices, self._signature = {}, None
+                return self._devices
+            with open(self.path, "r") as f:
+                self._devices = json.load(f)
+            self._signature = signature
+            return self._devices
+
+    def load(self) -> Dict[str, Dict]:
+        """Return a copy of all registered devices."""
+        return dict(self._current())
+
+    def get(self, device_id: str) -> Optional[Dict]:
+        return self._current().get(device_id)
+
+    def version(self):
+        """Signature of the cached file; changes with every edit of it."""
+        self._current()
+        return self._signature
+
+    def modified(self) -> Optional[float]:
+        """Epoch seconds of the last edit (file mtime)."""
+        signature = self.version()
+        return signature[1] / 1e9 if signature else None
+
+    def __contains__(self, device_id) -> bool:
+        return device_id in self._current()
+
+    def save(self, devices: Dict[str, Dict]):
+        """Write the registry atomically and update the cache."""
+        with self._lock:
+            write_json_atomic(self.path, devices, indent=2)
+            self._devices = dict(devices)
+            self._signature = self._stat_signature()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "devices": len(self._devices),
+        }
@@ -0,0 +1,216 @@
+"""
+Hourly and daily rollup tables per device.
+
+For every device and hour/day bucket of sample time the tables keep (a batch
+shares one `received_at`; each sample is placed before it by its millis()
+distance to the newest sample of the batch, as in `analytics.sample_times`):
+
+    volume   total litres consumed (sum of positive volume deltas; a drop
+             in the volume counter is treated as a device reboot)
+    peak     highest flow rate (L/min)
+    samples  number of samples
+    gaps     samples that follow a missing interval (device clock jumped
+             more than GAP_MS, or went backwards after a reboot)
+
+`RollupTables` is a `SegmentLog` listener, so it is updated incrementally as
+each batch is appended. The tables are saved to `rollups.json` next to the
+raw data together with the log cursor, and can be rebuilt from the raw log
+with:
+
+    python rollups.py backfill
+
+Once `compaction.py` has removed raw segments past the retention window, the
+saved tables are the only record of that history; a backfill can then only
+rebuild the retained window.
+"""
+
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from indexes import Checkpointed
+from validation import number
+
+HOUR_NS = 3600 * 1_000_000_000
+DAY_NS = 24 * HOUR_NS
+
+PERIODS = {
+    "hourly": HOUR_NS,
+    "daily": DAY_NS,
+}
+
+# ESP32 samples every 60 s; a longer jump between samples counts as a gap
+SAMPLE_INTERVAL_MS = 60_000
+GAP_MS = SAMPLE_INTERVAL_MS * 3 // 2
+
+ROLLUPS_NAME = "rollups.json"
+
+# Save the tables after this many records were applied since the last save
+CHECKPOINT_RECORDS = 10_000
+
+VOLUME, PEAK, SAMPLES, GAPS = range(4)
+
+MS_NS = 1_000_000
+
+
+def _epoch_ns(value) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(np.datetime64(value, "ns").astype(np.int64))
+    except (TypeError, ValueError):
+        return None
+
+
+class RollupTables(Checkpointed):
+    """Per-device hourly/daily consumption tables kept in sync with ingest."""
+
+    SNAPSHOT_NAME = ROLLUPS_NAME
+    CHECKPOINT_RECORDS = CHECKPOINT_RECORDS
+
+    def __init__(self):
+        super().__init__()
+        # period -> device_id -> bucket start (epoch ns) -> [volume, peak, samples, gaps]
+        self.tables: Dict[str, Dict[str, Dict[int, List]]] = {p: {} for p in PERIODS}
+        # device_id -> (timestamp, volume) of its previous sample
+        self._last: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Listener interface
+    # ------------------------------------------------------------------
+    def apply(self, records: List[Dict]):
+        # Newest timestamp per batch (device and received_at stamp)
+        batch_max: Dict[tuple, int] = {}
+        for record in records:
+            key = (record.get("device_id", "unknown"), record.get("received_at"))
+            timestamp = number(record.get("timestamp"))
+            if timestamp is not None:
+                batch_max[key] = max(timestamp, batch_max.get(key, timestamp))
+        with self._lock:
+            for record in records:
+                self._apply_one(record, batch_max)
+            self.applied_since_checkpoint += len(records)
+
+    def _apply_one(self, record: Dict, batch_max: Dict[tuple, int]):
+        received_ns = _epoch_ns(record.get("received_at"))
+        if received_ns is None:
+            return
+        device_id = record.get("device_id", "unknown")
+        timestamp = number(record.get("timestamp"))
+        sampled_ns = received_ns
+        if timestamp is not None:
+            newest = batch_max[(device_id, record.get("received_at"))]
+            sampled_ns -= (newest - timestamp) * MS_NS
+        volume = number(record.get("volume"))
+        flow_rate = number(record.get("flow_rate"))
+
+        consumed = 0.0
+        gap = 0
+        previous = self._last.get(device_id)
+        if previous is not None:
+            prev_timestamp, prev_volume = previous
+            if timestamp is not None and prev_timestamp is not None:
+                elapsed = timestamp - prev_timestamp
+                if elapsed < 0 or elapsed > GAP_MS:
+                    gap = 1
+            if volume is not None and prev_volume is not None:
+                delta = volume - prev_volume
+                consumed = delta if delta >= 0 else volume
+        self._last[device_id] = (timestamp, volume)
+
+        for period, size in PERIODS.items():
+            bucket = sampled_ns - sampled_ns % size
+            rows = self.tables[period].setdefault(device_id, {})
+            row = rows.get(bucket)
+            if row is None:
+                row = rows[bucket] = [0.0, 0.0, 0, 0]
+            row[VOLUME] += consumed
+            if flow_rate is not None and flow_rate > row[PEAK]:
+                row[PEAK] = flow_rate
+            row[SAMPLES] += 1
+            row[GAPS] += gap
+
+    def reset(self):
+        with self._lock:
+            self.tables = {p: {} for p in PERIODS}
+            self._last = {}
+            self.applied_since_checkpoint = 0
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def rows(self, period: str, device_id: Optional[str] = None,
+             start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> List[Dict]:
+        """Rollup rows of one period, optionally for one device and time window."""
+        with self._lock:
+            table = self.tables[period]
+            device_ids = [device_id] if device_id is not None else sorted(table)
+            selected = [
+                (d, bucket, list(row))
+                for d in device_ids
+                for bucket, row in table.get(d, {}).items()
+                if (start_ns is None or bucket >= start_ns)
+                and (end_ns is None or bucket < end_ns)
+            ]
+        selected.sort(key=lambda item: (item[0], item[1]))
+        return [
+            {
+                "device_id": d,
+                "bucket_start": str(np.datetime64(bucket, "ns").astype("datetime64[s]")),
+                "volume": round(row[VOLUME], 4),
+                "peak_flow": row[PEAK],
+                "samples": row[SAMPLES],
+                "gaps": row[GAPS],
+            }
+            for d, bucket, row in selected
+        ]
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def _state(self):
+        with self._lock:
+            return {
+                "last": dict(self._last),
+                "tables": {
+                    period: {d: {str(b): list(row) for b, row in rows.items()}
+                             for d, rows in table.items()}
+                    for period, table in self.tables.items()
+                },
+            }
+
+    def _load_state(self, data):
+        tables = {
+            period: {d: {int(b): row for b, row in rows.items()}
+                     for d, rows in data["tables"].get(period, {}).items()}
+            for period in PERIODS
+        }
+        last = {d: tuple(v) for d, v in data["last"].items()}
+        with self._lock:
+            self.tables, self._last = tables, last
+
+
+def backfill(data_dir) -> RollupTables:
+    """Rebuild the rollup tables from the full raw log and save them."""
+    from backends import open_backend
+
+    store = open_backend(None, data_dir, None).log
+    tables = store.subscribe(RollupTables())
+    tables.checkpoint(store, data_dir)
+    store.close()
+    return tables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollup table maintenance")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--data-dir", default="water_flow_data")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        tables = backfill(args.data_dir)
+        for period in PERIODS:
+            print(f"{period}: {len(tables.rows(period))} rows")
@@ -0,0 +1,286 @@
+"""
+Storage, indexes and ingest logic shared by the API servers.
+
+`flask_api.py` (WSGI) and `asgi_api.py` (asyncio) are two transports over the
+same state: one segment log, one writer thread and one set of indexes per
+process. Request parsing that does not depend on the web framework lives here
+so both servers accept the same payloads and return the same responses.
+"""
+
+import atexit
+import datetime
+import json
+import os
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from backends import open_backend
+from columnar import ColumnStore
+from compaction import RAW_RETENTION_DAYS, Compactor
+from detection import LeakDetector
+from httpcache import CachedResponse, ResponseCache
+from indexes import LatestIndex, RecentKeys
+from ingest import (
+    DURABILITY, GROUP_COMMIT_MS, INGEST_SOCKET_NAME, IngestWriter, SocketIngestWriter,
+)
+from liveness import LivenessTracker
+from rollups import RollupTables
+from sqlite_store import DATABASE_NAME
+from storage import COMPRESSED_SUFFIX, SEGMENT_PREFIX, SEGMENT_SUFFIX
+from validation import validate_batch
+
+DATA_FILE = Path("water_flow_data.json")  # legacy single-file store, imported once
+DATA_DIR = Path("water_flow_data")
+DEVICES_FILE = Path("registered_devices.json")
+
+
+def init_files():
+    if not DEVICES_FILE.exists():
+        devices = {
+            "ESP32_WATER_001": {
+                "name": "Water Meter 001",
+                "location": "Main Building",
+                "registered_at": datetime.datetime.now().isoformat()
+            }
+        }
+        DEVICES_FILE.write_text(json.dumps(devices, indent=2))
+
+
+init_files()
+
+# Storage backend: SWM_STORAGE=json (default, segment log + registered_devices.json)
+# atau sqlite (water_flow_data/water_meter.db), lihat backends.py
+backend = open_backend(None, DATA_DIR, DEVICES_FILE, legacy_file=DATA_FILE)
+store = backend.log
+registry = backend.registry
+
+# Index latest record per device; snapshot latest.json + replay log sesudahnya
+latest_index = LatestIndex.open(store, DATA_DIR)
+
+# Columnar arrays per device untuk query time-range (/data GET)
+columns = ColumnStore.open(store, DATA_DIR)
+
+# Rollup hourly/daily per device, di-update setiap batch masuk
+rollups = RollupTables.open(store, DATA_DIR)
+
+# Deteksi kebocoran/anomali per batch (state kecil per device, tanpa baca history)
+detector = LeakDetector.open(store, DATA_DIR)
+
+# Last seen, cadence upload dan upload yang terlewat per device (/liveness)
+liveness = LivenessTracker.open(store, DATA_DIR)
+
+# Timestamp terakhir per device, untuk membuang record yang dikirim ulang
+recent_keys = RecentKeys.open(store, DATA_DIR)
+
+# Semua write lewat satu writer thread (group commit + fsync sebelum ack).
+# Multi-worker: kalau writer process (`python ingest.py serve`) sudah jalan,
+# batch dikirim ke sana lewat Unix socket sehingga semua worker berbagi satu
+# group commit. Tanpa writer process, tiap worker menulis sendiri dan
+# dikoordinasi oleh file lock di SegmentLog.
+# Mode durability: SWM_DURABILITY=batch (fsync per batch) atau group (default,
+# satu fsync per commit window SWM_GROUP_COMMIT_MS); untuk writer process
+# lewat `python ingest.py serve --durability ... --group-commit-ms ...`.
+if SocketIngestWriter.available(DATA_DIR / INGEST_SOCKET_NAME):
+    writer = SocketIngestWriter(DATA_DIR / INGEST_SOCKET_NAME)
+else:
+    writer = IngestWriter(
+        store, dedup=recent_keys,
+        durability=os.environ.get("SWM_DURABILITY", DURABILITY),
+        group_commit_ms=float(os.environ.get("SWM_GROUP_COMMIT_MS", GROUP_COMMIT_MS)))
+
+# Retensi data mentah (SWM_RETENTION_DAYS, default 30 hari, sisanya tetap ada
+# di rollups) dan merge segment kecil, jalan di background tanpa memblokir ingest
+compactor = Compactor(
+    store, DATA_DIR, rollups=rollups, columns=columns,
+    retention_days=float(os.environ.get("SWM_RETENTION_DAYS", RAW_RETENTION_DAYS)))
+compactor.start()
+
+
+def shutdown():
+    compactor.stop()
+    writer.stop()
+    columns.checkpoint(store, DATA_DIR)
+    rollups.checkpoint(store, DATA_DIR)
+    detector.checkpoint(store, DATA_DIR)
+    for index in (latest_index, liveness, recent_keys):
+        index.checkpoint(store, DATA_DIR)
+
+
+atexit.register(shutdown)
+
+
+def storage_bytes() -> Dict[tuple, float]:
+    """On-disk size per kind of file, for the `/metrics` gauge."""
+    sizes = {("segment_jsonl",): 0, ("segment_swmz",): 0, ("checkpoint",): 0}
+    with os.scandir(DATA_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                size = entry.stat().st_size
+            except FileNotFoundError:  # rotated or compacted meanwhile
+                continue
+            if entry.name.startswith(DATABASE_NAME):
+                sizes[("sqlite",)] = sizes.get(("sqlite",), 0) + size
+            elif not entry.name.startswith(SEGMENT_PREFIX):
+                sizes[("checkpoint",)] += size
+            elif entry.name.endswith(SEGMENT_SUFFIX):
+                sizes[("segment_jsonl",)] += size
+            elif entry.name.endswith(COMPRESSED_SUFFIX):
+                sizes[("segment_swmz",)] += size
+    try:
+        sizes[("registry",)] = DEVICES_FILE.stat().st_size
+    except FileNotFoundError:
+        pass
+    return sizes
+
+
+metrics.gauge("swm_storage_bytes", "Size of the data files on disk.", ("kind",), storage_bytes)
+metrics.gauge("swm_storage_segments", "Live segment files of the log.", (),
+              lambda: {(): len(store.segments())})
+metrics.gauge("swm_column_rows", "Rows held in the in-memory column store.", (),
+              lambda: {(): len(columns)})
+metrics.gauge("swm_devices_overdue", "Devices past their expected upload time.", (),
+              lambda: {(): len(liveness.overdue())})
+metrics.gauge("swm_ingest_queue_batches", "Batches waiting for the writer thread.", (),
+              lambda: {(): writer.backlog()})
+
+
+def refresh_store():
+    """Pick up records appended by other processes."""
+    start = perf_counter()
+    store.refresh()
+    metrics.REFRESH.since(start)
+
+
+def load_data():
+    start = perf_counter()
+    records = backend.load_data()
+    metrics.LOAD_DATA.since(start)
+    return records
+
+
+def load_devices():
+    start = perf_counter()
+    devices = backend.load_devices()
+    metrics.LOAD_DEVICES.since(start)
+    return devices
+
+
+# Encoded /devices dan /latest, valid selama versi storage/registry tidak berubah
+response_cache = ResponseCache()
+
+
+def cached_devices() -> CachedResponse:
+    """`/devices` response; rebuilt only after the registry changed."""
+    version = registry.version()
+
+    def build():
+        return CachedResponse(load_devices(), modified=registry.modified())
+
+    return response_cache.get(("devices",), version, build)
+
+
+def cached_latest(device_id: Optional[str] = None) -> CachedResponse:
+    """`/latest` response; rebuilt only after the log moved."""
+    refresh_store()
+
+    def build():
+        latest = latest_index.get(device_id)
+        if not latest:
+            message = "no data found" if device_id else "no data available"
+            return CachedResponse({"status": "error", "message": message}, 404)
+        try:
+            modified = datetime.datetime.fromisoformat(latest["received_at"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            modified = None
+        return CachedResponse(latest, modified=modified)
+
+    return response_cache.get(("latest", device_id), store.version, build)
+
+
+def save_data(records):
+    """Queue new records for the writer and wait until they are durable.
+
+    Returns how many were stored; records already stored are skipped.
+    """
+    start = perf_counter()
+    stored = writer.write(records)
+    metrics.COMMIT.since(start)
+    return stored
+
+
+class BatchError(Exception):
+    """A rejected `/data` payload; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 400, rejected: Optional[List[Dict]] = None):
+        super().__init__(message)
+        self.status = status
+        self.rejected = rejected
+
+    def body(self) -> Dict:
+        body = {"status": "error", "message": str(self)}
+        if self.rejected is not None:
+            body["rejected"] = self.rejected
+        return body
+
+
+def prepare_batch(incoming_data, device_id=None) -> Tuple[str, List[Dict], List[Dict]]:
+    """Validate a decoded `/data` payload and normalize its records.
+
+    Accepts a bare array or ``{"device_id": ..., "data": [...]}``; the body's
+    device_id overrides the query parameter. Returns ``(device_id, records,
+    rejected)``; see `validation.validate_batch`.
+    """
+    # Check if it's wrapped format: {"device_id": "...", "data": [...]}
+    if isinstance(incoming_data, dict) and 'device_id' in incoming_data and 'data' in incoming_data:
+        device_id = incoming_data['device_id']  # Override from JSON body
+        data_array = incoming_data['data']
+    elif isinstance(incoming_data, list):
+        # Old format: direct array
+        data_array = incoming_data
+    else:
+        raise BatchError("data must be a JSON array or object with device_id and data fields")
+
+    if not isinstance(data_array, list):
+        raise BatchError("data must be a JSON array")
+
+    if not device_id:
+        raise BatchError("device_id required (in query param or JSON body)")
+
+    if device_id not in registry:
+        raise BatchError("device not registered", 404)
+
+    start = perf_counter()
+    records, rejected = validate_batch(data_array, device_id)
+    metrics.VALIDATE.since(start)
+    if rejected and not records:
+        raise BatchError(f"all {len(data_array)} data points rejected", 422, rejected)
+    return device_id, records, rejected
+
+
+def batch_committed(device_id: str, records: List[Dict], stored: int,
+                    rejected: List[Dict]) -> Dict:
+    """Housekeeping after a batch is durable; returns the success response body.
+
+    A retried batch whose records were all stored before is still a success,
+    so the device clears its buffer.
+    """
+    metrics.observe_batch(device_id, len(records), stored, len(rejected))
+    if stored:
+        start = perf_counter()
+        columns.maybe_checkpoint(store, DATA_DIR)
+        rollups.maybe_checkpoint(store, DATA_DIR)
+        detector.maybe_checkpoint(store, DATA_DIR)
+        for index in (latest_index, liveness, recent_keys):
+            index.maybe_checkpoint(store, DATA_DIR)
+        metrics.CHECKPOINT.since(start)
+    return {
+        "status": "success",
+        "message": f"Received {len(records) + len(rejected)} data points",
+        "device_id": device_id,
+        "duplicates": len(records) - stored,
+        "rejected": rejected
+    }
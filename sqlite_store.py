@@ -0,0 +1,508 @@
+"""
+SQLite storage backend: readings and device registry in one database file.
+
+`SqliteLog` has the same interface as `storage.SegmentLog` (append with
+``select``, listeners with cursors, ``refresh``/``hold``/``log_id``), so
+the writer thread, the indexes and the checkpointed structures work on it
+unchanged. The cursor is ``(0, last row id)``; ids come from AUTOINCREMENT
+and are never reused, so a cursor stays valid across retention deletes.
+
+    readings(id, device_id, timestamp, received_at, flow_rate, volume, extra)
+    devices(device_id, info)
+    meta(key, value)            log_id, log_start, devices_version
+
+The database runs in WAL mode with ``synchronous=FULL``: a commit is on
+disk when `append` returns, readers never block the writer, and several
+processes can share the file (SQLite's own locking; writes take
+``BEGIN IMMEDIATE``). Every thread gets its own connection, closed when the
+thread exits (request threads are short-lived), and the SQL
+strings are module constants so each connection's statement cache keeps
+them prepared. A batch is one ``executemany`` in one transaction.
+
+`SqliteRegistry` replaces `registry.DeviceRegistry` with the same methods.
+Existing JSON data is imported with:
+
+    python sqlite_store.py import --data-dir water_flow_data
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+DATABASE_NAME = "water_meter.db"
+
+# Statements kept prepared per connection
+STATEMENT_CACHE = 64
+
+# Rows fetched per round trip when iterating the whole table, and about the
+# most a listener is handed at once when catching up
+FETCH_ROWS = 10_000
+
+# Wait this long for another process's write transaction
+BUSY_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    timestamp INTEGER,
+    received_at TEXT,
+    flow_rate,
+    volume,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS readings_device_timestamp ON readings (device_id, timestamp);
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    info TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# flow_rate and volume have no declared type, so ints and floats come back
+# exactly as they were stored (like in the JSON log)
+_COLUMNS = ("timestamp", "flow_rate", "volume", "device_id", "received_at")
+
+INSERT_READING = ("INSERT INTO readings (timestamp, flow_rate, volume, device_id, "
+                  "received_at, extra) VALUES (?, ?, ?, ?, ?, ?)")
+SELECT_AFTER = ("SELECT id, timestamp, flow_rate, volume, device_id, received_at, extra "
+                "FROM readings WHERE id > ? ORDER BY id")
+SELECT_BETWEEN = ("SELECT id, timestamp, flow_rate, volume, device_id, received_at, extra "
+                  "FROM readings WHERE id > ? AND id <= ? ORDER BY id")
+SELECT_RANGE = ("SELECT id, timestamp, flow_rate, volume, device_id, received_at, extra "
+                "FROM readings WHERE device_id = ? AND timestamp >= ? AND timestamp < ? "
+                "ORDER BY timestamp LIMIT ?")
+SELECT_FIRST_FROM = "SELECT id, received_at FROM readings WHERE id >= ? ORDER BY id LIMIT 1"
+SELECT_ID_RANGE = "SELECT min(id), max(id) FROM readings"
+SELECT_LAST_ID = "SELECT seq FROM sqlite_sequence WHERE name = 'readings'"
+DELETE_THROUGH = "DELETE FROM readings WHERE id <= ?"
+SELECT_META = "SELECT value FROM meta WHERE key = ?"
+UPSERT_META = ("INSERT INTO meta (key, value) VALUES (?, ?) "
+               "ON CONFLICT (key) DO UPDATE SET value = excluded.value")
+SELECT_DEVICES = "SELECT device_id, info FROM devices"
+INSERT_DEVICE = "INSERT INTO devices (device_id, info) VALUES (?, ?)"
+
+
+def _scalar(value) -> bool:
+    return value is None or type(value) in (int, float, str)
+
+
+def _row(record: Dict) -> tuple:
+    """Columns of one record; fields that do not fit a column go to ``extra``."""
+    extra = {key: value for key, value in record.items()
+             if key not in _COLUMNS or not _scalar(value)}
+    return tuple(record.get(name) if name not in extra else None for name in _COLUMNS) + (
+        json.dumps(extra, separators=(",", ":")) if extra else None,)
+
+
+def _record(row: tuple) -> Dict:
+    """Record dict of a ``SELECT id, <_COLUMNS>, extra`` row (NULL fields left out)."""
+    record = {name: value for name, value in zip(_COLUMNS, row[1:6]) if value is not None}
+    if row[6] is not None:
+        record.update(json.loads(row[6]))
+    return record
+
+
+class _ThreadConnection:
+    """Holder of one thread's connection, stored in the thread-local.
+
+    The thread-local drops it when its thread exits, which closes the
+    connection (request threads come and go with Flask and Streamlit).
+    """
+
+    __slots__ = ("conn", "__weakref__")
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        weakref.finalize(self, conn.close)
+
+
+class SqliteDatabase:
+    """One SQLite file with a connection per live thread."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connections: "weakref.WeakSet[_ThreadConnection]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # Autocommit mode: transactions are explicit (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False, cached_statements=STATEMENT_CACHE)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._lock:
+                self._connections.add(holder)
+        return holder.conn
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction holding SQLite's write lock from the start."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connection().execute(SELECT_META, (key,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        """Close every live thread's connection (at shutdown only)."""
+        with self._lock:
+            for holder in list(self._connections):
+                holder.conn.close()
+            self._connections = weakref.WeakSet()
+        self._local = threading.local()
+
+
+class SqliteLog:
+    """`SegmentLog` interface over the readings table."""
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+        self.directory = database.path.parent
+        self._lock = threading.RLock()
+        self._cursor = (0, 0)
+        self._listeners = []
+        self._log_id = self.log_id
+        self.version = 0
+        # SQLite replays its own WAL when the file is opened
+        self.recovered_bytes = 0
+
+    # ------------------------------------------------------------------
+    # Write path
+    # ------------------------------------------------------------------
+    def append(self, records: List[Dict], sync: bool = False,
+               select: Optional[Callable[[List[Dict]], List[Dict]]] = None) -> int:
+        """Insert a batch in one transaction; durable on return (``synchronous=FULL``).
+
+        ``sync`` is accepted for interface compatibility. ``select`` runs
+        inside the write transaction after the listeners caught up, as in
+        `SegmentLog.append`.
+        """
+        if not records:
+            return 0
+        with self._lock:
+            with self.database.transaction() as conn:
+                if self._listeners:
+                    self._refresh_locked()
+                if select is not None:
+                    records = select(records)
+                    if not records:
+                        return 0
+                conn.executemany(INSERT_READING, [_row(record) for record in records])
+                last = conn.execute(SELECT_LAST_ID).fetchone()[0]
+            # Committed; still under self._lock so hold()/refresh() never see a
+            # cursor ahead of what the listeners applied. The write lock was
+            # held from BEGIN, so the batch got consecutive ids
+            if self._listeners and self._cursor[1] == last - len(records):
+                self._cursor = (0, last)
+                self._dispatch(records)
+        return len(records)
+
+    def sync(self):
+        """Commits are already durable."""
+
+    def recover(self) -> int:
+        return 0
+
+    def clear(self):
+        with self._lock, self.database.transaction() as conn:
+            conn.execute("DELETE FROM readings")
+            # Ids continue after a clear; other processes resume from here
+            start = self._last_id()
+            self._log_id = uuid.uuid4().hex
+            conn.execute(UPSERT_META, ("log_id", self._log_id))
+            conn.execute(UPSERT_META, ("log_start", str(start)))
+            self._reset_listeners(start)
+
+    def close(self):
+        self.database.close()
+
+    # ------------------------------------------------------------------
+    # Retention (driven by compaction.Compactor)
+    # ------------------------------------------------------------------
+    def segments(self) -> List[Path]:
+        return []
+
+    def sealed_segments(self) -> List[Path]:
+        return []
+
+    def expire_received_before(self, cutoff_ns: int) -> int:
+        """Delete readings received before ``cutoff_ns``; returns rows removed.
+
+        Ids follow arrival order, so the boundary is found by binary search
+        over ids (a handful of primary key lookups) and removed as one range.
+        """
+        # Same format as received_at (datetime.isoformat) so strings compare in time order
+        cutoff = np.datetime64(cutoff_ns, "ns").astype("datetime64[us]").item().isoformat()
+        conn = self.database.connection()
+        low, high = conn.execute(SELECT_ID_RANGE).fetchone()
+        if low is None:
+            return 0
+        through = None
+        while low <= high:
+            middle = (low + high) // 2
+            row = conn.execute(SELECT_FIRST_FROM, (middle,)).fetchone()
+            if row is None or row[0] > high:
+                high = middle - 1
+            elif row[1] is not None and row[1] < cutoff:
+                through, low = row[0], row[0] + 1
+            else:
+                high = middle - 1
+        if through is None:
+            return 0
+        with self.database.transaction() as conn:
+            return conn.execute(DELETE_THROUGH, (through,)).rowcount
+
+    # ------------------------------------------------------------------
+    # Read path
+    # ------------------------------------------------------------------
+    def iter_records(self) -> Iterator[Dict]:
+        """Yield every stored record in arrival order."""
+        rows = self.database.connection().execute(SELECT_AFTER, (0,))
+        while True:
+            chunk = rows.fetchmany(FETCH_ROWS)
+            if not chunk:
+                return
+            for row in chunk:
+                yield _record(row)
+
+    def read_all(self) -> List[Dict]:
+        return list(self.iter_records())
+
+    def query(self, device_id: str, start: Optional[int] = None, end: Optional[int] = None,
+              limit: int = -1) -> List[Dict]:
+        """Records of one device with ``start <= timestamp < end`` (index range scan)."""
+        rows = self.database.connection().execute(
+            SELECT_RANGE, (device_id, -(1 << 63) if start is None else start,
+                           (1 << 63) - 1 if end is None else end, limit))
+        return [_record(row) for row in rows]
+
+    # ------------------------------------------------------------------
+    # Listeners
+    # ------------------------------------------------------------------
+    def subscribe(self, listener, since=(0, 0)):
+        """Register a listener, fed every record after the ``since`` cursor."""
+        with self._lock:
+            self._refresh_locked()
+            if not self.valid_cursor(since):
+                listener.reset()
+                since = (0, 0)
+            # In chunks, so a replay never holds the whole table
+            for records, _ in self._scan(since[1], until=self._cursor[1]):
+                listener.apply(records)
+            self._listeners.append(listener)
+        return listener
+
+    @property
+    def log_id(self) -> str:
+        """Identifier of the table's contents; changes whenever it is cleared."""
+        log_id = self.database.get_meta("log_id")
+        if log_id is None:
+            with self.database.transaction() as conn:
+                log_id = conn.execute(SELECT_META, ("log_id",)).fetchone()
+                log_id = log_id[0] if log_id else uuid.uuid4().hex
+                conn.execute(UPSERT_META, ("log_id", log_id))
+        return log_id
+
+    @contextmanager
+    def hold(self):
+        """Pause dispatching and yield the cursor listeners are at."""
+        with self._lock:
+            yield self._cursor
+
+    def valid_cursor(self, cursor) -> bool:
+        row = self.database.connection().execute(SELECT_LAST_ID).fetchone()
+        return cursor[1] <= (row[0] if row else 0)
+
+    def refresh(self) -> int:
+        """Feed listeners with rows inserted by other processes."""
+        with self._lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> int:
+        log_id = self.log_id
+        if log_id != self._log_id:
+            # Cleared by another process
+            self._log_id = log_id
+            self._reset_listeners(int(self.database.get_meta("log_start") or 0))
+        count = 0
+        for records, last in self._scan(self._cursor[1]):
+            self._cursor = (0, last)
+            self._dispatch(records)
+            count += len(records)
+        return count
+
+    def _reset_listeners(self, start: int):
+        self._cursor = (0, start)
+        self.version += 1
+        for listener in self._listeners:
+            listener.reset()
+
+    def _last_id(self) -> int:
+        row = self.database.connection().execute(SELECT_LAST_ID).fetchone()
+        return row[0] if row else 0
+
+    def _scan(self, after: int, until: Optional[int] = None) -> Iterator[Tuple[List[Dict], int]]:
+        """Yield ``(records, last id)`` for rows after ``after`` (through
+        ``until``), about ``FETCH_ROWS`` at a time.
+
+        A chunk ends on a change of ``received_at``, so a batch is never
+        split between two `apply` calls.
+        """
+        conn = self.database.connection()
+        if until is None:
+            rows = conn.execute(SELECT_AFTER, (after,))
+        else:
+            rows = conn.execute(SELECT_BETWEEN, (after, until))
+        pending: List[tuple] = []
+        while True:
+            chunk = rows.fetchmany(FETCH_ROWS)
+            if not chunk:
+                break
+            pending.extend(chunk)
+            # Hold back the last batch, it may go on in the next chunk
+            cut = len(pending)
+            while cut and pending[cut - 1][5] == pending[-1][5]:
+                cut -= 1
+            if cut:
+                ready, pending = pending[:cut], pending[cut:]
+                yield [_record(row) for row in ready], ready[-1][0]
+        if pending:
+            yield [_record(row) for row in pending], pending[-1][0]
+
+    def _dispatch(self, records: List[Dict]):
+        self.version += 1
+        for listener in self._listeners:
+            listener.apply(records)
+
+
+class SqliteRegistry:
+    """`DeviceRegistry` interface over the devices table."""
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict] = {}
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        """Bumped by every `save`, also from other processes."""
+        return self.database.get_meta("devices_version")
+
+    def modified(self) -> Optional[float]:
+        version = self.version()
+        return int(version.split(":")[1]) / 1e9 if version else None
+
+    def _current(self) -> Dict[str, Dict]:
+        version = self.version()
+        with self._lock:
+            if version == self._version:
+                self.hits += 1
+                return self._devices
+            self.misses += 1
+            rows = self.database.connection().execute(SELECT_DEVICES).fetchall()
+            self._devices = {device_id: json.loads(info) for device_id, info in rows}
+            self._version = version
+            return self._devices
+
+    def load(self) -> Dict[str, Dict]:
+        return dict(self._current())
+
+    def get(self, device_id: str) -> Optional[Dict]:
+        return self._current().get(device_id)
+
+    def __contains__(self, device_id) -> bool:
+        return device_id in self._current()
+
+    def save(self, devices: Dict[str, Dict]):
+        """Replace all devices in one transaction."""
+        with self._lock, self.database.transaction() as conn:
+            previous = conn.execute(SELECT_META, ("devices_version",)).fetchone()
+            counter = int(previous[0].split(":")[0]) + 1 if previous else 1
+            version = f"{counter}:{time.time_ns()}"
+            conn.execute("DELETE FROM devices")
+            conn.executemany(INSERT_DEVICE, [(device_id, json.dumps(info))
+                                             for device_id, info in devices.items()])
+            conn.execute(UPSERT_META, ("devices_version", version))
+            self._devices, self._version = dict(devices), version
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "devices": len(self._devices),
+        }
+
+
+def import_json(data_dir, devices_file, database_path=None, legacy_file=None) -> Dict[str, int]:
+    """Copy the segment log (or a legacy single JSON file) and the device
+    registry into the SQLite database. Refuses to import into a database
+    that already has readings."""
+    from storage import SegmentLog
+
+    data_dir = Path(data_dir)
+    database = SqliteDatabase(database_path or data_dir / DATABASE_NAME)
+    log = SqliteLog(database)
+    if database.connection().execute(SELECT_ID_RANGE).fetchone()[0] is not None:
+        raise ValueError(f"{database.path} already has readings")
+
+    store = SegmentLog(data_dir, legacy_file=legacy_file)
+    imported = 0
+    batch = []
+    for record in store.iter_records():
+        batch.append(record)
+        if len(batch) >= FETCH_ROWS:
+            imported += log.append(batch)
+            batch = []
+    imported += log.append(batch)
+    store.close()
+
+    devices = 0
+    if devices_file is not None and Path(devices_file).exists():
+        with open(devices_file) as f:
+            registry = json.load(f)
+        SqliteRegistry(database).save(registry)
+        devices = len(registry)
+    database.close()
+    return {"readings": imported, "devices": devices}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite storage backend")
+    parser.add_argument("command", choices=["import"])
+    parser.add_argument("--data-dir", default="water_flow_data")
+    parser.add_argument("--devices", default="registered_devices.json")
+    parser.add_argument("--legacy-file", default="water_flow_data.json")
+    parser.add_argument("--db", help=f"default: <data dir>/{DATABASE_NAME}")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        print(json.dumps(import_json(args.data_dir, args.devices, args.db, args.legacy_file),
+                         indent=2))
@@ -0,0 +1,711 @@
+"""
+Append-only segment log for water meter records.
+
+Records are written as newline-delimited JSON into rotating segment files
+(`segment-000001.jsonl`, `segment-000002.jsonl`, ...) so that an ingest only
+costs as much as the batch it appends, instead of rewriting the whole history.
+
+Writes are serialized with a thread lock and, where available, an advisory
+file lock on `<directory>/.lock`, so several processes (gunicorn workers, the
+Streamlit app) can append to the same log without interleaving records.
+
+Once a segment is sealed (rotated away from) it is rewritten in the compact
+`.swmz` format from `compression.py` when its records allow a lossless
+round trip. Offsets inside the original file are kept, so cursors stay valid.
+
+`compaction.py` later removes segments past the retention window and merges
+small compressed segments into larger `segment-000003-000007.swmz` files;
+both keep every cursor valid.
+
+Derived in-memory structures (indexes, caches) subscribe to the log. They get
+every batch this process appends, and `SegmentLog.refresh()` tails the segment
+files from a cursor to feed them records written by other processes.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from itertools import accumulate
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import compression
+from validation import validate_records
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+COMPRESSED_SUFFIX = ".swmz"
+LOCK_NAME = ".lock"
+LOG_ID_NAME = ".log_id"
+# Highest segment number removed by retention (see compaction.py)
+EXPIRED_NAME = ".expired"
+
+# Reported size of a segment removed by retention: any cursor into it is valid
+EXPIRED_SIZE = float("inf")
+
+# Rotate to a new segment once the active one reaches this size
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+
+# fsync batching: sync after this many batches or this many seconds,
+# whichever comes first
+FSYNC_BATCHES = 32
+FSYNC_INTERVAL = 1.0
+
+# Rewrite sealed segments as compressed per-device blocks
+COMPRESS_SEALED = True
+
+
+def write_json_atomic(path, data, **kwargs):
+    """Write JSON to a temp file, fsync it and rename it over ``path``."""
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path.parent)
+
+
+def fsync_directory(directory):
+    """Make renames and new files in ``directory`` durable."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # Windows: directories cannot be opened
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def locked_file(path):
+    """Hold an exclusive advisory lock on ``path`` (created if missing)."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _encode_records(records: List[Dict]) -> bytes:
+    return b"".join(
+        json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+        for record in records
+    )
+
+
+def _segment_name(number: int) -> str:
+    return f"{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}"
+
+
+def _merged_name(first: int, last: int) -> str:
+    return f"{SEGMENT_PREFIX}{first:06d}-{last:06d}{COMPRESSED_SUFFIX}"
+
+
+def _segment_range(path: Path):
+    """``(first, last)`` segment numbers held by a file.
+
+    ``segment-000005.jsonl`` holds 5 only; a merged file
+    ``segment-000003-000007.swmz`` holds 3 through 7.
+    """
+    numbers = path.name[len(SEGMENT_PREFIX):].split(".")[0].split("-")
+    return int(numbers[0]), int(numbers[-1])
+
+
+def _segment_number(path: Path) -> int:
+    return _segment_range(path)[1]
+
+
+def _read_segment(path: Path, after=(0, 0), until=None):
+    """Records of one segment file after cursor ``after`` up to ``until``.
+
+    Cursors are ``(segment number, byte offset)``. Returns ``(records,
+    end)`` where ``end`` is the cursor just past the last complete record
+    read; a torn final line (crash mid-write) is left out.
+    """
+    first, last = _segment_range(path)
+    if path.suffix == COMPRESSED_SUFFIX:
+        records, (numbers, line_ends), sources = compression.decode_segment(
+            path.read_bytes(), number=last)
+        after_number, after_offset = after
+        selected = (numbers > after_number) | ((numbers == after_number) & (line_ends > after_offset))
+        if until is not None:
+            selected &= (numbers < until[0]) | ((numbers == until[0]) & (line_ends <= until[1]))
+        if until is not None and until[0] <= last:
+            end = tuple(until)
+        else:
+            end = tuple(sources[-1])
+        if selected.all():
+            return records, end
+        return [records[i] for i in selected.nonzero()[0].tolist()], end
+
+    start = after[1] if after[0] == last else 0
+    stop = until[1] if until is not None and until[0] == last else None
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read() if stop is None else f.read(max(stop - start, 0))
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].splitlines()], (last, start + end)
+
+
+class SegmentLog:
+    """Append-only store of records split across rotating segment files."""
+
+    def __init__(self, directory, legacy_file=None,
+                 segment_max_bytes=SEGMENT_MAX_BYTES,
+                 fsync_batches=FSYNC_BATCHES, fsync_interval=FSYNC_INTERVAL,
+                 interprocess=True, compress_sealed=COMPRESS_SEALED):
+        self.directory = Path(directory)
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_batches = fsync_batches
+        self.fsync_interval = fsync_interval
+        self.interprocess = interprocess and fcntl is not None
+        self.compress_sealed = compress_sealed
+        # Called with the segment number after a rotation (Compactor.wake)
+        self.on_sealed: Optional[Callable[[int], None]] = None
+        # Sealed segments that cannot be compressed losslessly
+        self._uncompressible = set()
+
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._active = None
+        self._active_number = 0
+        self._unsynced_batches = 0
+        self._last_sync = time.monotonic()
+        # A new segment's directory entry is synced with its first batch
+        self._directory_unsynced = False
+        # (segment number, size) of the active segment after our last append
+        self._tail_checked = None
+        # Bytes of torn records cut off by recovery
+        self.recovered_bytes = 0
+
+        # (segment number, byte offset) up to which listeners have been fed
+        self._cursor = (0, 0)
+        self._listeners = []
+        # Bumped whenever listeners see new records or a reset (cache validation)
+        self.version = 0
+        self._newest_cache = (None, 0)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.recover()
+        if legacy_file is not None:
+            self._import_legacy(Path(legacy_file))
+
+    # ------------------------------------------------------------------
+    # Segments
+    # ------------------------------------------------------------------
+    def segments(self) -> List[Path]:
+        """Return segment files in write order.
+
+        The compressed form of a segment is preferred over its `.jsonl`, a
+        merged file hides the single segments it replaced, and segments at or
+        below the retention mark are left out (a crash can leave any of
+        these behind for a moment).
+        """
+        expired = self._expired_through()
+        files = []
+        for path in self.directory.glob(f"{SEGMENT_PREFIX}*"):
+            if path.suffix not in (SEGMENT_SUFFIX, COMPRESSED_SUFFIX):
+                continue
+            first, last = _segment_range(path)
+            if last > expired:
+                files.append((first, last, path))
+        # Widest range first, and `.swmz` before `.jsonl` for the same range
+        files.sort(key=lambda f: (-f[1], f[0], f[2].suffix != COMPRESSED_SUFFIX))
+        kept = []
+        covered_from = None
+        for first, last, path in files:
+            if covered_from is not None and last >= covered_from:
+                continue
+            kept.append(path)
+            covered_from = first
+        kept.reverse()
+        return kept
+
+    def _expired_through(self) -> int:
+        try:
+            return int((self.directory / EXPIRED_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _segment_size(self, number: int):
+        """Byte size of a segment as written.
+
+        -1 if it does not exist, EXPIRED_SIZE if retention removed it.
+        """
+        try:
+            return os.stat(self.directory / _segment_name(number)).st_size
+        except FileNotFoundError:
+            pass
+        for path in self.segments():
+            first, last = _segment_range(path)
+            if first <= number <= last and path.suffix == COMPRESSED_SUFFIX:
+                for source, size in compression.read_sources(path, number=last):
+                    if source == number:
+                        return size
+        if number <= self._expired_through():
+            return EXPIRED_SIZE
+        return -1
+
+    def _newest_number(self) -> int:
+        """Highest segment number on disk, cached on the directory's mtime."""
+        stamp = os.stat(self.directory).st_mtime_ns
+        if self._newest_cache[0] != stamp:
+            segments = self.segments()
+            newest = _segment_number(segments[-1]) if segments else 0
+            self._newest_cache = (stamp, newest)
+        return self._newest_cache[1]
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            if not self.interprocess:
+                yield
+                return
+            if self._lock_file is None:
+                self._lock_file = open(self.directory / LOCK_NAME, "a")
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _open_active(self):
+        segments = self.segments()
+        if not segments:
+            self._active_number = 1
+        elif segments[-1].suffix == COMPRESSED_SUFFIX:
+            self._active_number = _segment_number(segments[-1]) + 1
+        else:
+            self._active_number = _segment_number(segments[-1])
+        path = self.directory / _segment_name(self._active_number)
+        self._directory_unsynced = not path.exists()
+        self._active = open(path, "ab")
+        if self._active.tell() >= self.segment_max_bytes:
+            self._rotate()
+
+    def _ensure_active(self):
+        """Open the newest segment, following rotations done by other processes."""
+        if self._active is not None and self.interprocess:
+            newest = self.directory / _segment_name(self._active_number + 1)
+            if newest.exists() or not os.path.exists(self._active.name):
+                self._sync()
+                self._active.close()
+                self._active = None
+        if self._active is None:
+            self._open_active()
+
+    def _rotate(self):
+        self._sync()
+        self._active.close()
+        sealed = self._active_number
+        self._active_number += 1
+        path = self.directory / _segment_name(self._active_number)
+        self._active = open(path, "ab")
+        self._directory_unsynced = True
+        # Compressing 8 MB takes about a second: left to the Compactor thread
+        # so this append (and the write lock) is not held up by it
+        if self.on_sealed is not None:
+            self.on_sealed(sealed)
+
+    def compress_sealed_segments(self) -> int:
+        """Compress every sealed `.jsonl` segment; returns how many were."""
+        if not self.compress_sealed:
+            return 0
+        return sum(self._compress_segment(_segment_number(path))
+                   for path in self.sealed_segments()
+                   if path.suffix == SEGMENT_SUFFIX
+                   and _segment_number(path) not in self._uncompressible)
+
+    def _compress_segment(self, number: int) -> bool:
+        """Replace a sealed `.jsonl` segment by its `.swmz` form if lossless.
+
+        Encoding runs without the write lock, as in `merge`; only the final
+        rename does.
+        """
+        log_id = self.log_id
+        path = self.directory / _segment_name(number)
+        data = path.read_bytes()
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].splitlines(keepends=True)
+        if not lines:
+            return False
+        records = [json.loads(line) for line in lines]
+        packed = compression.encode_segment(
+            records, list(accumulate(len(line) for line in lines)), len(data), number)
+        if packed is None:
+            self._uncompressible.add(number)
+            return False
+
+        target = path.with_suffix(COMPRESSED_SUFFIX)
+        tmp_path = target.with_name(target.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(packed)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._write_lock():
+            if self.log_id != log_id or not path.exists():
+                tmp_path.unlink()
+                return False
+            # The compressed file hides the `.jsonl` from the moment it exists
+            os.replace(tmp_path, target)
+            path.unlink()
+        return True
+
+    # ------------------------------------------------------------------
+    # Retention and compaction (driven by compaction.Compactor)
+    # ------------------------------------------------------------------
+    def sealed_segments(self) -> List[Path]:
+        """Segment files that no longer receive appends (all but the newest)."""
+        return self.segments()[:-1]
+
+    def expire(self, through: Path) -> int:
+        """Remove the sealed segment file ``through`` and all older ones.
+
+        The retention mark is written first, so cursors into removed segments
+        stay valid (they resume at the next live segment) and a crash cannot
+        bring removed data back. Returns the number of files removed.
+        """
+        with self._write_lock():
+            sealed = self.sealed_segments()
+            if not sealed:
+                return 0
+            if through not in sealed:
+                return 0
+            through = _segment_number(through)
+            if through <= self._expired_through():
+                return 0
+            tmp_path = self.directory / (EXPIRED_NAME + ".tmp")
+            tmp_path.write_text(str(through))
+            os.replace(tmp_path, self.directory / EXPIRED_NAME)
+            removed = 0
+            for path in self.directory.glob(f"{SEGMENT_PREFIX}*"):
+                if (path.suffix in (SEGMENT_SUFFIX, COMPRESSED_SUFFIX)
+                        and _segment_number(path) <= through):
+                    path.unlink()
+                    removed += 1
+            return removed
+
+    def merge(self, paths: List[Path]) -> Optional[Path]:
+        """Replace consecutive sealed `.swmz` files by one merged file.
+
+        Decoding and encoding run without holding the write lock, so ingest
+        continues meanwhile; only the final rename does. Returns the new
+        file, or None if the inputs changed (e.g. the log was cleared).
+        """
+        log_id = self.log_id
+        try:
+            packed = compression.merge_segments([path.read_bytes() for path in paths])
+        except FileNotFoundError:
+            return None
+        if packed is None:
+            return None
+        first, last = _segment_range(paths[0])[0], _segment_range(paths[-1])[1]
+        target = self.directory / _merged_name(first, last)
+        tmp_path = target.with_name(target.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(packed)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._write_lock():
+            if self.log_id != log_id or not all(path.exists() for path in paths):
+                tmp_path.unlink()
+                return None
+            # The merged file hides its sources from the moment it exists
+            os.replace(tmp_path, target)
+            for path in paths:
+                path.unlink()
+        return target
+
+    def _sync(self):
+        if self._active is not None and self._unsynced_batches:
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            if self._directory_unsynced:
+                fsync_directory(self.directory)
+                self._directory_unsynced = False
+        self._unsynced_batches = 0
+        self._last_sync = time.monotonic()
+
+    # ------------------------------------------------------------------
+    # Write path
+    # ------------------------------------------------------------------
+    def append(self, records: List[Dict], sync: bool = False,
+               select: Optional[Callable[[List[Dict]], List[Dict]]] = None) -> int:
+        """Append a batch of records; cost depends only on the batch size.
+
+        With ``sync=True`` the batch is fsynced before returning, otherwise
+        fsyncs are batched according to ``fsync_batches``/``fsync_interval``.
+
+        ``select(records)``, if given, runs under the write lock after the
+        listeners caught up with other processes, and only the records it
+        returns are written (used for duplicate filtering). Returns the
+        number of records written.
+        """
+        if not records:
+            return 0
+        payload = None if select is not None else _encode_records(records)
+        with self._write_lock():
+            self._ensure_active()
+            number = self._active_number
+            position = (number, os.fstat(self._active.fileno()).st_size)
+            if position != self._tail_checked and self._repair_tail():
+                position = (number, os.fstat(self._active.fileno()).st_size)
+            if self._listeners and self._cursor != position:
+                # Another process wrote since our last refresh
+                self._refresh_locked()
+
+            if select is not None:
+                records = select(records)
+                if not records:
+                    return 0
+                payload = _encode_records(records)
+
+            self._active.write(payload)
+            self._active.flush()
+            self._unsynced_batches += 1
+            self._tail_checked = (number, position[1] + len(payload))
+
+            if self._listeners and self._cursor == position:
+                self._cursor = (number, position[1] + len(payload))
+                self._dispatch(records)
+
+            if os.fstat(self._active.fileno()).st_size >= self.segment_max_bytes:
+                self._rotate()
+            elif (sync
+                  or self._unsynced_batches >= self.fsync_batches
+                  or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+        return len(records)
+
+    # ------------------------------------------------------------------
+    # Crash recovery
+    # ------------------------------------------------------------------
+    def recover(self) -> int:
+        """Cut a record torn by a crash off the newest segment.
+
+        Called at startup; `append` does the same check whenever the segment
+        changed since its own last write (another process may have died
+        mid-append). Readers already stop at the last complete line, so this
+        only keeps the next append from gluing onto the torn one. Listeners
+        catch up from their cursors as usual, which replays everything that
+        was durable. Returns the number of bytes removed.
+        """
+        segments = self.segments()
+        if not segments or segments[-1].suffix != SEGMENT_SUFFIX:
+            return 0
+        with self._write_lock():
+            self._ensure_active()
+            return self._repair_tail()
+
+    def _repair_tail(self) -> int:
+        """Truncate the active segment after its last newline; caller holds the write lock."""
+        self._active.flush()
+        path = self._active.name
+        with open(path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            keep = size
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    # Search backwards for the end of the last complete record
+                    while keep > 0:
+                        start = max(0, keep - 65536)
+                        f.seek(start)
+                        newline = f.read(keep - start).rfind(b"\n")
+                        if newline >= 0:
+                            keep = start + newline + 1
+                            break
+                        keep = start
+        self._tail_checked = (self._active_number, keep)
+        if keep == size:
+            return 0
+        os.ftruncate(self._active.fileno(), keep)
+        os.fsync(self._active.fileno())
+        self.recovered_bytes += size - keep
+        return size - keep
+
+    def sync(self):
+        """Force pending batches to disk."""
+        with self._lock:
+            self._sync()
+
+    def clear(self):
+        """Remove every segment (used by the dashboard 'Clear All Data')."""
+        with self._write_lock():
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+            for path in self.directory.glob(f"{SEGMENT_PREFIX}*"):
+                path.unlink()
+            try:
+                (self.directory / EXPIRED_NAME).unlink()
+            except FileNotFoundError:
+                pass
+            self._unsynced_batches = 0
+            self._write_log_id()
+            self._cursor = (0, 0)
+            self.version += 1
+            for listener in self._listeners:
+                listener.reset()
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._sync()
+                self._active.close()
+                self._active = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    # ------------------------------------------------------------------
+    # Read path
+    # ------------------------------------------------------------------
+    def iter_records(self) -> Iterator[Dict]:
+        """Yield every stored record in arrival order."""
+        with self._lock:
+            if self._active is not None:
+                self._active.flush()
+            segments = self.segments()
+        for path in segments:
+            records, _ = _read_segment(path)
+            yield from records
+
+    def read_all(self) -> List[Dict]:
+        return list(self.iter_records())
+
+    # ------------------------------------------------------------------
+    # Listeners
+    # ------------------------------------------------------------------
+    def subscribe(self, listener, since=(0, 0)):
+        """Register a listener with ``apply(records)`` and ``reset()`` methods.
+
+        The listener is fed every stored record after the ``since`` cursor,
+        so it can be attached at any time and still see the full history, or
+        resume from a snapshot taken at that cursor.
+        """
+        with self._lock:
+            self._refresh_locked()
+            if not self.valid_cursor(since):
+                listener.reset()
+                since = (0, 0)
+            # One segment at a time, so a replay never holds the whole history
+            for records, _ in self._scan(tuple(since), until=self._cursor):
+                if records:
+                    listener.apply(records)
+            self._listeners.append(listener)
+        return listener
+
+    @property
+    def log_id(self) -> str:
+        """Identifier of this log's contents; changes whenever it is cleared.
+
+        Snapshots store it next to their cursor so a cursor from before a
+        clear is never applied to the new log.
+        """
+        try:
+            return (self.directory / LOG_ID_NAME).read_text().strip()
+        except FileNotFoundError:
+            return self._write_log_id()
+
+    def _write_log_id(self) -> str:
+        log_id = uuid.uuid4().hex
+        tmp_path = self.directory / (LOG_ID_NAME + ".tmp")
+        tmp_path.write_text(log_id)
+        os.replace(tmp_path, self.directory / LOG_ID_NAME)
+        return log_id
+
+    @contextmanager
+    def hold(self):
+        """Pause dispatching and yield the cursor listeners are at."""
+        with self._lock:
+            yield self._cursor
+
+    def valid_cursor(self, cursor) -> bool:
+        """Check that ``cursor`` still points inside the current log."""
+        number, offset = cursor
+        if not number:
+            return True
+        return self._segment_size(number) >= offset
+
+    def refresh(self) -> int:
+        """Feed listeners with records appended by other processes."""
+        with self._lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> int:
+        number, offset = self._cursor
+        if number:
+            size = self._segment_size(number)
+            if size < offset:
+                # The log was cleared by another process
+                self._cursor = (0, 0)
+                self.version += 1
+                for listener in self._listeners:
+                    listener.reset()
+            elif size == offset and self._newest_number() <= number:
+                return 0
+
+        count = 0
+        for records, cursor in self._scan(self._cursor):
+            self._cursor = cursor
+            if records:
+                self._dispatch(records)
+                count += len(records)
+        return count
+
+    def _dispatch(self, records: List[Dict]):
+        self.version += 1
+        for listener in self._listeners:
+            listener.apply(records)
+
+    def _scan(self, cursor, until=None) -> Iterator[Tuple[List[Dict], tuple]]:
+        """Yield ``(records, cursor)`` per segment file after ``cursor`` (and
+        before ``until``); ``cursor`` is just past the records yielded.
+
+        A batch never spans segments, so every chunk holds whole batches.
+        """
+        if self._active is not None:
+            self._active.flush()
+        cursor = tuple(cursor)
+        for path in self.segments():
+            first, last = _segment_range(path)
+            if last < cursor[0] or (until is not None and first > until[0]):
+                continue
+            records, cursor = _read_segment(path, cursor, until)
+            yield records, cursor
+
+    # ------------------------------------------------------------------
+    # Migration from the old single JSON file
+    # ------------------------------------------------------------------
+    def _import_legacy(self, legacy_file: Path):
+        if not legacy_file.exists() or self.segments():
+            return
+        try:
+            with open(legacy_file, "r") as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(records, list) or not records:
+            return
+        # The old single-file server stored whatever it was sent; invalid
+        # rows stay only in the renamed `.imported` file
+        records, _ = validate_records(records)
+        if records:
+            self.append(records)
+        self.sync()
+        legacy_file.rename(legacy_file.with_name(legacy_file.name + ".imported"))
@@ -1,18 +1,31 @@
 import streamlit as st
 import json
 import datetime
+import os
+import sqlite3
 from pathlib import Path
 import pandas as pd
 from typing import List, Dict
 
+import analytics
+import export
+from columnar import ColumnStore, FrameCache
+from compaction import RAW_RETENTION_DAYS, Compactor
+from detection import LeakDetector
+from indexes import LatestIndex, RecentKeys
+from ingest import INGEST_SOCKET_NAME, IngestTimeout, IngestWriter, SocketIngestWriter
+from backends import open_backend
+from liveness import LivenessTracker, now_ns
+from rollups import RollupTables
+from validation import validate_batch
+
 # File untuk menyimpan data
-DATA_FILE = Path("water_flow_data.json")
+DATA_FILE = Path("water_flow_data.json")  # legacy single-file store, imported once
+DATA_DIR = Path("water_flow_data")
 DEVICES_FILE = Path("registered_devices.json")
 
 # Inisialisasi file jika belum ada
 def init_files():
-    if not DATA_FILE.exists():
-        DATA_FILE.write_text(json.dumps([]))
     if not DEVICES_FILE.exists():
         # Register default device
         devices = {
@@ -26,28 +39,128 @@ def init_files():
 
 init_files()
 
+# Dibuat sekali per proses, bukan setiap rerun Streamlit
+@st.cache_resource
+def get_backend():
+    # SWM_STORAGE=json (default) atau sqlite, harus sama dengan API server
+    return open_backend(None, DATA_DIR, DEVICES_FILE, legacy_file=DATA_FILE)
+
+@st.cache_resource
+def get_store():
+    return get_backend().log
+
+@st.cache_resource
+def get_latest_index():
+    return LatestIndex.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_columns():
+    # Snapshot di-mmap, lalu hanya log setelah snapshot yang di-replay
+    return ColumnStore.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_frame_cache():
+    # DataFrame bersama untuk semua session, hanya baris baru yang di-append
+    return FrameCache(get_store(), get_columns())
+
+@st.cache_resource
+def get_rollups():
+    return RollupTables.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_detector():
+    # Deteksi kebocoran per batch, state + alert disimpan di alerts.json
+    return LeakDetector.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_liveness():
+    # Last seen + cadence upload per device, heap untuk device yang terlambat
+    return LivenessTracker.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_recent_keys():
+    # Timestamp terakhir per device, untuk membuang record yang dikirim ulang
+    return RecentKeys.open(get_store(), DATA_DIR)
+
+@st.cache_resource
+def get_writer():
+    # Jalur append yang sama dengan API (dedup + durable sebelum balas)
+    if SocketIngestWriter.available(DATA_DIR / INGEST_SOCKET_NAME):
+        return SocketIngestWriter(DATA_DIR / INGEST_SOCKET_NAME)
+    return IngestWriter(get_store(), dedup=get_recent_keys())
+
+@st.cache_resource
+def get_registry():
+    return get_backend().registry
+
+@st.cache_resource
+def get_compactor():
+    # Retensi data mentah + merge segment kecil, jalan di background thread
+    # (SWM_RETENTION_DAYS harus sama dengan API server)
+    compactor = Compactor(
+        get_store(), DATA_DIR, rollups=get_rollups(), columns=get_columns(),
+        retention_days=float(os.environ.get("SWM_RETENTION_DAYS", RAW_RETENTION_DAYS)))
+    compactor.start()
+    return compactor
+
+backend = get_backend()
+store = get_store()
+latest_index = get_latest_index()
+columns = get_columns()
+frame_cache = get_frame_cache()
+rollups = get_rollups()
+detector = get_detector()
+liveness = get_liveness()
+recent_keys = get_recent_keys()
+writer = get_writer()
+compactor = get_compactor()
+registry = get_registry()
+
 # Load data
-def load_data():
+def load_frame(device_id=None):
+    """Cached, typed DataFrame sorted by received_at (ascending)"""
+    # Jangan sembunyikan storage yang rusak di balik history kosong
     try:
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return []
+        return frame_cache.get(device_id)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        st.error(f"❌ Gagal membaca data dari {DATA_DIR}: {e}")
+        st.stop()
 
 def load_devices():
     try:
-        with open(DEVICES_FILE, 'r') as f:
-            return json.load(f)
+        return backend.load_devices()
     except:
         return {}
 
-def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def save_data(records):
+    """Store new records durably; returns how many were not duplicates"""
+    return writer.write(records)
+
+def ingest_batch(device_id, data_array):
+    """Validate a batch like the API's /data and store it; returns the response"""
+    if not isinstance(data_array, list):
+        return {"status": "error", "message": "data must be a JSON array"}
+    records, rejected = validate_batch(data_array, device_id)
+    if rejected and not records:
+        return {"status": "error", "message": f"all {len(data_array)} data points rejected",
+                "rejected": rejected}
+    try:
+        stored = save_data(records)
+    except IngestTimeout as e:
+        return {"status": "error", "message": str(e)}
+    return {
+        "status": "success",
+        "message": f"Received {len(data_array)} data points",
+        "device_id": device_id,
+        "duplicates": len(records) - stored,
+        "rejected": rejected
+    }
+
+def clear_data():
+    backend.clear_data()
 
 def save_devices(devices):
-    with open(DEVICES_FILE, 'w') as f:
-        json.dump(devices, f, indent=2)
+    backend.save_devices(devices)
 
 # API Endpoints (menggunakan Streamlit query params)
 def handle_verify():
@@ -64,6 +177,7 @@ def handle_verify():
     
     devices = load_devices()
     if device_id in devices:
+        liveness.verified(device_id)
         return {
             "status": "verified",
             "device_id": device_id,
@@ -99,23 +213,8 @@ def handle_data():
     if device_id not in devices:
         return {"status": "error", "message": "device not registered"}
     
-    # Load existing data
-    all_data = load_data()
-    
-    # Tambahkan metadata
-    for record in incoming_data:
-        record['device_id'] = device_id
-        record['received_at'] = datetime.datetime.now().isoformat()
-        all_data.append(record)
-    
-    # Save
-    save_data(all_data)
-    
-    return {
-        "status": "success",
-        "message": f"Received {len(incoming_data)} data points",
-        "device_id": device_id
-    }
+    # Validasi + satu received_at per batch, lalu append (hanya batch baru)
+    return ingest_batch(device_id, incoming_data)
 
 # Streamlit UI
 def main():
@@ -152,11 +251,17 @@ def main():
 def show_dashboard():
     st.header("📊 Dashboard")
     
-    # Load data
-    all_data = load_data()
+    # Load data (cached; reruns without new data do no I/O)
+    df = load_frame()
+    columns.maybe_checkpoint(store, DATA_DIR)
+    rollups.maybe_checkpoint(store, DATA_DIR)
+    detector.maybe_checkpoint(store, DATA_DIR)
+    latest_index.maybe_checkpoint(store, DATA_DIR)
+    liveness.maybe_checkpoint(store, DATA_DIR)
+    recent_keys.maybe_checkpoint(store, DATA_DIR)
     devices = load_devices()
     
-    if not all_data:
+    if len(df) == 0:
         st.info("📭 No data received yet. Waiting for ESP32 to send data...")
         st.markdown("""
         ### Setup Instructions:
@@ -172,52 +277,90 @@ def show_dashboard():
     col1, col2, col3 = st.columns(3)
     
     with col1:
-        st.metric("Total Records", len(all_data))
+        st.metric("Total Records", len(df))
     
     with col2:
-        unique_devices = len(set([d.get('device_id', 'unknown') for d in all_data]))
-        st.metric("Active Devices", unique_devices)
+        # Device yang upload/verify sesuai cadence-nya (bukan sekadar pernah kirim data)
+        at_ns = now_ns()
+        overdue = len(liveness.overdue(at_ns))
+        st.metric("Active Devices", liveness.active_count(at_ns),
+                  delta=f"{overdue} overdue" if overdue else None,
+                  delta_color="inverse")
     
     with col3:
-        if all_data:
-            latest_record = all_data[-1]
+        latest_record = latest_index.get()
+        if latest_record:
             st.metric("Latest Flow Rate", f"{latest_record.get('flow_rate', 0):.2f} L/min")
     
-    # Convert to DataFrame
-    df = pd.DataFrame(all_data)
-    
-    if 'received_at' in df.columns:
-        df['received_at'] = pd.to_datetime(df['received_at'])
-        df = df.sort_values('received_at', ascending=False)
+    # Filter by device (per-device frame langsung dari columnar store)
+    selected_device = st.selectbox(
+        "Select Device",
+        options=['All'] + columns.device_ids()
+    )
     
-    # Filter by device
-    if 'device_id' in df.columns:
-        selected_device = st.selectbox(
-            "Select Device",
-            options=['All'] + list(df['device_id'].unique())
-        )
-        
-        if selected_device != 'All':
-            df_filtered = df[df['device_id'] == selected_device]
-        else:
-            df_filtered = df
+    if selected_device != 'All':
+        df_filtered = load_frame(selected_device)
     else:
         df_filtered = df
+    # Terbaru di atas
+    df_filtered = df_filtered.iloc[::-1]
     
     # Chart
     st.subheader("📈 Flow Rate Over Time")
     if 'flow_rate' in df_filtered.columns and len(df_filtered) > 0:
-        chart_data = df_filtered[['received_at', 'flow_rate']].set_index('received_at')
-        st.line_chart(chart_data)
+        st.line_chart(flow_chart_data(selected_device))
     else:
         st.info("No flow rate data available")
     
+    # Daily consumption dari rollup table (tidak menghitung ulang dari raw data)
+    st.subheader("💧 Daily Consumption (L)")
+    daily = pd.DataFrame(rollups.rows(
+        'daily', None if selected_device == 'All' else selected_device))
+    if len(daily) > 0:
+        daily['bucket_start'] = pd.to_datetime(daily['bucket_start'])
+        st.bar_chart(daily.pivot_table(index='bucket_start', columns='device_id', values='volume'))
+    else:
+        st.info("No consumption data available")
+    
+    # Alert kebocoran/anomali dari detector (sudah dihitung saat ingest)
+    st.subheader("🚨 Leak & Anomaly Alerts")
+    alerts = detector.alerts(None if selected_device == 'All' else selected_device, limit=20)
+    if alerts:
+        st.dataframe(pd.DataFrame(alerts)[['received_at', 'device_id', 'type', 'message']],
+                     use_container_width=True)
+    else:
+        st.success("No alerts")
+    
     # Recent data table
     st.subheader("📋 Recent Data (Last 20 records)")
     display_cols = ['device_id', 'flow_rate', 'volume', 'timestamp', 'received_at']
     available_cols = [col for col in display_cols if col in df_filtered.columns]
     st.dataframe(df_filtered[available_cols].head(20), use_container_width=True)
 
+def flow_chart_data(selected_device='All'):
+    """Flow rate per device, downsampled with LTTB to at most CHART_MAX_POINTS"""
+    device_ids = columns.device_ids() if selected_device == 'All' else [selected_device]
+    per_device = max(3, analytics.CHART_MAX_POINTS // max(1, len(device_ids)))
+    
+    frames = []
+    for device_id in device_ids:
+        window = columns.window(device_id)
+        if window is None:
+            continue
+        # Waktu sampel (bukan received_at yang sama untuk satu batch)
+        window = analytics.by_sample_time(window)
+        selected = analytics.lttb(window['sampled_at'], window['flow_rate'], per_device)
+        frames.append(pd.DataFrame({
+            'sampled_at': window['sampled_at'][selected].view('datetime64[ns]'),
+            'device_id': device_id,
+            'flow_rate': window['flow_rate'][selected],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=['flow_rate'])
+    
+    chart = pd.concat(frames, ignore_index=True)
+    return chart.pivot_table(index='sampled_at', columns='device_id', values='flow_rate')
+
 def show_api_testing():
     st.header("🧪 API Testing")
     
@@ -310,20 +453,13 @@ def show_api_testing():
             if device_id_from_json not in devices:
                 st.error(f"❌ Device not registered: {device_id_from_json}")
             else:
-                # Save data
-                all_data = load_data()
-                for record in data_array:
-                    record['device_id'] = device_id_from_json
-                    record['received_at'] = datetime.datetime.now().isoformat()
-                    all_data.append(record)
-                save_data(all_data)
-                
-                st.success(f"✅ Successfully received {len(data_array)} data points!")
-                st.json({
-                    "status": "success",
-                    "message": f"Received {len(data_array)} data points",
-                    "device_id": device_id_from_json
-                })
+                # Save data (validasi + dedup seperti /data di API)
+                result = ingest_batch(device_id_from_json, data_array)
+                if result["status"] == "success":
+                    st.success(f"✅ Successfully received {len(data_array)} data points!")
+                else:
+                    st.error(f"❌ {result['message']}")
+                st.json(result)
                 
                 # Clear session state
                 if 'incoming_data' in st.session_state:
@@ -379,31 +515,47 @@ def show_device_management():
 def show_raw_data():
     st.header("📄 Raw Data")
     
-    all_data = load_data()
+    df = load_frame()
     
     col1, col2 = st.columns([3, 1])
     
     with col1:
-        st.subheader(f"Total Records: {len(all_data)}")
+        st.subheader(f"Total Records: {len(df)}")
     
     with col2:
         if st.button("🗑️ Clear All Data"):
-            save_data([])
+            clear_data()
             st.success("All data cleared!")
             st.rerun()
     
-    if all_data:
-        st.json(all_data[-10:])  # Show last 10 records
+    if len(df) > 0:
+        # Show last 10 records
+        st.json(json.loads(df.tail(10).to_json(orient='records', date_format='iso')))
         
-        # Download button
-        df = pd.DataFrame(all_data)
-        csv = df.to_csv(index=False)
-        st.download_button(
-            label="📥 Download as CSV",
-            data=csv,
-            file_name=f"water_flow_data_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv"
+        # Export dibuat hanya saat diminta, bukan setiap render
+        st.subheader("📥 Export")
+        export_device = st.selectbox("Device", ['All'] + columns.device_ids(), key="export_device")
+        export_range = st.date_input(
+            "Date range (received_at)",
+            value=(df['received_at'].iloc[0].date(), df['received_at'].iloc[-1].date()),
+            key="export_range"
         )
+        
+        if st.button("Prepare CSV export"):
+            device_ids = None if export_device == 'All' else [export_device]
+            start_ns = end_ns = None
+            if isinstance(export_range, (tuple, list)) and len(export_range) == 2:
+                start_ns = pd.Timestamp(export_range[0]).value
+                end_ns = (pd.Timestamp(export_range[1]) + pd.Timedelta(days=1)).value
+            # Hanya untuk run ini; tidak disimpan di session_state
+            st.download_button(
+                label="📥 Download as CSV",
+                data=b"".join(export.iter_csv(columns, device_ids, start_ns, end_ns)),
+                file_name=f"water_flow_data_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime="text/csv"
+            )
+        st.caption("Untuk export besar atau Parquet gunakan Flask API: "
+                   "`/export?format=csv|parquet&device_id=...&from=...&to=...`")
     else:
         st.info("No data available")
 
@@ -0,0 +1,61 @@
+from indexes import RecentKeys
+
+MINUTE_MS = 60_000
+
+
+def batch(device_id, timestamps):
+    return [{"device_id": device_id, "timestamp": ts, "flow_rate": 1.0, "volume": float(i)}
+            for i, ts in enumerate(timestamps)]
+
+
+def sent(keys, records):
+    """Dedup a batch, then append what is left (as the ingest writer does)."""
+    fresh = keys.fresh(records)
+    keys.apply(fresh)
+    return [record["timestamp"] for record in fresh]
+
+
+def test_retry_is_dropped():
+    keys = RecentKeys()
+    first = [k * MINUTE_MS for k in range(1, 11)]
+    assert sent(keys, batch("A", first)) == first
+    assert sent(keys, batch("A", first)) == []
+    # Partly re-sent batch: only the new samples go through
+    second = [k * MINUTE_MS for k in range(6, 16)]
+    assert sent(keys, batch("A", second)) == second[5:]
+
+
+def test_reboot_forgets_keys():
+    keys = RecentKeys()
+    before = [k * MINUTE_MS for k in range(1, 201)]
+    for i in range(0, len(before), 10):
+        sent(keys, batch("A", before[i:i + 10]))
+
+    # After a reboot millis() starts over and repeats keys from before it
+    after = [k * MINUTE_MS for k in range(1, 11)]
+    assert sent(keys, batch("A", after)) == after
+    # A retry of the post-reboot batch is still a duplicate
+    assert sent(keys, batch("A", after)) == []
+    # Other devices keep their keys
+    sent(keys, batch("B", before[-10:]))
+    assert sent(keys, batch("B", before[-10:])) == []
+
+
+def test_quick_reboot_forgets_keys():
+    keys = RecentKeys()
+    before = [k * MINUTE_MS for k in range(1, 31)]
+    for i in range(0, len(before), 10):
+        sent(keys, batch("A", before[i:i + 10]))
+    # Rebooted 30 minutes after boot: the new batch overlaps the old keys
+    after = [k * MINUTE_MS for k in range(1, 11)]
+    assert sent(keys, batch("A", after)) == after
+    # A retry of the last pre-reboot batch would have reached its newest key
+    assert sent(keys, batch("A", after)) == []
+
+
+def test_fresh_does_not_forget_keys():
+    keys = RecentKeys()
+    keys.apply(batch("A", [k * MINUTE_MS for k in range(150, 201)]))
+    keys.fresh(batch("A", [MINUTE_MS]))
+    # Not appended, so a retry of the pre-reboot buffer is still recognized
+    assert keys.fresh(batch("A", [200 * MINUTE_MS])) == []
@@ -0,0 +1,50 @@
+import random
+
+from validation import _validate_matrix, _validate_rows, validate_records
+
+STAMP = "2026-01-01T00:00:00"
+
+
+def record(timestamp, volume=1.0, received_at=STAMP, device_id="A"):
+    return {"device_id": device_id, "timestamp": timestamp, "flow_rate": 1.0,
+            "volume": volume, "received_at": received_at}
+
+
+def test_legacy_records_keep_their_stamp():
+    records, rejected = validate_records([
+        record(1),
+        record("abc"),
+        record(2, received_at="not a time"),
+        "junk",
+        record(3, received_at="2026-01-01T00:01:00"),
+    ])
+    assert [(r["timestamp"], r["received_at"]) for r in records] == [
+        (1, STAMP), (3, "2026-01-01T00:01:00")]
+    assert rejected == 3
+
+
+def random_value(rng):
+    return rng.choice([
+        rng.randrange(0, 10_000), rng.uniform(0, 100), -rng.uniform(0, 5), -1,
+        2 ** 53, 2 ** 53 + 1, 2 ** 63 - 1, 2 ** 63, -2 ** 63 - 1, float(2 ** 63), 1e300,
+        float("nan"), float("inf"), True, None, "12", [1],
+    ])
+
+
+def random_row(rng):
+    if rng.random() < 0.02:
+        return rng.choice(["junk", None, 5])
+    row = {name: random_value(rng) if rng.random() < 0.3 else value
+           for name, value in (("timestamp", rng.randrange(0, 10 ** 6)),
+                               ("flow_rate", rng.uniform(0, 30)),
+                               ("volume", rng.uniform(0, 1000)))}
+    if rng.random() < 0.02:
+        del row[rng.choice(list(row))]
+    return row
+
+
+def test_loop_and_numpy_paths_agree():
+    rng = random.Random(15)
+    for _ in range(300):
+        rows = [random_row(rng) for _ in range(rng.randrange(1, 40))]
+        assert (_validate_rows(rows, "A", STAMP) == _validate_matrix(rows, "A", STAMP)), rows
@@ -0,0 +1,237 @@
+"""
+Validation and normalization of incoming `/data` batches.
+
+`validate_batch()` checks a whole batch at once: the fields are pulled into
+one ``(n, 3)`` NumPy array (non-numbers become NaN) and every rule is a
+vectorized mask over it. Python-level work per row is limited to building the
+stored record; error messages are only formatted for rejected rows. Batches
+below ``NUMPY_MIN_ROWS`` (the firmware sends 10) go through a plain loop
+with the same rules instead, since there the fixed cost of the NumPy calls
+outweighs the per-row work.
+
+Rules per row:
+
+    timestamp   integer >= 0 (ESP32 `millis()`)
+    flow_rate   finite number >= 0 (L/min)
+    volume      finite number >= 0 (total L), not lower than any accepted
+                row since the last reboot (a timestamp lower than the
+                previous row's: a reboot resets both counters)
+
+JSON integers must lie strictly within +-2**53, where float64 (the NumPy
+path) holds them exactly; floats are only bounded by the rules above.
+
+Accepted rows are rebuilt with only the known fields plus `device_id` and one
+`received_at` stamp shared by the whole batch. `validate_records()` applies
+the same rules to records that already carry both (the legacy JSON import).
+"""
+
+import datetime
+import math
+from itertools import chain, groupby
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+FIELDS = ("timestamp", "flow_rate", "volume")
+TIMESTAMP, FLOW_RATE, VOLUME = range(3)
+
+_INT64_LIMIT = 2 ** 63
+_EXACT_INT_LIMIT = 2 ** 53
+_NUMBER_TYPES = {int, float}
+_UPPER_BOUNDS = np.array([float(_INT64_LIMIT), np.inf, np.inf])
+
+# Smaller batches are validated by a plain loop (crossover in validation_bench.py)
+NUMPY_MIN_ROWS = 256
+
+
+def _number(row, name: str) -> float:
+    if type(row) is not dict:
+        return float("nan")
+    value = row.get(name)
+    # type() rather than isinstance(): bools are not numbers here
+    if type(value) is int:
+        return value if -_EXACT_INT_LIMIT < value < _EXACT_INT_LIMIT else float("nan")
+    return value if type(value) is float else float("nan")
+
+
+def number(value):
+    """``value`` if it is an int or a finite float, else None.
+
+    For readers of stored records, which may predate validation.
+    """
+    if type(value) is int or (type(value) is float and math.isfinite(value)):
+        return value
+    return None
+
+
+def _matrix(rows: List) -> np.ndarray:
+    """``(n, 3)`` float64 of the fields; NaN where missing or not a number."""
+    try:
+        values = [(row["timestamp"], row["flow_rate"], row["volume"]) for row in rows]
+    except (KeyError, TypeError, IndexError):
+        values = None
+    # Common case: every field present and numeric, converted in one call
+    if values is not None and set(map(type, chain.from_iterable(values))) <= _NUMBER_TYPES:
+        try:
+            matrix = np.array(values, dtype=np.float64)
+        except OverflowError:
+            pass
+        else:
+            # Ints beyond 2**53 are rejected like in `_number`; large floats
+            # are not, so only those rows are looked at again
+            for i in np.flatnonzero((np.abs(matrix) >= _EXACT_INT_LIMIT).any(axis=1)).tolist():
+                matrix[i] = [_number(rows[i], name) for name in FIELDS]
+            return matrix
+    return np.array([[_number(row, name) for name in FIELDS] for row in rows],
+                    dtype=np.float64)
+
+
+def _valid(value, integral: bool) -> bool:
+    """The NumPy rules for one field: a finite number >= 0 (integral for timestamps)."""
+    if type(value) is int:
+        return 0 <= value < _EXACT_INT_LIMIT
+    if type(value) is not float:
+        return False
+    if integral:
+        return 0 <= value < _INT64_LIMIT and value == math.floor(value)
+    return 0 <= value < math.inf
+
+
+def _errors(row, ok, decreased: bool) -> List[str]:
+    """Messages of a rejected row; ``ok`` holds the per-field checks."""
+    if type(row) is not dict:
+        return ["record must be a JSON object"]
+    errors = []
+    if not ok[TIMESTAMP]:
+        errors.append("timestamp must be a non-negative integer")
+    if not ok[FLOW_RATE]:
+        errors.append("flow_rate must be a finite number >= 0")
+    if not ok[VOLUME]:
+        errors.append("volume must be a finite number >= 0")
+    if decreased:
+        errors.append("volume decreased without a device reboot")
+    return errors
+
+
+def _validate_rows(rows: List, device_id: str,
+                   received_at: str) -> Tuple[List[Dict], List[Dict]]:
+    """`validate_batch` for small batches, one row at a time."""
+    records, rejected = [], []
+    previous = peak = None
+    for i, row in enumerate(rows):
+        if type(row) is dict:
+            timestamp, volume = row.get("timestamp"), row.get("volume")
+            ok = (_valid(timestamp, True), _valid(row.get("flow_rate"), False),
+                  _valid(volume, False))
+        else:
+            ok = (False, False, False)
+        decreased = False
+        if all(ok):
+            if previous is None or timestamp < previous:
+                peak = volume  # first row or reboot
+            elif volume < peak:
+                decreased = True
+            else:
+                peak = volume
+            previous = timestamp
+            if not decreased:
+                records.append({
+                    "timestamp": int(timestamp),
+                    "flow_rate": row["flow_rate"],
+                    "volume": volume,
+                    "device_id": device_id,
+                    "received_at": received_at,
+                })
+                continue
+        rejected.append({"index": i, "errors": _errors(row, ok, decreased)})
+    return records, rejected
+
+
+def validate_batch(rows: List, device_id: str,
+                   received_at: Optional[str] = None) -> Tuple[List[Dict], List[Dict]]:
+    """Split a batch into normalized records and per-row rejections.
+
+    Returns ``(records, rejected)`` where each rejection is
+    ``{"index": i, "errors": [...]}`` with ``i`` the row's position in the
+    batch.
+    """
+    if received_at is None:
+        received_at = datetime.datetime.now().isoformat()
+    if not rows:
+        return [], []
+    if len(rows) < NUMPY_MIN_ROWS:
+        return _validate_rows(rows, device_id, received_at)
+    return _validate_matrix(rows, device_id, received_at)
+
+
+def _validate_matrix(rows: List, device_id: str,
+                     received_at: str) -> Tuple[List[Dict], List[Dict]]:
+    """`validate_batch` for large batches, as NumPy masks over `_matrix`."""
+    values = _matrix(rows)
+    timestamp, volume = values[:, TIMESTAMP], values[:, VOLUME]
+    # NaN fails both comparisons, so this is "finite, >= 0 and in range"
+    field_ok = (values >= 0) & (values < _UPPER_BOUNDS)
+    field_ok[:, TIMESTAMP] &= timestamp == np.floor(timestamp)
+    valid = field_ok.all(axis=1)
+
+    # Monotonic volume: not below the highest volume since the last reboot,
+    # i.e. since a timestamp lower than the previous otherwise valid row's
+    order = np.flatnonzero(valid)
+    vol, ts = volume[order], timestamp[order]
+    starts = np.flatnonzero(np.concatenate(([True], ts[1:] < ts[:-1])))
+    peak = np.empty_like(vol)
+    for lo, hi in zip(starts.tolist(), starts[1:].tolist() + [len(vol)]):
+        peak[lo:hi] = np.maximum.accumulate(vol[lo:hi])
+    step_down = vol[1:] < peak[:-1]
+    step_down[starts[1:] - 1] = False
+    decreased = order[np.flatnonzero(step_down) + 1]
+    valid[decreased] = False
+
+    records = [
+        {
+            "timestamp": int(rows[i]["timestamp"]),
+            "flow_rate": rows[i]["flow_rate"],
+            "volume": rows[i]["volume"],
+            "device_id": device_id,
+            "received_at": received_at,
+        }
+        for i in np.flatnonzero(valid).tolist()
+    ]
+    if len(records) == len(rows):
+        return records, []
+
+    decreased = set(decreased.tolist())
+    rejected = [{"index": i, "errors": _errors(rows[i], field_ok[i], i in decreased)}
+                for i in np.flatnonzero(~valid).tolist()]
+    return records, rejected
+
+
+def _batch_key(record) -> tuple:
+    if type(record) is not dict:
+        return (None, None)
+    received_at = record.get("received_at")
+    try:
+        if not isinstance(received_at, str) or np.isnat(np.datetime64(received_at, "ns")):
+            received_at = None
+    except ValueError:
+        received_at = None
+    return (record.get("device_id", "unknown"), received_at)
+
+
+def validate_records(records: List) -> Tuple[List[Dict], int]:
+    """Validate stored-format records; returns ``(records, rejected count)``.
+
+    Consecutive records of one device with the same ``received_at`` are
+    checked as one batch and keep their stamp. Rows that are not objects or
+    have no valid ``received_at`` are dropped.
+    """
+    accepted, rejected = [], 0
+    for (device_id, received_at), rows in groupby(records, key=_batch_key):
+        rows = list(rows)
+        if received_at is None:
+            rejected += len(rows)
+            continue
+        valid, errors = validate_batch(rows, str(device_id), received_at)
+        accepted.extend(valid)
+        rejected += len(errors)
+    return accepted, rejected
@@ -0,0 +1,55 @@
+"""
+Compact binary ingest format for ESP32 batches.
+
+The body is the firmware's buffer sent as-is: a packed array of
+
+    struct Data {
+        unsigned long timestamp;  // millis(), uint32 on ESP32
+        float flow_rate;          // L/min
+        float volume;             // total L
+    };
+
+little-endian, 12 bytes per record, no header. The device id travels in the
+query string (`POST /data?device_id=...`). Batches are decoded in one call to
+`numpy.frombuffer` instead of parsing JSON text.
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+BINARY_CONTENT_TYPES = ("application/octet-stream", "application/x-swm-batch")
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<u4"),
+    ("flow_rate", "<f4"),
+    ("volume", "<f4"),
+])
+
+
+def is_binary(mimetype: str) -> bool:
+    return mimetype in BINARY_CONTENT_TYPES
+
+
+def decode_batch(payload: bytes) -> List[Dict]:
+    """Decode a packed batch into record dicts (without device metadata)."""
+    if len(payload) % RECORD_DTYPE.itemsize:
+        raise ValueError(
+            f"binary batch length must be a multiple of {RECORD_DTYPE.itemsize} bytes")
+    rows = np.frombuffer(payload, dtype=RECORD_DTYPE)
+    # float32 -> shortest decimal repr, so 2.3 is stored as 2.3
+    flow_rate = rows["flow_rate"].astype(str).astype(np.float64).tolist()
+    volume = rows["volume"].astype(str).astype(np.float64).tolist()
+    return [
+        {"timestamp": ts, "flow_rate": fr, "volume": vol}
+        for ts, fr, vol in zip(rows["timestamp"].tolist(), flow_rate, volume)
+    ]
+
+
+def encode_batch(records: List[Dict]) -> bytes:
+    """Pack records the way the firmware does (used by tests and simulators)."""
+    rows = np.empty(len(records), dtype=RECORD_DTYPE)
+    rows["timestamp"] = [r["timestamp"] for r in records]
+    rows["flow_rate"] = [r["flow_rate"] for r in records]
+    rows["volume"] = [r["volume"] for r in records]
+    return rows.tobytes()